@@ -0,0 +1,720 @@
+#!/usr/bin/env python3
+"""Time the Fizkin stages on synthetic communities of growing size"""
+
+import argparse
+import json
+import math
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+import time
+import numpy as np
+
+BASES = np.frombuffer(b'ACGT', dtype=np.uint8)
+
+# The stages in the report, in pipeline order
+STAGES = [
+    'subset_input', 'jellyfish_count', 'numpy_count', 'pairwise_compare',
+    'numpy_compare', 'colored_compare', 'sharded_compare', 'count_kept_reads',
+    'get_input_file_counts', 'make_matrix'
+]
+
+# fizkin.py arguments keeping GBME short; "--fizkin_args" may override
+FIGURE_ARGS = ['-N', '10']
+
+# Scheduler jobs by name prefix, for stages run as one job graph
+JOB_STAGES = {
+    'subset': 'subset_input',
+    'index': 'jellyfish_count',
+    'compare': 'pairwise_compare'
+}
+
+
+# --------------------------------------------------
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark fizkin.py on synthetic metagenomes',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '-N',
+        '--num_samples',
+        help='Community sizes to run',
+        metavar='int',
+        type=int,
+        nargs='+',
+        default=[10, 100, 1000])
+
+    parser.add_argument(
+        '-r',
+        '--num_reads',
+        help='Reads per sample',
+        metavar='int',
+        type=int,
+        default=10000)
+
+    parser.add_argument(
+        '-l',
+        '--read_len',
+        help='Read length',
+        metavar='int',
+        type=int,
+        default=150)
+
+    parser.add_argument(
+        '-g',
+        '--genome_size',
+        help='Size of each synthetic genome',
+        metavar='int',
+        type=int,
+        default=100000)
+
+    parser.add_argument(
+        '-G',
+        '--num_shared',
+        help='Number of genomes in the shared pool',
+        metavar='int',
+        type=int,
+        default=10)
+
+    parser.add_argument(
+        '-f',
+        '--shared_fraction',
+        help='Fraction of each sample\'s reads from the shared pool',
+        metavar='float',
+        type=float,
+        default=0.5)
+
+    parser.add_argument(
+        '-s',
+        '--seed',
+        help='Random seed for the communities',
+        metavar='int',
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        '-w',
+        '--work_dir',
+        help='Where to put the communities and runs',
+        metavar='str',
+        type=str,
+        default='fizkin-bench')
+
+    parser.add_argument(
+        '-t',
+        '--num_threads',
+        help='Number of threads for fizkin.py',
+        metavar='int',
+        type=int,
+        default=os.cpu_count() or 1)
+
+    parser.add_argument(
+        '-a',
+        '--fizkin_args',
+        help='More arguments for fizkin.py, e.g., "-e numpy"',
+        metavar='str',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-F',
+        '--prefilter',
+        help='Also run with this --prefilter, report its error against '
+        'the exact run (0 = off)',
+        metavar='float',
+        type=float,
+        default=0.)
+
+    parser.add_argument(
+        '-b',
+        '--baseline',
+        help='Baseline report to compare against',
+        metavar='str',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-B',
+        '--save_baseline',
+        help='Also save this report as the (new) baseline',
+        metavar='str',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-T',
+        '--tolerance',
+        help='Allowed slowdown/growth over the baseline',
+        metavar='float',
+        type=float,
+        default=0.2)
+
+    parser.add_argument(
+        '-M',
+        '--min_seconds',
+        help='Ignore wall-time regressions smaller than this',
+        metavar='float',
+        type=float,
+        default=1.)
+
+    parser.add_argument(
+        '-p',
+        '--parse',
+        help='Only benchmark the FASTA/Q parsers on these files',
+        metavar='str',
+        type=str,
+        nargs='+',
+        default=[])
+
+    parser.add_argument(
+        '-P',
+        '--parse_size',
+        help='Only benchmark the parsers, on a synthetic FASTA this size '
+        '(e.g., "1G")',
+        metavar='str',
+        type=str,
+        default='')
+
+    return parser.parse_args()
+
+
+# --------------------------------------------------
+def warn(msg):
+    """Print a message to STDERR"""
+
+    print(msg, file=sys.stderr)
+
+
+# --------------------------------------------------
+def die(msg='Something went wrong'):
+    """Print a message to STDERR and exit with error"""
+
+    warn('Error: {}'.format(msg))
+    sys.exit(1)
+
+
+# --------------------------------------------------
+def random_genome(rand, size):
+    """A uniform random genome as a uint8 array of bases"""
+
+    return BASES[rand.randint(0, 4, size)]
+
+
+# --------------------------------------------------
+def sample_reads(rand, genome, num_reads, read_len):
+    """(num_reads x read_len) array of reads from random genome positions"""
+
+    if num_reads < 1:
+        return np.zeros((0, read_len), dtype=np.uint8)
+
+    starts = rand.randint(0, len(genome) - read_len + 1, num_reads)
+    return genome[starts[:, None] + np.arange(read_len)]
+
+
+# --------------------------------------------------
+def write_sample(path, name, reads):
+    """Write reads as FASTA named "<name>_<num>", via a temp file"""
+
+    lines = []
+    for num, read in enumerate(reads):
+        lines.append('>{}_{}\n'.format(name, num).encode())
+        lines.append(read.tobytes() + b'\n')
+
+    with open(path + '.tmp', 'wb') as out_fh:
+        out_fh.write(b''.join(lines))
+    os.rename(path + '.tmp', path)
+
+
+# --------------------------------------------------
+def make_community(reads_dir, num_samples, params):
+    """
+    Write (or reuse) "num_samples" FASTA files in which "shared_fraction"
+    of the reads come from a pool of shared genomes and the rest from a
+    genome private to the sample. Sample "i" depends only on the seed
+    and "i", so every community is a prefix of the larger ones.
+    """
+
+    if not os.path.isdir(reads_dir):
+        os.makedirs(reads_dir)
+
+    genome_size = params['genome_size']
+    read_len = params['read_len']
+    if genome_size < read_len:
+        die('--genome_size "{}" shorter than --read_len "{}"'.format(
+            genome_size, read_len))
+
+    pool = None
+    files = []
+    for num in range(num_samples):
+        name = 'sample{:05d}'.format(num)
+        path = os.path.join(reads_dir, name + '.fa')
+        files.append(path)
+        if os.path.isfile(path):
+            continue
+
+        if pool is None:
+            rand = np.random.RandomState(params['seed'])
+            pool = [
+                random_genome(rand, genome_size)
+                for _ in range(params['num_shared'])
+            ]
+
+        rand = np.random.RandomState([params['seed'], num + 1])
+        num_shared = int(round(params['num_reads'] *
+                               params['shared_fraction'])) if pool else 0
+        source = rand.randint(0, max(1, len(pool)), num_shared)
+        reads = [
+            sample_reads(rand, pool[genome], np.sum(source == genome),
+                         read_len) for genome in range(len(pool))
+        ]
+        reads.append(
+            sample_reads(rand, random_genome(rand, genome_size),
+                         params['num_reads'] - num_shared, read_len))
+
+        reads = np.concatenate(reads)
+        write_sample(path, name, reads[rand.permutation(len(reads))])
+
+    return files
+
+
+# --------------------------------------------------
+def link_query(files, query_dir):
+    """A directory holding links to just these files"""
+
+    if os.path.isdir(query_dir):
+        shutil.rmtree(query_dir)
+    os.makedirs(query_dir)
+
+    for file in files:
+        os.symlink(os.path.abspath(file),
+                   os.path.join(query_dir, os.path.basename(file)))
+
+    return query_dir
+
+
+# --------------------------------------------------
+def run_fizkin(query_dir, out_dir, num_threads, fizkin_args):
+    """
+    Run fizkin.py from scratch with tracing, return the wall time less
+    the figures stage
+    """
+
+    if os.path.isdir(out_dir):
+        shutil.rmtree(out_dir)
+    os.makedirs(out_dir)
+
+    fizkin = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          'fizkin.py')
+    cmd = [
+        sys.executable, fizkin, '-q', query_dir, '-o', out_dir, '-T', '-t',
+        str(num_threads)
+    ] + FIGURE_ARGS + shlex.split(fizkin_args)
+
+    start = time.time()
+    with open(os.path.join(out_dir, 'fizkin.log'), 'wt') as log:
+        proc = subprocess.run(cmd, stdout=log, stderr=log)
+    seconds = time.time() - start
+
+    if proc.returncode != 0:
+        die('fizkin.py failed ({}), see "{}"'.format(
+            proc.returncode, os.path.join(out_dir, 'fizkin.log')))
+
+    with open(os.path.join(out_dir, 'trace.jsonl')) as fh:
+        for line in fh:
+            event = json.loads(line)
+            if event['kind'] == 'stage' and event['name'] == 'make_figures':
+                seconds -= event['wall']
+
+    return seconds
+
+
+# --------------------------------------------------
+def prefilter_error(exact_dir, prefilter_dir, threshold):
+    """
+    The sketch error against the exact run's "matrix_raw" and the pairs
+    the prefilter skipped that the exact run found reads kept for
+    """
+
+    import sketch
+
+    names, sim = sketch.read_matrix(
+        os.path.join(prefilter_dir, 'figures', 'matrix_sketch.txt'))
+    exact_names, exact = sketch.read_matrix(
+        os.path.join(exact_dir, 'figures', 'matrix_raw.txt'))
+
+    pos = {name: i for i, name in enumerate(exact_names)}
+    wrong = sorted(
+        [idx, qry] for idx, qry in sketch.skip_pairs(names, sim, threshold)
+        if idx in pos and qry in pos and exact[pos[idx], pos[qry]] > 0)
+
+    # Kept reads as a fraction of the sample's own, like the sketch
+    frac = exact / np.maximum(exact.diagonal(), 1)[:, None]
+
+    return sketch.error_report(names, sim, exact_names, frac,
+                               threshold), wrong
+
+
+# --------------------------------------------------
+def stage_results(trace_file, num_reads, num_bytes):
+    """
+    {stage: metrics} from a trace: wall/CPU seconds, reads and MiB per
+    second and peak RSS. Subsetting, counting and comparing may run as
+    one job graph, so a stage not traced on its own is the span of its
+    jobs (these may overlap).
+    """
+
+    events = []
+    with open(trace_file) as fh:
+        for line in fh:
+            events.append(json.loads(line))
+
+    jobs = [e for e in events if e['kind'] == 'job']
+    spans = {}
+    windows = []
+    for event in events:
+        if event['kind'] == 'stage' and event['name'] in STAGES:
+            stop = event['start'] + event['wall']
+            windows.append((event['start'], stop))
+            job_rss = [
+                job['max_rss'] for job in jobs
+                if event['start'] <= job['start'] <= stop
+            ]
+            spans[event['name']] = {
+                'wall': event['wall'],
+                'cpu': event['cpu'],
+                'max_rss': max(job_rss + [event['max_rss']])
+            }
+
+    # Jobs and tasks inside a stage traced on its own belong to it
+    by_stage = {}
+    for job in jobs:
+        stage = JOB_STAGES.get(job['name'].split(':')[0])
+        if stage and stage not in spans and \
+           not any(lo <= job['start'] <= hi for lo, hi in windows):
+            by_stage.setdefault(stage, []).append(job)
+
+    for stage, stage_jobs in by_stage.items():
+        start = min(job['start'] for job in stage_jobs)
+        spans[stage] = {
+            'wall': max(job['start'] + job['wall']
+                        for job in stage_jobs) - start,
+            'cpu': sum(job['cpu'] for job in stage_jobs),
+            'max_rss': max(job['max_rss'] for job in stage_jobs)
+        }
+
+    for span in spans.values():
+        wall = max(span['wall'], 1e-6)
+        span['reads_per_sec'] = num_reads / wall
+        span['mib_per_sec'] = num_bytes / 2.**20 / wall
+
+    return spans
+
+
+# --------------------------------------------------
+def scaling(results):
+    """
+    Per stage, the exponent "b" of wall ~ N^b between consecutive sizes
+    (about 1 for per-sample stages and 2 for the pairwise ones)
+    """
+
+    sizes = sorted(results, key=int)
+    exponents = {}
+    for small, big in zip(sizes, sizes[1:]):
+        for stage in results[big]['stages']:
+            before = results[small]['stages'].get(stage)
+            after = results[big]['stages'][stage]
+            if not before or before['wall'] <= 0 or after['wall'] <= 0:
+                continue
+            exponents.setdefault(stage, {})[big] = math.log(
+                after['wall'] / before['wall']) / math.log(
+                    int(big) / int(small))
+
+    return exponents
+
+
+# --------------------------------------------------
+def regressions(report, baseline, tolerance, min_seconds):
+    """
+    Messages for every (size, stage) slower or bigger than the baseline
+    by more than "tolerance" (wall time only past "min_seconds")
+    """
+
+    found = []
+    for size, result in sorted(report['results'].items(), key=lambda r:
+                               int(r[0])):
+        base = baseline.get('results', {}).get(size)
+        if not base:
+            continue
+
+        for stage, now in result['stages'].items():
+            then = base['stages'].get(stage)
+            if not then:
+                continue
+
+            if now['wall'] > then['wall'] * (1 + tolerance) and \
+               now['wall'] - then['wall'] > min_seconds:
+                found.append('N={} {}: wall {:.1f}s, baseline {:.1f}s'.format(
+                    size, stage, now['wall'], then['wall']))
+
+            if now['max_rss'] > then['max_rss'] * (1 + tolerance):
+                found.append(
+                    'N={} {}: RSS {:.0f} MiB, baseline {:.0f} MiB'.format(
+                        size, stage, now['max_rss'] / 2.**20,
+                        then['max_rss'] / 2.**20))
+
+    return found
+
+
+# --------------------------------------------------
+def format_report(report, baseline=None):
+    """The scaling report as a table"""
+
+    exponents = scaling(report['results'])
+    row = '{:>6} {:<22} {:>9} {:>9} {:>8} {:>10} {:>8} {:>6} {:>8}'
+    lines = [
+        row.format('N', 'stage', 'wall_s', 'cpu_s', 'rss_MiB', 'reads/s',
+                   'MiB/s', 'scale', 'vs_base')
+    ]
+
+    for size, result in sorted(report['results'].items(), key=lambda r:
+                               int(r[0])):
+        base = (baseline or {}).get('results', {}).get(size, {})
+        for stage in STAGES:
+            now = result['stages'].get(stage)
+            if not now:
+                continue
+
+            exponent = exponents.get(stage, {}).get(size)
+            then = base.get('stages', {}).get(stage)
+            lines.append(
+                row.format(size, stage, '{:.2f}'.format(now['wall']),
+                           '{:.2f}'.format(now['cpu']),
+                           '{:.0f}'.format(now['max_rss'] / 2.**20),
+                           '{:.0f}'.format(now['reads_per_sec']),
+                           '{:.1f}'.format(now['mib_per_sec']),
+                           '' if exponent is None else
+                           '{:.2f}'.format(exponent),
+                           '{:.2f}x'.format(now['wall'] / then['wall'])
+                           if then and then['wall'] > 0 else ''))
+
+        lines.append(
+            row.format(size, 'total', '{:.2f}'.format(result['wall']), '',
+                       '', '', '', '', ''))
+
+    return '\n'.join(lines)
+
+
+# --------------------------------------------------
+def parse_file(work_dir, size, params, batch_reads=100000):
+    """Write (or reuse) a synthetic FASTA of about "size" bytes"""
+
+    import kmers
+
+    num_bytes = kmers.parse_size(size)
+    path = os.path.join(work_dir, 'parse-{}-{}.fa'.format(num_bytes,
+                                                          params['seed']))
+    if os.path.isfile(path):
+        return path
+
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    rand = np.random.RandomState(params['seed'])
+    genome = random_genome(rand, params['genome_size'])
+    written = 0
+    num = 0
+    with open(path + '.tmp', 'wb') as out_fh:
+        while written < num_bytes:
+            reads = sample_reads(rand, genome, batch_reads, params['read_len'])
+            lines = []
+            for read in reads:
+                lines.append('>read_{}\n'.format(num).encode())
+                lines.append(read.tobytes() + b'\n')
+                num += 1
+            data = b''.join(lines)
+            out_fh.write(data)
+            written += len(data)
+    os.rename(path + '.tmp', path)
+
+    return path
+
+
+# --------------------------------------------------
+def parse_benchmark(path, batch_size=4000000):
+    """
+    (parser, seconds, records) of reading every record of a file with
+    each "fastx" reader, and with Bio.SeqIO when it is installed
+    """
+
+    import fastx
+
+    fmt = fastx.guess_format(path)
+
+    def bounds():
+        data = fastx.map_file(path)
+        try:
+            return len(fastx.record_bounds(data, fmt)[0])
+        finally:
+            data.close()
+
+    parsers = [
+        ('fastx.count_records', lambda: fastx.count_records(path)),
+        ('fastx.record_bounds', bounds),
+        ('fastx.mapped_records',
+         lambda: sum(1 for _ in fastx.mapped_records(path, fmt))),
+        ('fastx.read_records',
+         lambda: sum(1 for _ in fastx.read_records(path, fmt))),
+        ('fastx.seq_arrays', lambda: sum(
+            len(starts) for _, starts in fastx.seq_arrays(path, batch_size))),
+    ]
+
+    try:
+        from Bio import SeqIO
+        parsers.append(('Bio.SeqIO.parse', lambda: sum(
+            1 for _ in SeqIO.parse(path, fmt))))
+    except ImportError:
+        warn('Bio.SeqIO is not installed, not comparing with it')
+
+    if not fastx.mappable(path):
+        parsers = [parser for parser in parsers
+                   if parser[0] not in ('fastx.record_bounds',
+                                        'fastx.mapped_records')]
+
+    rows = []
+    for name, func in parsers:
+        start = time.time()
+        num = func()
+        rows.append((name, time.time() - start, num))
+
+    return rows
+
+
+# --------------------------------------------------
+def format_parse(path, rows):
+    """A table of parser timings"""
+
+    mib = os.path.getsize(path) / 2.**20
+    row = '{:<22} {:>12} {:>9} {:>9} {:>12}'
+    lines = [
+        path, row.format('parser', 'records', 'wall_s', 'MiB/s', 'records/s')
+    ]
+    for name, seconds, num in rows:
+        seconds = max(seconds, 1e-9)
+        lines.append(row.format(name, num, '{:.2f}'.format(seconds),
+                                '{:.0f}'.format(mib / seconds),
+                                '{:.0f}'.format(num / seconds)))
+
+    return '\n'.join(lines)
+
+
+# --------------------------------------------------
+def main():
+    """Start here"""
+
+    args = get_args()
+    work_dir = os.path.abspath(args.work_dir)
+    params = {
+        'num_reads': args.num_reads,
+        'read_len': args.read_len,
+        'genome_size': args.genome_size,
+        'num_shared': args.num_shared,
+        'shared_fraction': args.shared_fraction,
+        'seed': args.seed,
+        'num_threads': args.num_threads,
+        'fizkin_args': args.fizkin_args
+    }
+
+    if args.parse or args.parse_size:
+        files = list(args.parse)
+        if args.parse_size:
+            files.append(parse_file(work_dir, args.parse_size, params))
+        for path in files:
+            if not os.path.isfile(path):
+                die('--parse "{}" is not a file'.format(path))
+            print(format_parse(path, parse_benchmark(path)))
+        return
+
+    baseline = None
+    if args.baseline:
+        if not os.path.isfile(args.baseline):
+            die('--baseline "{}" is not a file'.format(args.baseline))
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if baseline.get('params') != params:
+            warn('Baseline was run with {}'.format(baseline.get('params')))
+
+    report = {'params': params, 'results': {}}
+    # Communities made with other settings live in other directories
+    reads_dir = os.path.join(
+        work_dir, 'reads-{num_reads}-{read_len}-{genome_size}-{num_shared}-'
+        '{shared_fraction}-{seed}'.format(**params))
+    for num_samples in sorted(set(args.num_samples)):
+        warn('Making community of {}'.format(num_samples))
+        files = make_community(reads_dir, num_samples, params)
+        query_dir = link_query(
+            files, os.path.join(work_dir, 'query-{}'.format(num_samples)))
+
+        warn('Running fizkin.py on {}'.format(num_samples))
+        out_dir = os.path.join(work_dir, 'run-{}'.format(num_samples))
+        seconds = run_fizkin(query_dir, out_dir, args.num_threads,
+                             args.fizkin_args)
+
+        report['results'][str(num_samples)] = {
+            'wall': seconds,
+            'stages': stage_results(
+                os.path.join(out_dir, 'trace.jsonl'),
+                num_samples * args.num_reads,
+                sum(map(os.path.getsize, files)))
+        }
+
+        if args.prefilter > 0:
+            warn('Running fizkin.py on {} with --prefilter {}'.format(
+                num_samples, args.prefilter))
+            prefilter_dir = out_dir + '-prefilter'
+            seconds = run_fizkin(
+                query_dir, prefilter_dir, args.num_threads,
+                '{} --prefilter {}'.format(args.fizkin_args, args.prefilter))
+            error, wrong = prefilter_error(out_dir, prefilter_dir,
+                                           args.prefilter)
+            report['results'][str(num_samples)]['prefilter'] = {
+                'threshold': args.prefilter,
+                'wall': seconds,
+                'error': error,
+                'wrongly_skipped': wrong
+            }
+
+    report_file = os.path.join(work_dir, 'report.json')
+    for path in [report_file, args.save_baseline]:
+        if path:
+            with open(path, 'wt') as out_fh:
+                json.dump(report, out_fh, indent=2)
+
+    print(format_report(report, baseline))
+    for size, result in sorted(report['results'].items(), key=lambda r:
+                               int(r[0])):
+        prefilter = result.get('prefilter')
+        if prefilter:
+            print('N={} --prefilter {}: {:.2f}s (exact {:.2f}s); {}'.format(
+                size, prefilter['threshold'], prefilter['wall'],
+                result['wall'], prefilter['error']))
+            for idx, qry in prefilter['wrongly_skipped']:
+                print('  wrongly skipped {} x {}'.format(idx, qry))
+    print('See report "{}"'.format(report_file))
+
+    if baseline:
+        found = regressions(report, baseline, args.tolerance,
+                            args.min_seconds)
+        if found:
+            die('{} regression{} over the baseline:\n{}'.format(
+                len(found), '' if len(found) == 1 else 's', '\n'.join(found)))
+        print('No regressions over the baseline')
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
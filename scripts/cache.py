@@ -0,0 +1,185 @@
+"""Content-addressed cache for subsets and kmer indexes"""
+
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+from kmers import parse_size
+
+SCHEMA = """
+    create table if not exists digest (
+        path text primary key,
+        size integer not null,
+        mtime real not null,
+        sha text not null
+    );
+
+    create table if not exists entry (
+        key text primary key,
+        size integer not null,
+        last_used real not null
+    );
+"""
+
+
+# --------------------------------------------------
+def params_key(params):
+    """Stable string for a dict of stage parameters"""
+
+    return json.dumps(params, sort_keys=True)
+
+
+# --------------------------------------------------
+def is_stale(stamp_file, params):
+    """
+    Compare "params" to those recorded in "stamp_file" (then record
+    them); True when outputs were made with different parameters
+    """
+
+    new = params_key(params)
+    old = None
+    if os.path.isfile(stamp_file):
+        with open(stamp_file) as fh:
+            old = fh.read()
+
+    if old != new:
+        with open(stamp_file, 'wt') as fh:
+            fh.write(new)
+
+    return old is not None and old != new
+
+
+# --------------------------------------------------
+class Cache:
+    """Files keyed on input content + stage parameters, LRU-evicted"""
+
+    def __init__(self, cache_dir, max_size='50G'):
+        self.cache_dir = cache_dir
+        self.max_size = parse_size(max_size)
+        self.hits = 0
+        self.misses = 0
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # Outputs are put from the scheduler's callback thread
+        self.db = sqlite3.connect(
+            os.path.join(cache_dir, 'cache.db'), timeout=60,
+            check_same_thread=False)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.executescript(SCHEMA)
+
+    def digest(self, path):
+        """SHA-256 of a file, remembered until its size/mtime change"""
+
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        row = self.db.execute(
+            'select sha from digest where path = ? and size = ? and '
+            'mtime = ?', (path, stat.st_size, stat.st_mtime)).fetchone()
+        if row:
+            return row[0]
+
+        sha = hashlib.sha256()
+        with open(path, 'rb') as fh:
+            for chunk in iter(lambda: fh.read(2**22), b''):
+                sha.update(chunk)
+
+        with self.db:
+            self.db.execute(
+                'insert or replace into digest values (?, ?, ?, ?)',
+                (path, stat.st_size, stat.st_mtime, sha.hexdigest()))
+
+        return sha.hexdigest()
+
+    def key(self, stage, input_file, params):
+        """Cache key for a stage run on "input_file" with "params" """
+
+        ident = '\t'.join([stage, self.digest(input_file), params_key(params)])
+        return hashlib.sha256(ident.encode()).hexdigest()
+
+    def path(self, key):
+        """Where the object for a key lives"""
+
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key, dest):
+        """Link/copy a cached object to "dest", return True on a hit"""
+
+        src = self.path(key)
+        found = self.db.execute('select 1 from entry where key = ?',
+                                (key, )).fetchone()
+        if not found or not os.path.isfile(src):
+            self.misses += 1
+            return False
+
+        tmp_dest = dest + '.tmp{}'.format(os.getpid())
+        link_or_copy(src, tmp_dest)
+        os.rename(tmp_dest, dest)
+        with self.db:
+            self.db.execute('update entry set last_used = ? where key = ?',
+                            (time.time(), key))
+        self.hits += 1
+
+        return True
+
+    def put(self, key, src):
+        """Add a finished output to the cache, evicting as needed"""
+
+        if not os.path.isfile(src):
+            return False
+
+        dest = self.path(key)
+        if not os.path.isdir(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+
+        tmp_dest = dest + '.tmp{}'.format(os.getpid())
+        link_or_copy(src, tmp_dest)
+        os.rename(tmp_dest, dest)
+
+        with self.db:
+            self.db.execute('insert or replace into entry values (?, ?, ?)',
+                            (key, os.path.getsize(dest), time.time()))
+        self.evict()
+
+        return True
+
+    def evict(self):
+        """Remove least-recently used objects until under budget"""
+
+        total = self.db.execute(
+            'select coalesce(sum(size), 0) from entry').fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        for key, size in self.db.execute(
+                'select key, size from entry order by last_used').fetchall():
+            if total <= self.max_size:
+                break
+            if os.path.isfile(self.path(key)):
+                os.remove(self.path(key))
+            with self.db:
+                self.db.execute('delete from entry where key = ?', (key, ))
+            total -= size
+
+    def report(self):
+        """Summary of cache use"""
+
+        return 'Cache "{}": {} hit{}, {} miss{}'.format(
+            self.cache_dir, self.hits, '' if self.hits == 1 else 's',
+            self.misses, '' if self.misses == 1 else 'es')
+
+
+# --------------------------------------------------
+def link_or_copy(src, dest):
+    """Hard link if possible (same filesystem), copy otherwise"""
+
+    if os.path.isfile(dest):
+        os.remove(dest)
+
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
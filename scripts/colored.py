@@ -0,0 +1,326 @@
+"""
+One colored kmer index merged from all the NumPy indexes: every kmer
+maps to the samples holding it, so one scan of a query gives its whole
+row of the matrix
+"""
+
+import json
+import math
+import os
+import numpy as np
+import fastx
+import kmers
+
+MAX_COUNT = np.iinfo(np.uint32).max
+
+# Bytes held per (kmer, sample) entry while merging a range of codes
+MERGE_BYTES = 32
+
+# Set in each worker by "init_worker" so the index is opened once
+COLORED = None
+
+
+# --------------------------------------------------
+def index_files(prefix):
+    """The (codes, offsets, samples, counts, meta) files of an index"""
+
+    return (prefix + '.codes', prefix + '.offsets', prefix + '.samples',
+            prefix + '.counts', prefix + '.json')
+
+
+# --------------------------------------------------
+def sample_dtype(num_samples):
+    """Smallest unsigned int that numbers the samples"""
+
+    return np.uint16 if num_samples <= np.iinfo(np.uint16).max else \
+        np.uint32
+
+
+# --------------------------------------------------
+def code_cuts(indexes, num_ranges):
+    """
+    Codes that split all the indexes into "num_ranges" ranges holding
+    about the same number of entries, from a sample of each index
+    """
+
+    if num_ranges < 2:
+        return np.zeros(0, dtype=np.uint64)
+
+    sampled = np.sort(
+        np.concatenate([
+            codes[::max(1, len(codes) // (100 * num_ranges))]
+            for codes, _ in indexes
+        ] + [np.zeros(0, dtype=np.uint64)]))
+
+    if len(sampled) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    picks = np.linspace(0, len(sampled), num_ranges + 1)[1:-1].astype(int)
+    return np.unique(sampled[picks])
+
+
+# --------------------------------------------------
+def build(index_paths, prefix, mem_budget=2**30):
+    """
+    Merge the indexes into sorted unique codes with CSR "offsets" into
+    the sample numbers (colors) and counts of each code. The codes are
+    merged one range at a time so memory stays within "mem_budget";
+    reuse the index if none of the inputs changed.
+    """
+
+    codes_file, offsets_file, samples_file, counts_file, meta_file = \
+        index_files(prefix)
+    index_paths = sorted(index_paths)
+    sources = [[kmers.index_name(file), os.path.getsize(file),
+                os.path.getmtime(file)] for file in index_paths]
+
+    if os.path.isfile(meta_file):
+        with open(meta_file) as fh:
+            if json.load(fh)['sources'] == sources:
+                return prefix
+
+    indexes = [kmers.load_index(file) for file in index_paths]
+    num_entries = sum(len(codes) for codes, _ in indexes)
+    num_ranges = max(1, int(math.ceil(num_entries * MERGE_BYTES /
+                                      max(1, mem_budget))))
+    cuts = code_cuts(indexes, num_ranges)
+    bounds = [
+        np.concatenate(([0], np.searchsorted(codes, cuts), [len(codes)]))
+        for codes, _ in indexes
+    ]
+    dtype = sample_dtype(len(indexes))
+
+    num_codes = 0
+    out_fhs = [open(file + '.tmp', 'wb')
+               for file in index_files(prefix)[:4]]
+    codes_fh, offsets_fh, samples_fh, counts_fh = out_fhs
+    try:
+        np.zeros(1, dtype=np.uint64).tofile(offsets_fh)
+        num_written = 0
+        for num in range(len(cuts) + 1):
+            parts = [(codes[bound[num]:bound[num + 1]],
+                      counts[bound[num]:bound[num + 1]], sample)
+                     for sample, ((codes, counts), bound) in enumerate(
+                         zip(indexes, bounds))]
+            codes = np.concatenate([part[0] for part in parts])
+            if len(codes) == 0:
+                continue
+
+            # Stable, so the samples of a code stay in order
+            order = np.argsort(codes, kind='mergesort')
+            codes = codes[order]
+            samples = np.concatenate([
+                np.full(len(part[0]), part[2], dtype=dtype) for part in parts
+            ])[order]
+            counts = np.minimum(
+                np.concatenate([part[1] for part in parts]),
+                MAX_COUNT).astype(np.uint32)[order]
+
+            starts = np.flatnonzero(
+                np.concatenate(([True], codes[1:] != codes[:-1])))
+            ends = np.concatenate((starts[1:], [len(codes)]))
+
+            codes[starts].tofile(codes_fh)
+            (ends + num_written).astype(np.uint64).tofile(offsets_fh)
+            samples.tofile(samples_fh)
+            counts.tofile(counts_fh)
+            num_codes += len(starts)
+            num_written += len(codes)
+    finally:
+        for out_fh in out_fhs:
+            out_fh.close()
+
+    for file in index_files(prefix)[:4]:
+        os.rename(file + '.tmp', file)
+
+    with open(meta_file + '.tmp', 'wt') as out_fh:
+        json.dump({
+            'names': [name for name, _, _ in sources],
+            'num_codes': num_codes,
+            'num_entries': num_entries,
+            'sample_dtype': np.dtype(dtype).name,
+            'sources': sources
+        }, out_fh)
+    os.rename(meta_file + '.tmp', meta_file)
+
+    return prefix
+
+
+# --------------------------------------------------
+def open_index(prefix):
+    """Map an index read-only as a dict of its arrays and sample names"""
+
+    codes_file, offsets_file, samples_file, counts_file, meta_file = \
+        index_files(prefix)
+    with open(meta_file) as fh:
+        meta = json.load(fh)
+
+    def mapped(path, dtype, num):
+        if num == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r', shape=(num, ))
+
+    return {
+        'names': meta['names'],
+        'codes': mapped(codes_file, np.uint64, meta['num_codes']),
+        'offsets': mapped(offsets_file, np.uint64, meta['num_codes'] + 1),
+        'samples': mapped(samples_file, meta['sample_dtype'],
+                          meta['num_entries']),
+        'counts': mapped(counts_file, np.uint32, meta['num_entries'])
+    }
+
+
+# --------------------------------------------------
+def index_bytes(prefix):
+    """Total size of an index on disk"""
+
+    return sum(os.path.getsize(file) for file in index_files(prefix))
+
+
+# --------------------------------------------------
+def keep_counts(index, codes, read_ids, num_reads, min_mode,
+                pct_kmer_coverage, max_entries=2**24):
+    """
+    Reads kept by each sample, the "compare.keep_reads" test for every
+    sample at once: the kmers found are expanded into their (read,
+    sample, count) entries, a few reads at a time so no more than about
+    "max_entries" are held
+    """
+
+    num_samples = len(index['names'])
+    kept = np.zeros(num_samples, dtype=np.int64)
+    index_codes = index['codes']
+    if len(codes) == 0 or len(index_codes) == 0:
+        return kept
+
+    num_kmers = np.bincount(read_ids, minlength=num_reads)
+    pos = np.searchsorted(index_codes, codes)
+    pos[pos == len(index_codes)] = 0
+    found = index_codes[pos] == codes
+    pos = pos[found]
+    found_read = read_ids[found]
+
+    offsets = index['offsets']
+    starts = offsets[pos].astype(np.int64)
+    lens = offsets[pos + 1].astype(np.int64) - starts
+
+    # Groups of whole reads; reads come in order from "array_codes"
+    read_entries = np.cumsum(
+        np.bincount(found_read, weights=lens, minlength=num_reads))
+    group = (read_entries // max_entries).astype(np.int64)[found_read]
+    cuts = np.concatenate(
+        ([0], np.flatnonzero(group[1:] != group[:-1]) + 1, [len(group)]))
+
+    for lo, hi in zip(cuts[:-1], cuts[1:]):
+        kept += group_kept(index, found_read[lo:hi], starts[lo:hi],
+                           lens[lo:hi], num_kmers, min_mode,
+                           pct_kmer_coverage)
+
+    # Without kmers in common a read passes only if nothing is required
+    if min_mode <= 0 and pct_kmer_coverage <= 0:
+        hit = np.zeros(num_samples, dtype=np.int64)
+        if len(pos):
+            pairs = np.unique(
+                np.repeat(found_read.astype(np.int64), lens) * num_samples +
+                index['samples'][np.repeat(starts, lens) +
+                                 entry_steps(lens)])
+            hit = np.bincount(pairs % num_samples, minlength=num_samples)
+        kept += np.count_nonzero(num_kmers) - hit
+
+    return kept
+
+
+# --------------------------------------------------
+def entry_steps(lens):
+    """0, 1, ... within each run of "lens" entries, all runs concatenated"""
+
+    total = int(lens.sum())
+    run_starts = np.cumsum(lens) - lens
+    return np.arange(total, dtype=np.int64) - np.repeat(run_starts, lens)
+
+
+# --------------------------------------------------
+def group_kept(index, found_read, starts, lens, num_kmers, min_mode,
+               pct_kmer_coverage):
+    """Reads kept by each sample among one group of found kmers"""
+
+    num_samples = len(index['names'])
+    if len(lens) == 0:
+        return np.zeros(num_samples, dtype=np.int64)
+
+    entries = np.repeat(starts, lens) + entry_steps(lens)
+    pair = np.repeat(found_read.astype(np.int64), lens) * num_samples + \
+        index['samples'][entries]
+    count = index['counts'][entries]
+
+    # Runs of equal (read, sample, count) give each count's frequency
+    order = np.lexsort((count, pair))
+    pair = pair[order]
+    count = count[order]
+    run_starts = np.flatnonzero(
+        np.concatenate(([True], (pair[1:] != pair[:-1]) |
+                        (count[1:] != count[:-1]))))
+    run_len = np.diff(np.concatenate((run_starts, [len(pair)])))
+    run_pair = pair[run_starts]
+    run_val = count[run_starts]
+
+    # Per (read, sample): kmers found and the most frequent count,
+    # lowest on ties
+    pair_starts = np.flatnonzero(
+        np.concatenate(([True], run_pair[1:] != run_pair[:-1])))
+    num_found = np.add.reduceat(run_len, pair_starts)
+    best = np.lexsort((run_val, -run_len, run_pair))
+    first = np.concatenate(([True], run_pair[best][1:] !=
+                            run_pair[best][:-1]))
+    best_len = run_len[best][first]
+    best_val = run_val[best][first]
+    pairs = run_pair[pair_starts]
+
+    # The kmers not found all count 0, which wins ties
+    read = pairs // num_samples
+    total = num_kmers[read]
+    mode = np.where(total - num_found >= best_len, 0, best_val)
+    keep = (mode >= min_mode) & \
+        (100 * num_found / total >= pct_kmer_coverage)
+
+    return np.bincount(
+        pairs[keep] % num_samples, minlength=num_samples).astype(np.int64)
+
+
+# --------------------------------------------------
+def count_row(query_file, index, kmer_size, min_mode=1,
+              pct_kmer_coverage=10, batch_size=4000000):
+    """
+    Scan a query once against all the samples, return ({sample: kept},
+    num_reads), the same counts "compare.count_kept" gives per index
+    """
+
+    kept = np.zeros(len(index['names']), dtype=np.int64)
+    num_reads = 0
+
+    for buf, starts in fastx.seq_arrays(query_file, batch_size):
+        codes, read_ids = kmers.array_codes(
+            buf, starts, kmer_size, with_read_ids=True)
+        kept += keep_counts(index, codes, read_ids, len(starts), min_mode,
+                            pct_kmer_coverage)
+        num_reads += len(starts)
+
+    return dict(zip(index['names'], kept.tolist())), num_reads
+
+
+# --------------------------------------------------
+def init_worker(prefix):
+    """Pool initializer: map the index once per worker process"""
+
+    global COLORED
+    COLORED = open_index(prefix)
+
+
+# --------------------------------------------------
+def count_query(qry_file, kmer_size, min_mode, pct_kmer_coverage):
+    """One query's row against the index mapped by "init_worker" """
+
+    kept, _ = count_row(qry_file, COLORED, kmer_size, min_mode,
+                        pct_kmer_coverage)
+
+    return qry_file, kept
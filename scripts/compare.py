@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""Compare reads to NumPy kmer indexes, counting the reads kept"""
+
+import argparse
+import os
+import sys
+import numpy as np
+import fastx
+import kmers
+
+
+# --------------------------------------------------
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description='Count reads kept by NumPy kmer indexes',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('file', help='FASTA/Q query file', metavar='FILE')
+
+    parser.add_argument(
+        '-i',
+        '--index',
+        help='NumPy kmer index file(s)',
+        metavar='FILE',
+        nargs='+',
+        required=True)
+
+    parser.add_argument(
+        '-k',
+        '--kmer_size',
+        help='Kmer size used to build the indexes',
+        metavar='int',
+        type=int,
+        default=20)
+
+    parser.add_argument(
+        '-m',
+        '--min_mode',
+        help='Min. mode of the kmer counts to keep a read',
+        metavar='int',
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        '-p',
+        '--pct_kmer_coverage',
+        help='Min. percent of read kmers found in the index',
+        metavar='int',
+        type=int,
+        default=10)
+
+    return parser.parse_args()
+
+
+# --------------------------------------------------
+def lookup(index, codes):
+    """Count of each code in a (codes, counts) index, 0 if absent"""
+
+    index_codes, index_counts = index
+    if len(index_codes) == 0 or len(codes) == 0:
+        return np.zeros(len(codes), dtype=np.uint64)
+
+    pos = np.searchsorted(index_codes, codes)
+    pos[pos == len(index_codes)] = 0
+    found = index_codes[pos] == codes
+
+    return np.where(found, index_counts[pos], 0).astype(np.uint64)
+
+
+# --------------------------------------------------
+def keep_reads(counts, read_ids, num_reads, min_mode, pct_kmer_coverage):
+    """
+    Decide which reads to keep like "query_per_sequence": the mode of
+    the read's kmer counts (ties go to the lower count) must be at
+    least "min_mode" and at least "pct_kmer_coverage" percent of its
+    kmers must be present in the index
+    """
+
+    keep = np.zeros(num_reads, dtype=bool)
+    if len(counts) == 0:
+        return keep
+
+    num_kmers = np.bincount(read_ids, minlength=num_reads)
+    num_found = np.bincount(read_ids, weights=counts > 0, minlength=num_reads)
+
+    # Runs of equal (read, count) give each value's frequency in a read
+    order = np.lexsort((counts, read_ids))
+    rid = read_ids[order]
+    val = counts[order]
+    starts = np.concatenate(
+        ([0], np.flatnonzero((rid[1:] != rid[:-1]) | (val[1:] != val[:-1])) +
+         1))
+    run_len = np.diff(np.concatenate((starts, [len(rid)])))
+    run_read = rid[starts]
+    run_val = val[starts]
+
+    # Most frequent value per read, lowest value on ties
+    best = np.lexsort((run_val, -run_len, run_read))
+    first = np.concatenate(
+        ([True], run_read[best][1:] != run_read[best][:-1]))
+    mode = np.zeros(num_reads, dtype=np.uint64)
+    mode[run_read[best][first]] = run_val[best][first]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = np.where(num_kmers > 0, 100 * num_found / num_kmers, 0)
+
+    return (num_kmers > 0) & (mode >= min_mode) & (pct >= pct_kmer_coverage)
+
+
+# --------------------------------------------------
+def count_kept(query_file,
+               index_files,
+               kmer_size,
+               min_mode=1,
+               pct_kmer_coverage=10,
+               batch_size=4000000):
+    """
+    Encode the reads in a query file once, batch by batch, and count
+    how many each index keeps; returns ({index_name: kept}, num_reads)
+    """
+
+    indexes = [(kmers.index_name(file), kmers.load_index(file))
+               for file in index_files]
+
+    return count_kept_indexes(query_file, indexes, kmer_size, min_mode,
+                              pct_kmer_coverage, batch_size)
+
+
+# --------------------------------------------------
+def count_kept_indexes(query_file,
+                       indexes,
+                       kmer_size,
+                       min_mode=1,
+                       pct_kmer_coverage=10,
+                       batch_size=4000000):
+    """Like "count_kept" for (name, (codes, counts)) already loaded"""
+
+    kept = {name: 0 for name, _ in indexes}
+    num_reads = 0
+
+    for buf, starts in fastx.seq_arrays(query_file, batch_size):
+        codes, read_ids = kmers.array_codes(
+            buf, starts, kmer_size, with_read_ids=True)
+        num_reads += len(starts)
+
+        for name, index in indexes:
+            keep = keep_reads(
+                lookup(index, codes), read_ids, len(starts), min_mode,
+                pct_kmer_coverage)
+            kept[name] += int(keep.sum())
+
+    return kept, num_reads
+
+
+# --------------------------------------------------
+def main():
+    """Start here"""
+
+    args = get_args()
+
+    if not os.path.isfile(args.file):
+        print('"{}" is not a file'.format(args.file), file=sys.stderr)
+        sys.exit(1)
+
+    kept, num_reads = count_kept(args.file, args.index, args.kmer_size,
+                                 args.min_mode, args.pct_kmer_coverage)
+
+    for name in sorted(kept):
+        print('{}\t{}\t{}'.format(name, kept[name], num_reads))
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
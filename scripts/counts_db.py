@@ -0,0 +1,94 @@
+"""SQLite store for the kept ("mode") and input read counts"""
+
+import sqlite3
+
+DB_NAME = 'counts.db'
+
+SCHEMA = """
+    create table if not exists mode (
+        index_name text not null,
+        query_name text not null,
+        num integer not null,
+        primary key (index_name, query_name)
+    ) without rowid;
+
+    create table if not exists input_count (
+        name text primary key,
+        num integer not null
+    ) without rowid;
+"""
+
+
+# --------------------------------------------------
+def connect(path):
+    """Open (creating if needed) the counts database in WAL mode"""
+
+    db = sqlite3.connect(path, timeout=60)
+    db.execute('pragma journal_mode=wal')
+    db.execute('pragma synchronous=normal')
+    db.executescript(SCHEMA)
+
+    return db
+
+
+# --------------------------------------------------
+def put_modes(db, rows):
+    """Upsert (index_name, query_name, num) rows in one transaction"""
+
+    with db:
+        db.executemany('insert or replace into mode values (?, ?, ?)', rows)
+
+
+# --------------------------------------------------
+def drop_modes(db, pairs):
+    """Forget the counts of (index_name, query_name) pairs being redone"""
+
+    with db:
+        db.executemany(
+            'delete from mode where index_name = ? and query_name = ?', pairs)
+
+
+# --------------------------------------------------
+def put_input_counts(db, rows):
+    """Upsert (name, num) rows in one transaction"""
+
+    with db:
+        db.executemany('insert or replace into input_count values (?, ?)',
+                       rows)
+
+
+# --------------------------------------------------
+def get_modes(db):
+    """Read all the mode counts as {index_name: {query_name: num}}"""
+
+    counts = {}
+    for index_name, query_name, num in db.execute(
+            'select index_name, query_name, num from mode'):
+        counts.setdefault(index_name, {})[query_name] = num
+
+    return counts
+
+
+# --------------------------------------------------
+def get_input_counts(db):
+    """Read all the input counts as {name: num}"""
+
+    return dict(db.execute('select name, num from input_count'))
+
+
+# --------------------------------------------------
+def done_pairs(db):
+    """The set of (index_name, query_name) already counted"""
+
+    return set(db.execute('select index_name, query_name from mode'))
+
+
+# --------------------------------------------------
+def clear(db, table):
+    """Remove every row from "mode" or "input_count" """
+
+    if table not in ('mode', 'input_count'):
+        raise ValueError('Unknown table "{}"'.format(table))
+
+    with db:
+        db.execute('delete from {}'.format(table))
@@ -4,10 +4,13 @@
 # Author: Ken Youens-Clark <kyclark@email.arizona.edu>
 
 import argparse
-from random import random
+import math
 import os
+import random
+import subprocess
 import sys
-from Bio import SeqIO
+import time
+from multiprocessing import Pool
 
 # --------------------------------------------------
 def get_args():
@@ -16,7 +19,16 @@ def get_args():
         description='Split FASTA files',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument('file', help='FASTQ/A input file', metavar='FILE')
+    parser.add_argument('file', metavar='FILE', nargs='*',
+                        help='FASTQ/A input file(s) (may be compressed)')
+
+    parser.add_argument('-M', '--manifest',
+                        help='File listing more input files, one per line',
+                        type=str, metavar='FILE', default='')
+
+    parser.add_argument('-P', '--procs',
+                        help='Worker processes for many files',
+                        type=int, metavar='NUM', default=os.cpu_count())
 
     parser.add_argument('-n', '--num', help='Number of records per file',
                         type=int, metavar='NUM', default=500000)
@@ -27,67 +39,347 @@ def get_args():
     parser.add_argument('-o', '--out_dir', help='Output directory',
                         type=str, metavar='DIR', default='subset')
 
-    parser.add_argument('-i', '--input_format', help='Input file format',
-                        type=str, metavar='FMT', default='fasta')
+    parser.add_argument('-i', '--input_format',
+                        help='Input file format (default guess per file)',
+                        type=str, metavar='FMT', default='')
 
     parser.add_argument('-t', '--output_format', help='Output file format',
                         type=str, metavar='FMT', default='fasta')
 
-    return parser.parse_args()
+    parser.add_argument('-s', '--seed', help='Random seed',
+                        type=int, metavar='INT', default=1)
+
+    parser.add_argument('-c', '--counts_db',
+                        help='Counts database to record the number taken',
+                        type=str, metavar='FILE', default='')
+
+    parser.add_argument('-p', '--pipe',
+                        help='Also stream the subset into this command',
+                        type=str, metavar='CMD', action='append', default=[])
+
+    args = parser.parse_args()
+
+    if args.manifest:
+        with open(args.manifest) as fh:
+            args.file.extend(line.strip() for line in fh if line.strip())
+
+    if not args.file:
+        parser.error('No input files, give FILE(s) or --manifest')
+
+    return args
+
+# --------------------------------------------------
+def reservoir_sample(records, num, seed, progress=1000000):
+    """
+    Take a uniform sample of "num" records in one pass (Algorithm L),
+    return the count of records seen and the sample in input order
+    """
+    rand = random.Random(seed)
+    reservoir = []
+    num_seen = 0
+    next_take = num
+    weight = 1.0
+
+    def skip():
+        """Records to pass over before the next replacement"""
+        return int(math.log(rand.random() or 1e-300) /
+                   math.log(1 - weight)) + 1
+
+    for num_seen, record in enumerate(records, start=1):
+        if num_seen % progress == 0:
+            print('{:,} records'.format(num_seen), file=sys.stderr)
+
+        if num_seen <= num:
+            reservoir.append((num_seen, record))
+            if num_seen == num:
+                weight = math.exp(math.log(rand.random() or 1e-300) / num)
+                next_take = num + skip()
+        elif num_seen == next_take:
+            reservoir[rand.randrange(num)] = (num_seen, record)
+            weight *= math.exp(math.log(rand.random() or 1e-300) / num)
+            next_take += skip()
+
+    reservoir.sort(key=lambda pair: pair[0])
+
+    return num_seen, [record for _, record in reservoir]
+
+# --------------------------------------------------
+def progress_report(every=1000000):
+    """
+    A callback for a running count of records that prints it, as
+    "reservoir_sample" does, each time it passes a multiple of "every"
+    """
+    last = 0
+
+    def report(num_seen):
+        nonlocal last
+        if num_seen // every > last // every:
+            print('{:,} records'.format(num_seen), file=sys.stderr)
+        last = num_seen
+
+    return report
+
+# --------------------------------------------------
+def sample_numbers(count, num, seed):
+    """
+    The record numbers (0-based, sorted) "reservoir_sample" takes from
+    "count" records, jumping from take to take without visiting the rest
+    """
+    rand = random.Random(seed)
+    picks = list(range(min(num, count)))
+    if count < num:
+        return picks
+
+    weight = math.exp(math.log(rand.random() or 1e-300) / num)
+
+    def skip():
+        """Records to pass over before the next replacement"""
+        return int(math.log(rand.random() or 1e-300) /
+                   math.log(1 - weight)) + 1
+
+    next_take = num + skip()
+    while next_take <= count:
+        picks[rand.randrange(num)] = next_take - 1
+        weight *= math.exp(math.log(rand.random() or 1e-300) / num)
+        next_take += skip()
+
+    return sorted(picks)
+
+# --------------------------------------------------
+def count_task(task):
+    """Pool worker: "fastx.count_bounds" on one (path, fmt, lo, hi)"""
+    import fastx
+
+    return fastx.count_bounds(*task)
+
+# --------------------------------------------------
+def sample_file(infile, input_format, num, seed, procs=1):
+    """
+    "reservoir_sample" of a file's records; a plain file is mapped and
+    sampled by record number, so only the records taken are copied, and
+    a large one is counted and cut in "procs" byte ranges at once (the
+    same sample, numbers are global)
+    """
+    import fastx
+
+    if not fastx.mappable(infile):
+        return reservoir_sample(
+            fastx.read_records(infile, input_format), num, seed)
+
+    if fastx.splittable(infile, procs):
+        ranges = fastx.split_ranges(infile, procs, input_format)
+        tasks = [(infile, input_format, lo, hi) for lo, hi in ranges]
+        report = progress_report()
+        with Pool(min(procs, len(tasks))) as pool:
+            counts = []
+            for num_recs in pool.imap(count_task, tasks):
+                counts.append(num_recs)
+                report(sum(counts))
+            first = [sum(counts[:i]) for i in range(len(counts))]
+            count_seqs = sum(counts)
+            picks = sample_numbers(count_seqs, num, seed)
+            spans = pool.starmap(fastx.pick_bounds, [
+                task + ([pick - before for pick in picks
+                         if before <= pick < before + num_recs], )
+                for task, before, num_recs in zip(tasks, first, counts)
+            ])
+        spans = [span for chunk in spans for span in chunk]
+    else:
+        data = fastx.map_file(infile)
+        try:
+            starts, ends = fastx.record_bounds(
+                data, input_format, progress=progress_report())
+        finally:
+            data.close()
+        count_seqs = len(starts)
+        picks = sample_numbers(count_seqs, num, seed)
+        spans = [(int(starts[pick]), int(ends[pick])) for pick in picks]
+
+    data = fastx.map_file(infile)
+    try:
+        taken = [data[start:end] for start, end in spans]
+    finally:
+        data.close()
+
+    if taken and not taken[-1].endswith(b'\n'):
+        taken[-1] += b'\n'
+
+    return count_seqs, taken
+
+# --------------------------------------------------
+def pipe_into(data, cmds):
+    """tee the subset into each command's STDIN, return those that failed"""
+    procs = [(cmd, subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE))
+             for cmd in cmds]
+
+    failed = []
+    for cmd, proc in procs:
+        try:
+            proc.stdin.write(data)
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        if proc.wait() != 0:
+            failed.append(cmd)
+
+    return failed
+
+# --------------------------------------------------
+def subset_file(infile, out_dir, num, min_num=0, input_format='',
+                output_format='fasta', seed=1, pipes=None, procs=1):
+    """
+    Subset one file into "out_dir" (and each of "pipes"), return
+    (out_file, records read, records taken); "out_file" is None when
+    fewer than "min_num" were taken; a large plain file is split across
+    "procs" workers. The input format is guessed when not given. Raise
+    ValueError for bad input.
+    """
+    import fastx
+
+    if not os.path.isfile(infile):
+        raise ValueError('Input file "{}" is not valid'.format(infile))
+
+    if os.path.dirname(infile) == out_dir:
+        raise ValueError('--outdir cannot be the same as input files')
+
+    input_format = input_format or fastx.guess_format(infile)
+    if output_format not in ('fasta', input_format):
+        raise ValueError('Cannot write {} "{}" as {}'.format(
+            input_format, infile, output_format))
+
+    count_seqs, taken = sample_file(infile, input_format, num, seed, procs)
+
+    if count_seqs == 0:
+        raise ValueError('Found no records in "{}"'.format(infile))
+
+    if output_format != input_format:
+        taken = list(map(fastx.to_fasta, taken))
+
+    out_file = os.path.join(out_dir, fastx.sample_name(infile))
+    num_taken = len(taken)
+
+    data = b''.join(taken)
+
+    if num_taken < min_num:
+        print('Only took {}, so not writing "{}"'.format(num_taken, out_file))
+        if os.path.isfile(out_file):
+            os.remove(out_file)
+        return None, count_seqs, num_taken
+
+    failed = pipe_into(data, pipes or [])
+    if failed:
+        raise ValueError('Failed to stream "{}" into "{}"'.format(
+            out_file, '", "'.join(failed)))
+
+    # Only a complete subset ever has the final name
+    with open(out_file + '.tmp', 'wb') as out_fh:
+        out_fh.write(data)
+    os.rename(out_file + '.tmp', out_file)
+
+    return out_file, count_seqs, num_taken
+
+# --------------------------------------------------
+def subset_task(args):
+    """
+    Pool worker: "subset_file" on one (infile, kwargs), return (infile,
+    result or None, error or None) so one bad file does not stop a batch
+    """
+    infile, kwargs = args
+    try:
+        return infile, subset_file(infile, **kwargs), None
+    except (OSError, ValueError) as err:
+        return infile, None, str(err)
+
+# --------------------------------------------------
+def subset_files(files, procs=None, **kwargs):
+    """
+    Subset many files in a pool of long-lived workers, so the interpreter
+    starts and imports once per worker instead of once per file; yield
+    "subset_task" results as they finish
+    """
+    import fastx
+
+    procs = procs or os.cpu_count()
+
+    # Large files one at a time with all the workers on their byte ranges
+    for infile in files:
+        if fastx.splittable(infile, procs):
+            yield subset_task((infile, dict(kwargs, procs=procs)))
+
+    tasks = [(infile, kwargs) for infile in files
+             if not fastx.splittable(infile, procs)]
+    if len(tasks) < 2 or procs == 1:
+        yield from map(subset_task, tasks)
+        return
+
+    with Pool(min(procs, len(tasks))) as pool:
+        yield from pool.imap_unordered(subset_task, tasks)
+
+# --------------------------------------------------
+def batch_report(num_files, start, first_done):
+    """Cold start (time to the first file done) and files per second"""
+    now = time.time()
+    return '{} file{} in {:.2f}s, first done after {:.2f}s ({:.1f} ' \
+        'files/s)'.format(num_files, '' if num_files == 1 else 's',
+                          now - start, (first_done or now) - start,
+                          num_files / max(now - start, 1e-9))
 
 # --------------------------------------------------
 def main():
     """main"""
+    import tracing
+
+    # The cold start of a batch counts from the process starting
+    start = tracing.process_start()
     args = get_args()
-    infile = args.file
     out_dir = args.out_dir
-    num_seqs = args.num
-    min_num = args.min
     input_format = args.input_format
     output_format = args.output_format
 
-    if not os.path.isfile(infile):
-        print('Input file "{}" is not valid'.format(infile))
-        sys.exit(1)
-
-    if os.path.dirname(infile) == out_dir:
-        print('--outdir cannot be the same as input files')
+    if args.num < 1:
+        print("--num cannot be less than one")
         sys.exit(1)
 
-    if num_seqs < 1:
-        print("--num cannot be less than one")
+    if input_format not in ('', 'fasta', 'fastq') or \
+       output_format not in ('fasta', 'fastq'):
+        print('Can only subset FASTA/Q to FASTA or the input format')
         sys.exit(1)
 
     if not os.path.isdir(out_dir):
-        os.mkdir(out_dir)
+        os.makedirs(out_dir)
 
-    count_seqs = 0
-    for record in SeqIO.parse(infile, input_format):
-        count_seqs += 1
+    num_failed = 0
+    first_done = None
+    counts = []
+    for infile, result, error in subset_files(
+            args.file, args.procs, out_dir=out_dir, num=args.num,
+            min_num=args.min, input_format=input_format,
+            output_format=output_format, seed=args.seed, pipes=args.pipe):
+        first_done = first_done or time.time()
+        if error:
+            print(error)
+            num_failed += 1
+            continue
 
-    if count_seqs == 0:
-        print('Found no records in "{}"'.format(infile))
-        sys.exit(1)
+        out_file, count_seqs, num_taken = result
+        if out_file:
+            counts.append((os.path.basename(out_file), num_taken))
+            print('Done, read {} wrote {} sequence{} to "{}"'.format(
+                count_seqs, num_taken, '' if num_taken == 1 else 's',
+                out_file))
 
-    out_file = os.path.join(out_dir, os.path.basename(infile))
-    take_pct = round(num_seqs / count_seqs, 4) if count_seqs > num_seqs else 1
-    num_taken = 0
+    if args.counts_db and counts:
+        import counts_db
 
-    with open(out_file, 'wt') as out_fh:
-        for record in SeqIO.parse(infile, input_format):
-            if random() <= take_pct:
-                SeqIO.write(record, out_fh, output_format)
-                num_taken += 1
+        db = counts_db.connect(args.counts_db)
+        counts_db.put_input_counts(db, counts)
+        db.close()
 
-            if num_taken >= num_seqs:
-                break
+    if len(args.file) > 1:
+        print('Subset ' + batch_report(len(args.file), start, first_done))
 
-    if num_taken < min_num:
-        print('Only took {}, so removing "{}"'.format(num_taken, out_file))
-        os.remove(out_file)
-    else:
-        print('Done, wrote {} sequence{} to "{}"'.format(
-            num_taken, '' if num_taken == 1 else 's', out_file))
+    if num_failed:
+        sys.exit(1)
 
 # --------------------------------------------------
 if __name__ == '__main__':
@@ -0,0 +1,761 @@
+"""Lightweight FASTA/FASTQ readers that work on raw bytes"""
+
+import bz2
+import gzip
+import hashlib
+import io
+import mmap
+import os
+import shutil
+import subprocess
+
+OFFSETS_EXT = '.fxi.npy'
+
+# Bytes of a mapped file scanned at a time for record boundaries
+MAP_WINDOW = 2**26
+
+# Smallest byte range a file is split into for parallel work
+SPLIT_BYTES = 2**28
+
+# Compressed extensions and the (parallel first) tools that stream them
+COMPRESSION = {'.gz': 'gzip', '.bgz': 'gzip', '.bz2': 'bzip2', '.zst': 'zstd'}
+DECOMPRESS = {
+    'gzip': [['pigz', '-dc', '-p', '{threads}'], ['gzip', '-dc']],
+    'bzip2': [['pbzip2', '-dc', '-p{threads}'], ['bzip2', '-dc']],
+    'zstd': [['zstd', '-dcq', '-T{threads}']]
+}
+COMPRESS = {
+    'gzip': [['pigz', '-c', '-p', '{threads}'], ['gzip', '-c']],
+    'bzip2': [['pbzip2', '-c', '-p{threads}'], ['bzip2', '-c']],
+    'zstd': [['zstd', '-cq', '-T{threads}']]
+}
+
+
+# --------------------------------------------------
+def compression(path):
+    """"gzip," "bzip2," "zstd" or None from the file extension"""
+
+    return COMPRESSION.get(os.path.splitext(path)[1].lower())
+
+
+# --------------------------------------------------
+def sample_name(path):
+    """File name without any compression extension"""
+
+    name = os.path.basename(path)
+    return os.path.splitext(name)[0] if compression(name) else name
+
+
+# --------------------------------------------------
+def find_tool(tools, threads):
+    """First of the command lines whose program is installed"""
+
+    for tool in tools:
+        if shutil.which(tool[0]):
+            return [arg.format(threads=threads) for arg in tool]
+
+    return None
+
+
+# --------------------------------------------------
+def decompress_cmd(path, threads=1):
+    """Shell command streaming the decompressed file to STDOUT"""
+
+    tool = find_tool(DECOMPRESS[compression(path)], threads)
+    if not tool:
+        raise OSError('No decompressor for "{}"'.format(path))
+
+    return ' '.join(tool + [path])
+
+
+# --------------------------------------------------
+def stream_input(path, threads=1):
+    """
+    (shell prefix, file argument) to give a tool an input file: plain
+    files are used as-is, compressed ones are piped in as /dev/stdin
+    """
+
+    if not compression(path):
+        return '', path
+
+    return decompress_cmd(path, threads) + ' | ', '/dev/stdin'
+
+
+# --------------------------------------------------
+def compress_cmd(out_file, threads=1, kind=None):
+    """
+    Shell command compressing STDIN into "out_file" by its extension
+    (or as "kind," e.g., for a temp file)
+    """
+
+    tool = find_tool(COMPRESS[kind or compression(out_file)], threads)
+    if not tool:
+        raise OSError('No compressor for "{}"'.format(out_file))
+
+    return '{} > {}'.format(' '.join(tool), out_file)
+
+
+# --------------------------------------------------
+class Pipe:
+    """Read or write a compressed file through an external (de)compressor"""
+
+    def __init__(self, cmd, path, mode):
+        if mode == 'rb':
+            self.proc = subprocess.Popen(
+                cmd + [path], stdout=subprocess.PIPE, bufsize=2**20)
+            self.fh = self.proc.stdout
+        else:
+            self.out = open(path, 'wb')
+            self.proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=self.out, bufsize=2**20)
+            self.fh = self.proc.stdin
+        self.path = path
+
+    def __getattr__(self, name):
+        if name == 'fh':
+            raise AttributeError(name)
+        return getattr(self.fh, name)
+
+    def __iter__(self):
+        return iter(self.fh)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        """Close the pipe, fail if the tool did"""
+
+        if self.fh.closed:
+            return
+
+        # A reader that stops early just stops the tool
+        if self.proc.stdout and self.fh.read(1):
+            self.proc.terminate()
+            self.fh.close()
+            self.proc.wait()
+            return
+
+        self.fh.close()
+        status = self.proc.wait()
+        if self.proc.stdin:
+            self.out.close()
+        if status != 0:
+            raise OSError('Failed to stream "{}" ({})'.format(
+                self.path, status))
+
+
+# --------------------------------------------------
+def open_input(path, threads=1):
+    """
+    Open a plain or compressed file for binary reading, decompressing
+    through a (multi-threaded) tool when one is installed
+    """
+
+    kind = compression(path)
+    if not kind:
+        return open(path, 'rb', buffering=2**20)
+
+    tool = find_tool(DECOMPRESS[kind], threads)
+    if tool:
+        return Pipe(tool, path, 'rb')
+
+    if kind == 'zstd':
+        import zstandard
+        return io.BufferedReader(
+            zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')),
+            2**20)
+
+    return gzip.open(path, 'rb') if kind == 'gzip' else bz2.open(path, 'rb')
+
+
+# --------------------------------------------------
+def open_output(path, threads=1):
+    """Open a file for binary writing, compressing it by its extension"""
+
+    kind = compression(path)
+    if not kind:
+        return open(path, 'wb', buffering=2**20)
+
+    tool = find_tool(COMPRESS[kind], threads)
+    if tool:
+        return Pipe(tool, path, 'wb')
+
+    if kind == 'zstd':
+        import zstandard
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+
+    return gzip.open(path, 'wb') if kind == 'gzip' else bz2.open(path, 'wb')
+
+
+# --------------------------------------------------
+def guess_format(path):
+    """Look at the first byte to decide FASTA or FASTQ"""
+
+    with open_input(path) as fh:
+        return peek_format(fh)
+
+
+# --------------------------------------------------
+def peek_format(fh):
+    """Like "guess_format" without consuming the byte, so pipes work"""
+
+    return 'fastq' if fh.peek(1)[:1] == b'@' else 'fasta'
+
+
+# --------------------------------------------------
+def read_seqs(path):
+    """Yield the sequence (as bytes) of every record in a FASTA/FASTQ file"""
+
+    with open_input(path) as fh:
+        if peek_format(fh) == 'fastq':
+            for i, line in enumerate(fh):
+                if i % 4 == 1:
+                    yield line.rstrip()
+            return
+
+        seq = []
+        in_record = False
+        for line in fh:
+            if line.startswith(b'>'):
+                if in_record:
+                    yield b''.join(seq)
+                seq = []
+                in_record = True
+            else:
+                seq.append(line.rstrip())
+
+        if in_record:
+            yield b''.join(seq)
+
+
+# --------------------------------------------------
+def read_records(path, fmt=None):
+    """Yield the raw bytes (newlines included) of every record"""
+
+    with open_input(path) as fh:
+        yield from handle_records(fh, fmt)
+
+
+# --------------------------------------------------
+def handle_records(fh, fmt=None):
+    """"read_records" of an open binary handle, e.g. a pipe"""
+
+    if (fmt or peek_format(fh)) == 'fastq':
+        while True:
+            record = fh.readline()
+            if not record:
+                return
+            record += fh.readline() + fh.readline() + fh.readline()
+            yield record if record.endswith(b'\n') else record + b'\n'
+
+    lines = []
+    for line in fh:
+        if line.startswith(b'>') and lines:
+            yield b''.join(lines)
+            lines = []
+        if lines or line.startswith(b'>'):
+            lines.append(line)
+
+    if lines:
+        if not lines[-1].endswith(b'\n'):
+            lines[-1] += b'\n'
+        yield b''.join(lines)
+
+
+# --------------------------------------------------
+def to_fasta(record):
+    """Convert a raw FASTQ record to FASTA, FASTA is returned as-is"""
+
+    if not record.startswith(b'@'):
+        return record
+
+    header, seq = record.split(b'\n', 2)[:2]
+    return b'>' + header[1:].rstrip(b'\r') + b'\n' + seq.rstrip(b'\r') + b'\n'
+
+
+# --------------------------------------------------
+def seq_batches(path, batch_size):
+    """Group sequences into lists holding about "batch_size" bases"""
+
+    batch = []
+    num_bases = 0
+    for seq in read_seqs(path):
+        batch.append(seq)
+        num_bases += len(seq)
+        if num_bases >= batch_size:
+            yield batch
+            batch = []
+            num_bases = 0
+
+    if batch:
+        yield batch
+
+
+# --------------------------------------------------
+def mappable(path):
+    """Can the file be mapped? (plain, regular and not empty)"""
+
+    return not compression(path) and os.path.isfile(path) and \
+        os.path.getsize(path) > 0
+
+
+# --------------------------------------------------
+def map_file(path):
+    """Map a whole file read-only"""
+
+    with open(path, 'rb') as fh:
+        return mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+# --------------------------------------------------
+def record_bounds(data, fmt, window=MAP_WINDOW, lo=0, hi=None,
+                  progress=None):
+    """
+    (starts, ends) int64 arrays of the records in mapped bytes (or in
+    the range "lo" to "hi" starting at a record, see "split_ranges"),
+    found with NumPy a window at a time so no object is made per record;
+    records are what "read_records" yields: FASTA from a ">" line to
+    the next, FASTQ by line quads. "progress" is called with the number
+    of records found so far after each window.
+    """
+
+    import numpy as np
+
+    hi = len(data) if hi is None else hi
+    found = []
+    num_lines = 0
+    num_found = 0
+    for win_lo in range(lo, hi, window):
+        win_hi = min(win_lo + window, hi)
+        # One byte past the window to see what follows its last newline
+        view = np.frombuffer(data, dtype=np.uint8,
+                             count=min(win_hi + 1, hi) - win_lo, offset=win_lo)
+        newlines = np.flatnonzero(view[:win_hi - win_lo] == 10)
+        line_starts = newlines + 1
+        line_starts = line_starts[line_starts < len(view)]
+
+        if fmt == 'fastq':
+            line_nums = num_lines + 1 + np.arange(len(line_starts))
+            starts = line_starts[line_nums % 4 == 0]
+            if win_lo == lo:
+                starts = np.concatenate(([0], starts))
+            num_lines += len(newlines)
+        else:
+            starts = line_starts[view[line_starts] == ord('>')]
+            if win_lo == lo and view[0] == ord('>'):
+                starts = np.concatenate(([0], starts))
+
+        found.append(starts.astype(np.int64) + win_lo)
+        num_found += len(starts)
+        if progress:
+            progress(num_found)
+
+    starts = np.concatenate(found or [np.zeros(0, dtype=np.int64)])
+    ends = np.concatenate((starts[1:], [hi])).astype(np.int64)
+
+    return starts, ends
+
+
+# --------------------------------------------------
+def record_start(data, pos, fmt):
+    """
+    The first record starting at or after "pos": a ">" line in FASTA; in
+    FASTQ an "@" line with a "+" line two below it (a quality line may
+    start with "@," but then two lines down is a sequence)
+    """
+
+    size = len(data)
+    if pos <= 0:
+        return 0
+
+    if fmt != 'fastq':
+        return data.find(b'\n>', pos - 1) + 1 or size
+
+    line = data.find(b'\n', pos - 1) + 1 or size
+    while line < size:
+        after = data.find(b'\n', line) + 1 or size
+        plus = data.find(b'\n', after) + 1 or size
+        if data[line:line + 1] == b'@' and data[plus:plus + 1] == b'+':
+            return line
+        line = after
+
+    return size
+
+
+# --------------------------------------------------
+def split_ranges(path, num_chunks, fmt=None):
+    """
+    Cut a plain file into about "num_chunks" (lo, hi) byte ranges that
+    start at records, for "record_bounds" on each in parallel
+    """
+
+    fmt = fmt or guess_format(path)
+    size = os.path.getsize(path)
+    num_chunks = max(1, min(num_chunks, size // SPLIT_BYTES))
+
+    data = map_file(path)
+    try:
+        cuts = sorted(set(
+            [0, size] + [record_start(data, size * i // num_chunks, fmt)
+                         for i in range(1, num_chunks)]))
+    finally:
+        data.close()
+
+    return list(zip(cuts[:-1], cuts[1:]))
+
+
+# --------------------------------------------------
+def map_chunks(func, path, procs, fmt=None):
+    """
+    "func(path, fmt, lo, hi)" on the "split_ranges" of a file in a pool
+    of "procs" workers, the results in file order
+    """
+
+    from multiprocessing import Pool
+
+    fmt = fmt or guess_format(path)
+    ranges = split_ranges(path, procs, fmt)
+    tasks = [(path, fmt, lo, hi) for lo, hi in ranges]
+    if len(tasks) < 2:
+        return [func(*task) for task in tasks]
+
+    with Pool(min(procs, len(tasks))) as pool:
+        return pool.starmap(func, tasks)
+
+
+# --------------------------------------------------
+def splittable(path, procs):
+    """Is a file worth splitting across "procs" workers?"""
+
+    return procs > 1 and mappable(path) and \
+        os.path.getsize(path) >= 2 * SPLIT_BYTES
+
+
+# --------------------------------------------------
+def count_bounds(path, fmt, lo, hi):
+    """Number of records in a range, by "record_bounds" """
+
+    data = map_file(path)
+    try:
+        return len(record_bounds(data, fmt, lo=lo, hi=hi)[0])
+    finally:
+        data.close()
+
+
+# --------------------------------------------------
+def pick_bounds(path, fmt, lo, hi, picks):
+    """(start, end) of the records numbered "picks" within a range"""
+
+    data = map_file(path)
+    try:
+        starts, ends = record_bounds(data, fmt, lo=lo, hi=hi)
+    finally:
+        data.close()
+
+    return [(int(starts[pick]), int(ends[pick])) for pick in picks]
+
+
+# --------------------------------------------------
+def mapped_records(path, fmt=None):
+    """
+    Yield every record of a plain file as a memoryview into the mapped
+    file (no copy, unlike "read_records"), newline-terminated
+    """
+
+    fmt = fmt or guess_format(path)
+    data = map_file(path)
+    view = memoryview(data)
+    try:
+        starts, ends = record_bounds(data, fmt)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if data[end - 1] == 10:
+                yield view[start:end]
+            else:
+                yield bytes(view[start:end]) + b'\n'
+    finally:
+        view.release()
+        try:
+            data.close()
+        except BufferError:
+            # Views the caller still holds keep it open until they go
+            pass
+
+
+# --------------------------------------------------
+def sequence_array(view, fmt, starts):
+    """
+    The sequences of whole records (starting at "starts") in a uint8
+    array as one buffer of "N" + sequence per record, return (buffer,
+    read starts); "N" keeps kmers from spanning reads, line breaks and
+    other whitespace are dropped
+    """
+
+    import numpy as np
+
+    size = len(view)
+    space = np.flatnonzero(view <= 32)
+    newlines = np.concatenate((space[view[space] == 10], [size, size]))
+    first = np.searchsorted(newlines, starts)
+
+    # Sequence after the header line: to the record's end in FASTA, to
+    # the end of the next line in FASTQ
+    seq_lo = np.minimum(newlines[first] + 1, size)
+    if fmt == 'fastq':
+        seq_hi = newlines[np.minimum(first + 1, len(newlines) - 1)]
+    else:
+        seq_hi = np.concatenate((starts[1:], [size]))
+    seq_hi = np.maximum(seq_hi, seq_lo)
+
+    # +1/-1 where sequences start/end (each position at most once)
+    delta = np.zeros(size + 1, dtype=np.int8)
+    delta[seq_lo] += 1
+    delta[seq_hi] -= 1
+    keep = np.cumsum(delta[:-1], dtype=np.int8).view(bool)
+    keep[space] = False
+    keep[starts] = True
+    buf = view[keep]
+
+    # Each record keeps its "N" and the non-space bytes of its sequence
+    kept = 1 + seq_hi - seq_lo - (np.searchsorted(space, seq_hi) -
+                                  np.searchsorted(space, seq_lo))
+    sep_pos = np.cumsum(kept) - kept
+    buf[sep_pos] = ord('N')
+
+    return buf, sep_pos + 1
+
+
+# --------------------------------------------------
+def seq_arrays(path, batch_size):
+    """
+    Yield (buffer, read starts) batches of about "batch_size" bases, see
+    "sequence_array"; a plain file is mapped and cut into runs of whole
+    records, a compressed one read through "seq_batches"
+    """
+
+    import numpy as np
+
+    if not mappable(path):
+        for batch in seq_batches(path, batch_size):
+            buf = np.frombuffer(b'N' + b'N'.join(batch), dtype=np.uint8)
+            yield buf, np.cumsum(
+                [1] + [len(seq) + 1 for seq in batch[:-1]]).astype(np.int64)
+        return
+
+    fmt = guess_format(path)
+    data = map_file(path)
+    try:
+        starts, ends = record_bounds(data, fmt)
+        if len(starts) == 0:
+            return
+
+        # Whole records adding up to about "batch_size" bytes
+        cuts = np.searchsorted(
+            starts, np.arange(starts[0], ends[-1], max(1, batch_size)),
+            side='left')
+        cuts = np.unique(np.concatenate((cuts, [len(starts)])))
+        cuts = cuts[cuts > 0]
+        first = 0
+        for last in cuts.tolist():
+            lo, hi = int(starts[first]), int(ends[last - 1])
+            view = np.frombuffer(data, dtype=np.uint8, count=hi - lo,
+                                 offset=lo)
+            yield sequence_array(view, fmt, starts[first:last] - lo)
+            del view
+            first = last
+    finally:
+        try:
+            data.close()
+        except BufferError:
+            pass
+
+
+# --------------------------------------------------
+def count_range(path, fmt, lo, hi, chunk_size=2**22):
+    """(newlines, FASTA headers) in a byte range of a plain file"""
+
+    num_lines = 0
+    num_headers = 0
+    data = map_file(path)
+    try:
+        if lo == 0 and data[:1] == b'>':
+            num_headers += 1
+        for start in range(lo, hi, chunk_size):
+            stop = min(start + chunk_size, hi)
+            num_lines += data[start:stop].count(b'\n')
+            # A header belongs to the range holding the newline before it
+            num_headers += data[start:min(stop + 1, len(data))].count(
+                b'\n>')
+    finally:
+        data.close()
+
+    return num_lines, num_headers
+
+
+# --------------------------------------------------
+def count_records(path, chunk_size=2**22, procs=1):
+    """
+    Count FASTA headers (or FASTQ line quads) without parsing records,
+    a large plain file in "procs" byte ranges at once
+    """
+
+    if splittable(path, procs):
+        fmt = guess_format(path)
+        counts = map_chunks(count_range, path, procs, fmt)
+        if fmt == 'fasta':
+            return sum(headers for _, headers in counts)
+
+        with open(path, 'rb') as fh:
+            fh.seek(-1, os.SEEK_END)
+            last = fh.read(1)
+        return (sum(lines for lines, _ in counts) + (last != b'\n')) // 4
+
+    num_lines = 0
+    num_headers = 0
+    last = b'\n'
+    with open_input(path) as fh:
+        fmt = peek_format(fh)
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            num_lines += chunk.count(b'\n')
+            num_headers += chunk.count(b'\n>') + (last == b'\n' and
+                                                  chunk[:1] == b'>')
+            last = chunk[-1:]
+
+    if fmt == 'fastq':
+        return (num_lines + (last not in (b'\n', b''))) // 4
+
+    return num_headers
+
+
+# --------------------------------------------------
+def mean_record_bytes(path, sample_size=2**20):
+    """Average bytes per record (uncompressed) in the start of a file"""
+
+    with open_input(path) as fh:
+        fmt = peek_format(fh)
+        sample = fh.read(sample_size)
+
+    if fmt == 'fastq':
+        num = sample.count(b'\n') / 4
+    else:
+        num = sample.count(b'\n>') + sample.startswith(b'>')
+
+    return max(1, int(len(sample) / max(num, 1)))
+
+
+# --------------------------------------------------
+def record_spans(path, fmt=None, lo=0, hi=None):
+    """
+    Yield (id, offset, length) of every record (in a "split_ranges"
+    range), IDs end at whitespace
+    """
+
+    fmt = fmt or guess_format(path)
+    if os.path.getsize(path) == 0:
+        return
+
+    data = map_file(path)
+    try:
+        starts, ends = record_bounds(data, fmt, lo=lo, hi=hi)
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            yield span_id(data, start), start, end - start
+    finally:
+        data.close()
+
+
+# --------------------------------------------------
+def id_hash(read_id):
+    """Stable 64-bit hash of a read ID"""
+
+    return int.from_bytes(
+        hashlib.blake2b(read_id.encode(), digest_size=8).digest(), 'little')
+
+
+# --------------------------------------------------
+def offsets_path(path):
+    """Where the offset index of a reads file is cached"""
+
+    return path + OFFSETS_EXT
+
+
+# --------------------------------------------------
+def span_table(path, fmt, lo, hi):
+    """(ID hash, offset, length) uint64 rows of the records in a range"""
+
+    import numpy as np
+
+    return np.array(
+        [(id_hash(rec_id), offset, length)
+         for rec_id, offset, length in record_spans(path, fmt, lo, hi)],
+        dtype=np.uint64).reshape(-1, 3)
+
+
+# --------------------------------------------------
+def load_offsets(path, procs=1):
+    """
+    The offset index of a FASTA/FASTQ file, (n x 3) uint64 rows of (ID
+    hash, offset, length) sorted by hash, mapped from the cached file
+    next to it and (re)built when missing or older than the reads (a
+    large file in "procs" byte ranges at once)
+    """
+
+    import numpy as np
+
+    cache = offsets_path(path)
+    if os.path.isfile(cache) and \
+       os.path.getmtime(cache) >= os.path.getmtime(path):
+        return np.load(cache, mmap_mode='r')
+
+    fmt = guess_format(path)
+    if splittable(path, procs):
+        table = np.concatenate(map_chunks(span_table, path, procs, fmt))
+    else:
+        table = span_table(path, fmt, 0, os.path.getsize(path))
+
+    # Stable, so equal hashes stay in file order either way
+    table = table[np.argsort(table[:, 0], kind='mergesort')]
+
+    try:
+        with open(cache + '.tmp', 'wb') as out_fh:
+            np.save(out_fh, table)
+        os.rename(cache + '.tmp', cache)
+    except OSError:
+        pass
+
+    return table
+
+
+# --------------------------------------------------
+def find_offsets(table, read_ids):
+    """
+    (offset, length) rows of the records whose ID hash matches one of
+    "read_ids" (check the IDs themselves, hashes may collide)
+    """
+
+    import numpy as np
+
+    if len(table) == 0 or not read_ids:
+        return np.zeros((0, 2), dtype=np.uint64)
+
+    hashes = np.array(sorted(map(id_hash, read_ids)), dtype=np.uint64)
+    left = np.searchsorted(table[:, 0], hashes, side='left')
+    right = np.searchsorted(table[:, 0], hashes, side='right')
+    rows = np.concatenate(
+        [np.arange(lo, hi) for lo, hi in zip(left, right)] or [[]])
+
+    return np.asarray(table[rows.astype(np.int64), 1:])
+
+
+# --------------------------------------------------
+def span_id(data, offset):
+    """ID of the record starting at "offset" in mapped bytes"""
+
+    eol = data.find(b'\n', offset)
+    header = data[offset + 1:eol if eol >= 0 else len(data)].split(None, 1)
+
+    return (header or [b''])[0].decode()
@@ -2,11 +2,18 @@
 """Main entry point for Fizkin"""
 
 import argparse
-import glob
+import atexit
 import os
+import shutil
 import sys
-import tempfile as tmp
+import time
 import subprocess
+from multiprocessing import Pool
+import tracing
+
+# "--hash_size auto": room over the estimated distinct kmers, and floor
+HASH_HEADROOM = 1.2
+MIN_HASH_SIZE = 10**6
 
 
 # --------------------------------------------------
@@ -61,23 +68,176 @@ def get_args():
     parser.add_argument(
         '-s',
         '--hash_size',
-        help='Jellyfish hash size',
+        help='Jellyfish hash size, "auto" sizes each to fit its file',
         metavar='str',
         type=str,
-        default='100M')
+        default='auto')
 
-    return parser.parse_args()
+    parser.add_argument(
+        '-H',
+        '--hash_estimate',
+        help='Estimate distinct kmers for "auto" from file size or with '
+        'a HyperLogLog pass',
+        metavar='str',
+        type=str,
+        choices=['size', 'hll'],
+        default='size')
+
+    parser.add_argument(
+        '-e',
+        '--engine',
+        help='Kmer counting engine',
+        metavar='str',
+        type=str,
+        choices=['jellyfish', 'numpy'],
+        default='jellyfish')
 
+    parser.add_argument(
+        '-m',
+        '--min_mode',
+        help='Min. mode of kmer counts to keep a read',
+        metavar='int',
+        type=int,
+        default=1)
 
-# --------------------------------------------------
-def line_count(fname):
-    """Count the number of lines in a file"""
+    parser.add_argument(
+        '-p',
+        '--pct_kmer_coverage',
+        help='Min. percent of read kmers found in the index',
+        metavar='int',
+        type=int,
+        default=10)
+
+    parser.add_argument(
+        '-n',
+        '--sketch_size',
+        help='MinHash sketch size for --prefilter/--approximate',
+        metavar='int',
+        type=int,
+        default=1000)
+
+    parser.add_argument(
+        '-f',
+        '--prefilter',
+        help='Skip exact comparison of pairs with sketch similarity below',
+        metavar='float',
+        type=float,
+        default=0.)
+
+    parser.add_argument(
+        '-a',
+        '--approximate',
+        help='Only write the sketch similarity matrix',
+        action='store_true')
+
+    parser.add_argument(
+        '-r',
+        '--seed',
+        help='Random seed for subsetting',
+        metavar='int',
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        '-c',
+        '--cache_dir',
+        help='Shared cache for subsets and indexes',
+        metavar='str',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-b',
+        '--cache_size',
+        help='Disk budget for --cache_dir',
+        metavar='str',
+        type=str,
+        default='50G')
+
+    parser.add_argument(
+        '-S',
+        '--shards',
+        help='Split the comparisons into this many tiles (0 = off)',
+        metavar='int',
+        type=int,
+        default=0)
+
+    parser.add_argument(
+        '-R',
+        '--shard_runner',
+        help='Run shards here or write a SLURM job array',
+        metavar='str',
+        type=str,
+        choices=['local', 'slurm'],
+        default='local')
+
+    parser.add_argument(
+        '-i',
+        '--index_mem',
+        help='Memory for NumPy indexes probed together (default half free)',
+        metavar='str',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-w',
+        '--stream',
+        help='Pipe subsets into kmer counting and kept reads into a '
+        'read counter instead of reading files back',
+        action='store_true')
+
+    parser.add_argument(
+        '-C',
+        '--colored',
+        help='Merge the NumPy indexes into one colored index and scan '
+        'each query once (N instead of N^2 scans)',
+        action='store_true')
+
+    parser.add_argument(
+        '-N',
+        '--num_scans',
+        help='Most GBME scans per chain (fewer once the chains converge)',
+        metavar='int',
+        type=int,
+        default=20000)
 
-    n = 0
-    for _ in open(fname):
-        n += 1
+    parser.add_argument(
+        '-M',
+        '--num_chains',
+        help='Number of GBME chains',
+        metavar='int',
+        type=int,
+        default=4)
+
+    parser.add_argument(
+        '-y',
+        '--retries',
+        help='Times to retry a failed job',
+        metavar='int',
+        type=int,
+        default=0)
 
-    return n
+    parser.add_argument(
+        '-g',
+        '--keep_going',
+        help='Keep running the jobs that do not need a failed one',
+        action='store_true')
+
+    parser.add_argument(
+        '-V',
+        '--verify',
+        help='Check the outputs of finished jobs against their checksums '
+        'before skipping them',
+        action='store_true')
+
+    parser.add_argument(
+        '-T',
+        '--trace',
+        help='Record stage/job time, CPU, RSS and I/O to "trace.jsonl" '
+        'and "trace.json" (Chrome trace) in the output dir',
+        action='store_true')
+
+    return parser.parse_args()
 
 
 # --------------------------------------------------
@@ -96,21 +256,27 @@ def die(msg='Something went wrong'):
 
 
 # --------------------------------------------------
-def run_job_file(jobfile, msg='Running job', num_concurrent=4):
-    """Run a job file if there are jobs"""
+def run_jobs(jobs, msg='Running jobs', max_jobs=None, retries=0,
+             keep_going=False):
+    """Run scheduler jobs, packing them onto this node's CPUs/memory"""
 
-    num_jobs = line_count(jobfile)
-    warn('{} (# jobs = {} @ {})'.format(msg, num_jobs, num_concurrent))
+    import scheduler
 
-    if num_jobs > 0:
-        cmd = 'parallel -j {} --halt soon,fail=1 < {}'.format(
-            num_concurrent, jobfile)
-        try:
-            subprocess.run(cmd, shell=True, check=True)
-        except subprocess.CalledProcessError as err:
-            die('Error:\n{}\n{}\n'.format(err.stderr, err.stdout))
-        finally:
-            os.remove(jobfile)
+    sched = scheduler.Scheduler(
+        max_jobs=max_jobs, retries=retries, keep_going=keep_going)
+    warn('{} (# jobs = {} @ {} CPUs)'.format(msg, len(jobs), sched.cpus))
+
+    if jobs:
+        start = time.time()
+        with tracing.stage(msg):
+            failed = sched.run(jobs)
+        tracing.add_jobs(jobs, msg)
+        warn(scheduler.report(jobs, time.time() - start, sched.cpus))
+
+        if failed:
+            not_run = sum(job.status is None for job in jobs)
+            die('{} job{} failed, {} not run; rerun to do only those'.format(
+                len(failed), '' if len(failed) == 1 else 's', not_run))
 
     return True
 
@@ -133,205 +299,985 @@ def find_input_files(query):
 
 
 # --------------------------------------------------
-def jellyfish_count(files, out_dir, kmer_size, hash_size, num_threads):
-    """Use Jellyfish to count kmers in files"""
+def is_done(journal, name, params, inputs, outputs):
+    """Did a job finish? Per the run journal, or else by its outputs"""
+
+    if journal:
+        return journal.is_done(name, params, inputs, outputs)
+
+    return all(os.path.isfile(path) for path in outputs)
+
+
+# --------------------------------------------------
+def journaled(journal, name, params, inputs, outputs, on_done=None):
+    """A job's "on_done" that then records it in the run journal"""
+
+    if not journal:
+        return on_done
+
+    def done():
+        """Run the job's own callback, then record it"""
+        if on_done:
+            on_done()
+        journal.record(name, params, inputs, outputs)
+
+    return done
+
+
+# --------------------------------------------------
+def pipe_into(subset_job, cmd, cpus=1, mem=0, on_done=None):
+    """Have a subset job tee its output into "cmd" (fa_subset.py -p)"""
+
+    subset_job.cmd += " -p '{}'".format(cmd)
+    subset_job.cpus += cpus
+    subset_job.mem += mem
+
+    if on_done:
+        first = subset_job.on_done
+
+        def both():
+            """Run the subset's and the command's callbacks"""
+            if first:
+                first()
+            on_done()
+
+        subset_job.on_done = both
+
+
+# --------------------------------------------------
+def piped_bytes(subset_jobs, out_dir):
+    """
+    Bytes of subset that the commands piped from the finished subset jobs
+    did not have to read back from disk (the subsets are still written)
+    """
+
+    total = 0
+    for job in subset_jobs:
+        num_pipes = (job.cmd or '').count(" -p '")
+        subset_file = os.path.join(out_dir, 'subset',
+                                   job.name.split(':', 1)[1])
+        if job.status == 0 and num_pipes and os.path.isfile(subset_file):
+            total += num_pipes * os.path.getsize(subset_file)
+
+    return total
+
+
+# --------------------------------------------------
+def jellyfish_mem(hash_size, kmer_size):
+    """Rough bytes used by a Jellyfish hash (key bits + counter bits)"""
+
+    import kmers
+
+    return kmers.parse_size(hash_size) * (2 * kmer_size + 8) // 8
+
+
+# --------------------------------------------------
+def jellyfish_hash_sizes(files, kmer_size, hash_size='auto', estimate='size',
+                         sources=None, num_threads=1):
+    """
+    Jellyfish hash size (entries) for each file: "hash_size" as given,
+    or ("auto") room for its estimated distinct kmers so Jellyfish never
+    writes and merges partial hashes, capped by the node's memory. A
+    subset not made yet is estimated from its (source, max_records) in
+    "sources."
+    """
+
+    import kmers
+    import scheduler
+
+    if hash_size != 'auto':
+        return {file: kmers.parse_size(hash_size) for file in files}
+
+    sources = sources or {}
+    distinct = {}
+    todo = [file for file in files if os.path.isfile(file)]
+    if estimate == 'hll' and todo:
+        with Pool(max(1, min(num_threads, len(todo)))) as pool:
+            distinct = dict(
+                zip(todo,
+                    pool.starmap(kmers.estimate_distinct,
+                                 [(file, kmer_size) for file in todo])))
+
+    max_size = scheduler.available_memory() * 9 // 10 * 8 // \
+        (2 * kmer_size + 8)
+    sizes = {}
+    for file in files:
+        if file in distinct:
+            num = distinct[file]
+        elif os.path.isfile(file):
+            num = kmers.estimate_kmers(file, kmer_size)
+        elif os.path.isfile(sources.get(file, ('', 0))[0]):
+            num = kmers.estimate_kmers(file=sources[file][0],
+                                       kmer_size=kmer_size,
+                                       max_records=sources[file][1])
+        else:
+            num = kmers.parse_size(kmers.DEFAULT_HASH_SIZE)
+
+        sizes[file] = max(MIN_HASH_SIZE, int(num * HASH_HEADROOM))
+        if sizes[file] > max_size:
+            warn('"{}" needs a hash of {:,}, capped at {:,} to fit in '
+                 'memory'.format(file, sizes[file], max_size))
+            sizes[file] = max_size
+
+    return sizes
+
+
+# --------------------------------------------------
+def jellyfish_jobs(files, out_dir, kmer_size, hash_size, num_threads,
+                   cache=None, stream_into=None, journal=None,
+                   hash_sizes=None):
+    """
+    Jellyfish jobs for the files that need an index, each with its own
+    hash size (see "jellyfish_hash_sizes"); a file made by one of the
+    "stream_into" subset jobs is piped into Jellyfish by that job
+    """
+
+    import fastx
+    import scheduler
 
     jf_dir = os.path.join(out_dir, 'jellyfish')
     if not os.path.isdir(jf_dir):
         os.makedirs(jf_dir)
 
-    cmd_tmpl = 'jellyfish count -m {} -t {} -s {}'.format(
-        kmer_size, num_threads, hash_size)
+    if hash_sizes is None:
+        hash_sizes = jellyfish_hash_sizes(files, kmer_size, hash_size)
 
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
+    params = {'engine': 'jellyfish', 'kmer_size': kmer_size,
+              'hash_size': hash_size}
+    jobs = []
     for file in files:
-        jf_file = os.path.join(jf_dir, os.path.basename(file))
-        if not os.path.isfile(jf_file):
-            jobfile.write(cmd_tmpl + ' -o {} {}\n'.format(jf_file, file))
+        basename = fastx.sample_name(file)
+        jf_file = os.path.join(jf_dir, basename)
+        name = 'index:' + basename
+        if is_done(journal, name, params, [file], [jf_file]):
+            continue
+
+        on_done = None
+        if cache:
+            # The input may be a subset that is not made yet
+            if os.path.isfile(file) and \
+               cache.get(cache.key('index', file, params), jf_file):
+                continue
+
+            on_done = lambda file=file, jf_file=jf_file: cache.put(
+                cache.key('index', file, params), jf_file)
+
+        on_done = journaled(journal, name, params, [file], [jf_file], on_done)
+
+        # Jellyfish writes a temp file, renamed once it is complete
+        size = hash_sizes[file]
+        count = 'jellyfish count -m {0} -t {1} -s {2} -o {3}.tmp {{}} && ' \
+            'mv {3}.tmp {3}'.format(kmer_size, num_threads, size, jf_file)
+
+        subset_job = (stream_into or {}).get('subset:' + basename)
+        if subset_job:
+            pipe_into(subset_job, count.format('/dev/stdin'), num_threads,
+                      jellyfish_mem(size, kmer_size), on_done)
+            continue
+
+        pipe, file_arg = fastx.stream_input(file, num_threads)
+        jobs.append(
+            scheduler.Job(
+                name=name,
+                cmd=pipe + count.format(file_arg),
+                cpus=num_threads,
+                mem=jellyfish_mem(size, kmer_size),
+                deps=['subset:' + basename],
+                on_done=on_done))
+
+    return jf_dir, jobs
+
+
+# --------------------------------------------------
+@tracing.traced
+def jellyfish_count(files,
+                    out_dir,
+                    kmer_size,
+                    hash_size,
+                    num_threads,
+                    engine='jellyfish',
+                    cache=None):
+    """Use Jellyfish to count kmers in files"""
 
-    jobfile.close()
+    if engine == 'numpy':
+        return numpy_count(files, out_dir, kmer_size, hash_size, num_threads,
+                           cache)[0]
 
-    run_job_file(jobfile=jobfile.name, msg='Counting kmers', num_concurrent=8)
+    jf_dir, jobs = jellyfish_jobs(files, out_dir, kmer_size, hash_size,
+                                  num_threads, cache)
+
+    run_jobs(jobs, msg='Counting kmers')
 
     return jf_dir
 
 
 # --------------------------------------------------
-def pairwise_compare(input_files, jf_dir, out_dir):
-    """Compare all Jellyfish indexes to all the input files"""
+@tracing.traced
+def sketch_input(files, out_dir, kmer_size, sketch_size, num_threads,
+                 journal=None):
+    """MinHash the files, write an approximate similarity matrix"""
 
-    keep_dir = os.path.join(out_dir, 'reads_kept')
-    reject_dir = os.path.join(out_dir, 'reads_rejected')
+    import fastx
+    import sketch
 
-    for dirname in [keep_dir, reject_dir]:
+    sketch_dir = os.path.join(out_dir, 'sketches')
+    figs_dir = os.path.join(out_dir, 'figures')
+    for dirname in [sketch_dir, figs_dir]:
         if not os.path.isdir(dirname):
             os.makedirs(dirname)
 
-    jf_files = [file.path for file in os.scandir(jf_dir) if file.is_file()]
+    start = time.time()
+    params = {'kmer_size': kmer_size, 'sketch_size': sketch_size}
+    todo = [
+        (file, sketch_dir, kmer_size, sketch_size) for file in files
+        if not is_done(journal, 'sketch:' + fastx.sample_name(file), params,
+                       [file], [sketch.sketch_path(sketch_dir, file)])
+    ]
 
-    if not jf_files:
-        die('Found no Jellyfish indexes in "{}"'.format(jf_dir))
+    warn('Sketching (# files = {} @ {})'.format(len(todo), num_threads))
+
+    if todo:
+        with Pool(max(1, min(num_threads, len(todo)))) as pool:
+            for (file, *_), (path, usage) in zip(
+                    todo,
+                    pool.starmap(tracing.measure,
+                                 [(sketch.sketch_file, ) + job
+                                  for job in todo])):
+                name = 'sketch:' + fastx.sample_name(file)
+                tracing.add_task(name, 'sketch_input', usage)
+                if journal:
+                    journal.record(name, params, [file], [path])
+
+    names, sketches = sketch.load_sketches(
+        [sketch.sketch_path(sketch_dir, file) for file in files])
+    sim = sketch.similarity(sketches)
+    sketch.write_matrix(
+        os.path.join(figs_dir, 'matrix_sketch.txt'), names, sim)
+
+    warn('Sketch matrix for {} files in {:.2f}s'.format(
+        len(files), time.time() - start))
+
+    return names, sim
+
+
+# --------------------------------------------------
+def numpy_stream(jobs, out_dir, kmer_size, hash_size, cache=None,
+                 journal=None):
+    """
+    Have the subset jobs tee their output into "kmers.py" as well; a
+    subset being redone always needs its index redone
+    """
+
+    import kmers
+
+    kmer_dir = os.path.join(out_dir, 'kmers')
+    if not os.path.isdir(kmer_dir):
+        os.makedirs(kmer_dir)
+
+    prg = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                       'kmers.py')
+    tmpl = '{} -k {} -s {} -o {} -n {{}} /dev/stdin'.format(
+        prg, kmer_size, hash_size, kmer_dir)
+    params = {'engine': 'numpy', 'kmer_size': kmer_size,
+              'hash_size': hash_size}
+
+    for job in jobs:
+        name = job.name.split(':', 1)[1]
+        index_file = kmers.index_path(kmer_dir, name, name)
+        subset_file = os.path.join(out_dir, 'subset', name)
+
+        on_done = None
+        if cache:
+            on_done = lambda subset_file=subset_file, index_file=index_file: \
+                cache.put(cache.key('index', subset_file, params), index_file)
+
+        pipe_into(job, tmpl.format(name),
+                  on_done=journaled(journal, 'index:' + name, params,
+                                    [subset_file], [index_file], on_done))
+
+    return kmer_dir
+
+
+# --------------------------------------------------
+def numpy_jobs(files, out_dir, kmer_size, hash_size, cache=None,
+               journal=None):
+    """
+    kmers.index_file jobs, run in the scheduler's workers, for the files
+    that need a NumPy index
+    """
+
+    import fastx
+    import kmers
+    import scheduler
+
+    kmer_dir = os.path.join(out_dir, 'kmers')
+    if not os.path.isdir(kmer_dir):
+        os.makedirs(kmer_dir)
+
+    params = {'engine': 'numpy', 'kmer_size': kmer_size,
+              'hash_size': hash_size}
+    max_held = kmers.parse_size(
+        kmers.DEFAULT_HASH_SIZE if hash_size == 'auto' else hash_size)
+    jobs = []
+    for file in files:
+        basename = fastx.sample_name(file)
+        index_file = kmers.index_path(kmer_dir, file)
+        name = 'index:' + basename
+        if is_done(journal, name, params, [file], [index_file]):
+            continue
+
+        on_done = None
+        if cache:
+            key = cache.key('index', file, params)
+            if os.path.isfile(file) and cache.get(key, index_file):
+                continue
+
+            on_done = lambda key=key, index_file=index_file: cache.put(
+                key, index_file)
+
+        # Up to "hash_size" (code, count) pairs, twice over when merging
+        held = min(max_held, kmers.estimate_kmers(file, kmer_size)) \
+            if os.path.isfile(file) else max_held
+        jobs.append(
+            scheduler.Job(
+                name=name,
+                func=kmers.index_file,
+                args=(file, kmer_dir, kmer_size, hash_size),
+                mem=held * 32,
+                deps=['subset:' + basename],
+                on_done=journaled(journal, name, params, [file],
+                                  [index_file], on_done)))
+
+    return kmer_dir, jobs
+
+
+# --------------------------------------------------
+@tracing.traced
+def numpy_count(files, out_dir, kmer_size, hash_size, num_threads,
+                cache=None, journal=None):
+    """
+    Count kmers in-process into sorted NumPy indexes; return (index dir,
+    names of the "index:" jobs that were (re)done)
+    """
+
+    import kmers
 
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
+    kmer_dir, jobs = numpy_jobs(files, out_dir, kmer_size, hash_size, cache,
+                                journal)
 
+    start = time.time()
+    run_jobs(jobs, msg='Counting kmers in-process', max_jobs=num_threads)
+
+    if jobs:
+        for job in jobs:
+            warn(kmers.report(job.result))
+
+        total = sum(job.result['kmers'] for job in jobs)
+        secs = max(time.time() - start, 1e-9)
+        warn('Counted {:,} kmers in {:.2f}s = {:,.0f} kmers/s'.format(
+            total, secs, total / secs))
+
+    return kmer_dir, {job.name for job in jobs}
+
+
+# --------------------------------------------------
+def compare_jobs(input_files,
+                 jf_files,
+                 out_dir,
+                 min_mode=1,
+                 pct_kmer_coverage=10,
+                 skip=None,
+                 index_mem=0,
+                 count_only=False,
+                 journal=None,
+                 redo=None):
+    """
+    query_per_sequence jobs for every (index, query) pair not done (or
+    whose subset/index jobs are in "redo"), storing the reads kept as a
+    bitmap in "kept/<index>.kept" (see kept.py, stored from the
+    scheduler's workers rather than a kept.py per pair) or only writing
+    the number kept to "mode/<index>/<query>"; outputs are renamed (or
+    committed) into place once complete
+    """
+
+    import counts_db
+    import fastx
+    import kept
+    import scheduler
+
+    def index_size(jf_file):
+        """Memory given per index, else its bytes if it exists"""
+        mem = index_mem.get(jf_file) if isinstance(index_mem, dict) else \
+            index_mem
+        if mem or not os.path.isfile(jf_file):
+            return mem or 0
+        return os.path.getsize(jf_file)
+
+    skip = skip or set()
+    redo = redo or set()
+    keep_dir = os.path.join(out_dir, 'mode' if count_only else 'kept')
+    id_dir = os.path.join(keep_dir, 'ids')
+    for dirname in [keep_dir] if count_only else [keep_dir, id_dir]:
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+
+    tmpl = 'query_per_sequence {} {} '.format(min_mode, pct_kmer_coverage)
+    counter = " 2>/dev/null | awk '/^>/ { n++ } END { print n + 0 }'"
+    params = {
+        'min_mode': min_mode,
+        'pct_kmer_coverage': pct_kmer_coverage,
+        'count_only': count_only
+    }
+
+    jobs = []
+    pairs = []
     for jf_file in jf_files:
         index_name = os.path.basename(jf_file)
         keep = os.path.join(keep_dir, index_name)
-        reject = os.path.join(reject_dir, index_name)
+        container = kept.container_path(keep_dir, index_name)
+        stored = {} if count_only or not os.path.isfile(container) else \
+            kept.counts(container)
 
-        for dirname in [keep, reject]:
-            if not os.path.isdir(dirname):
-                os.makedirs(dirname)
+        if count_only and not os.path.isdir(keep):
+            os.makedirs(keep)
 
-        tmpl = 'query_per_sequence 1 10 {} {} 1>{} 2>{}\n'
         for qry_file in input_files:
-            qry_name = os.path.basename(qry_file)
+            qry_name = fastx.sample_name(qry_file)
             keep_file = os.path.join(keep, qry_name)
-            reject_file = os.path.join(reject, qry_name)
+            # Pairs share a container, so the journal checks no outputs
+            outputs = [keep_file] if count_only else []
+            name = 'compare:{}:{}'.format(index_name, qry_name)
+
+            # A streamed index is made by the subset job, not "index:"
+            deps = ['index:' + index_name, 'subset:' + index_name,
+                    'subset:' + qry_name]
+            if (index_name, qry_name) in skip or \
+               (not redo.intersection(deps) and
+                (count_only or qry_name in stored) and
+                is_done(journal, name, params, [jf_file, qry_file],
+                        outputs)):
+                continue
+
+            pipe, qry_arg = fastx.stream_input(qry_file)
+            cmd = pipe + tmpl + '{} {}'.format(jf_file, qry_arg)
+            on_done = journaled(journal, name, params, [jf_file, qry_file],
+                                outputs)
+            pairs.append((index_name, qry_name))
+            if count_only:
+                jobs.append(
+                    scheduler.Job(
+                        name=name,
+                        cmd=cmd + counter + ' > {0}.tmp && mv {0}.tmp {0}'
+                        .format(keep_file),
+                        mem=index_size(jf_file),
+                        deps=deps,
+                        on_done=on_done))
+                continue
+
+            # The rejected reads are the complement of the kept ones
+            jobs.append(
+                scheduler.Job(
+                    name=name,
+                    func=kept.store_pipe,
+                    args=(container, qry_file, cmd + ' 2>/dev/null',
+                          os.path.join(id_dir, qry_name + '.npy')),
+                    mem=index_size(jf_file),
+                    deps=deps,
+                    on_done=on_done))
+
+    # Counts of the pairs being redone are stale
+    if pairs:
+        db = counts_db.connect(os.path.join(out_dir, counts_db.DB_NAME))
+        counts_db.drop_modes(db, pairs)
+        db.close()
+
+    return keep_dir, jobs
+
+
+# --------------------------------------------------
+@tracing.traced
+def pairwise_compare(input_files,
+                     jf_dir,
+                     out_dir,
+                     min_mode=1,
+                     pct_kmer_coverage=10,
+                     skip=None):
+    """Compare all Jellyfish indexes to all the input files"""
 
-            if not os.path.isfile(keep_file):
-                jobfile.write(
-                    tmpl.format(jf_file, qry_file, keep_file, reject_file))
+    jf_files = [file.path for file in os.scandir(jf_dir) if file.is_file()]
+
+    if not jf_files:
+        die('Found no Jellyfish indexes in "{}"'.format(jf_dir))
 
-    jobfile.close()
+    keep_dir, jobs = compare_jobs(input_files, jf_files, out_dir, min_mode,
+                                  pct_kmer_coverage, skip)
 
-    run_job_file(jobfile=jobfile.name, msg='Pairwise comparison')
+    run_jobs(jobs, msg='Pairwise comparison')
 
     return keep_dir
 
 
 # --------------------------------------------------
-def count_kept_reads(keep_dir, out_dir):
-    """Count the kept reads"""
+def numpy_done_pairs(db, index_files, input_files, params, skip=None,
+                     journal=None, redo=None):
+    """
+    The (index, query) pairs to leave alone: skipped, or counted with
+    these parameters and inputs (per the run journal) and with neither
+    subset nor the index in "redo"; the counts of the rest are dropped
+    """
+
+    import counts_db
+    import fastx
+    import kmers
+
+    redo = redo or set()
+    have = counts_db.done_pairs(db)
+    done = set(skip or [])
+    stale = []
+    for index_file in index_files:
+        index_name = kmers.index_name(index_file)
+        for qry_file in input_files:
+            qry_name = fastx.sample_name(qry_file)
+            if (index_name, qry_name) not in have:
+                continue
+
+            deps = ['index:' + index_name, 'subset:' + index_name,
+                    'subset:' + qry_name]
+            name = 'compare:{}:{}'.format(index_name, qry_name)
+            if not redo.intersection(deps) and \
+               is_done(journal, name, params, [index_file, qry_file], []):
+                done.add((index_name, qry_name))
+            else:
+                stale.append((index_name, qry_name))
 
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
-    base_mode_dir = os.path.join(out_dir, 'mode')
+    if stale:
+        counts_db.drop_modes(db, stale)
 
-    for index_dir in os.scandir(keep_dir):
-        index_name = os.path.basename(index_dir)
-        mode_dir = os.path.join(base_mode_dir, index_name)
+    return done
 
-        if not os.path.isdir(mode_dir):
-            os.makedirs(mode_dir)
 
-        for kept in os.scandir(index_dir):
-            out_file = os.path.join(mode_dir, os.path.basename(kept))
-            if not os.path.isfile(out_file):
-                jobfile.write("grep -ce '^>' {} > {}\n".format(
-                    kept.path, out_file))
+# --------------------------------------------------
+def journal_pairs(journal, params, index_files, qry_file, index_names):
+    """Record the pairs of one query just counted in the run journal"""
 
-    jobfile.close()
+    import fastx
 
-    run_job_file(
-        jobfile=jobfile.name, msg='Counting taken seqs', num_concurrent=16)
+    if not journal:
+        return
 
-    return base_mode_dir
+    qry_name = fastx.sample_name(qry_file)
+    for index_name in index_names:
+        journal.record('compare:{}:{}'.format(index_name, qry_name), params,
+                       [index_files[index_name], qry_file], [])
 
 
 # --------------------------------------------------
-def get_input_file_counts(input_files, out_dir):
-    """Count how many sequences were used in the input files"""
+def star_count_block(args):
+    """
+    Unpack a job tuple for index_pack.count_block (for Pool.imap), with
+    the worker's usage for the trace
+    """
 
-    counts_dir = os.path.join(out_dir, 'counts')
-    if not os.path.isdir(counts_dir):
-        os.makedirs(counts_dir)
+    import index_pack
 
-    jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
-    for qry_file in input_files:
-        out_file = os.path.join(counts_dir, os.path.basename(qry_file))
-        if not os.path.isfile(out_file):
-            jobfile.write("grep -ce '^>' {} > {}\n".format(qry_file, out_file))
-    jobfile.close()
+    return tracing.measure(index_pack.count_block, *args)
 
-    run_job_file(
-        jobfile=jobfile.name, msg='Counting input seqs', num_concurrent=16)
 
-    input_counts = {}
-    for count_file in os.scandir(counts_dir):
-        basename = os.path.basename(count_file)
-        num_seqs = int(open(count_file.path).read().rstrip())
-        if num_seqs < 1:
-            die('Cannot have zero-count for input "{}"'.format(basename))
-        input_counts[basename] = num_seqs
-
-    return input_counts
+# --------------------------------------------------
+@tracing.traced
+def numpy_compare(input_files,
+                  kmer_dir,
+                  out_dir,
+                  kmer_size,
+                  min_mode,
+                  pct_kmer_coverage,
+                  num_threads,
+                  skip=None,
+                  index_mem='',
+                  journal=None,
+                  redo=None):
+    """
+    Compare all NumPy indexes to all the input files in-process: the
+    indexes are packed into one mmapped layout shared by the workers
+    and probed a block at a time while every query streams through;
+    return (counts database, (worker seconds, # pairs compared))
+    """
+
+    import counts_db
+    import fastx
+    import index_pack
+    import kmers
+    import scheduler
+
+    skip = skip or set()
+    index_files = sorted(
+        file.path for file in os.scandir(kmer_dir)
+        if file.is_file() and kmers.is_index(file.path))
+
+    if not index_files:
+        die('Found no kmer indexes in "{}"'.format(kmer_dir))
+
+    prefix = index_pack.build(index_files, os.path.join(out_dir, 'index_pack'))
+    sizes = index_pack.index_bytes(prefix)
+    budget = kmers.parse_size(index_mem) if index_mem else \
+        scheduler.available_memory() // 2
+    blocks = index_pack.plan_blocks(sizes, budget)
+
+    db_file = os.path.join(out_dir, counts_db.DB_NAME)
+    db = counts_db.connect(db_file)
+    params = {'engine': 'numpy', 'kmer_size': kmer_size,
+              'min_mode': min_mode, 'pct_kmer_coverage': pct_kmer_coverage}
+    done = numpy_done_pairs(db, index_files, input_files, params, skip,
+                            journal, redo)
+    by_name = {kmers.index_name(file): file for file in index_files}
+
+    # Block-major order keeps each block hot while all queries go by
+    jobs = []
+    task_names = []
+    for num, block in enumerate(blocks):
+        for qry_file in input_files:
+            qry_name = fastx.sample_name(qry_file)
+            todo = [name for name in block if (name, qry_name) not in done]
+            if todo:
+                jobs.append((qry_file, todo, kmer_size, min_mode,
+                             pct_kmer_coverage))
+                task_names.append('block{}:{}'.format(num, qry_name))
+
+    warn('Pairwise comparison in-process (# jobs = {} in {} index block{} '
+         '@ {})'.format(len(jobs), len(blocks), ''
+                        if len(blocks) == 1 else 's', num_threads))
+
+    seconds = 0.
+    read_bytes = max_rss = 0
+    if jobs:
+        with Pool(max(1, min(num_threads, len(jobs))),
+                  initializer=index_pack.init_worker,
+                  initargs=(prefix, )) as pool:
+            for task_name, ((qry_file, kept), usage) in zip(
+                    task_names, pool.imap(star_count_block, jobs)):
+                tracing.add_task(task_name, 'numpy_compare', usage)
+                seconds += usage['wall']
+                read_bytes += usage['read_bytes']
+                max_rss = max(max_rss, usage['max_rss'])
+                qry_name = fastx.sample_name(qry_file)
+                counts_db.put_modes(
+                    db, [(index_name, qry_name, num)
+                         for index_name, num in kept.items()])
+                journal_pairs(journal, params, by_name, qry_file, kept)
+
+        warn('Index pack {:,} bytes; workers read {:,} bytes, '
+             'max RSS {:,} KB'.format(
+                 sum(sizes.values()), read_bytes, max_rss // 1024))
+
+    db.close()
+
+    return db_file, (seconds, sum(len(job[1]) for job in jobs))
 
 
 # --------------------------------------------------
-def matrix_from_mode(mode_dir):
-    """Read all the files in "mode" dir and create count matrix"""
+def star_count_query(args):
+    """
+    Unpack a job tuple for colored.count_query (for Pool.imap), with the
+    worker's usage for the trace
+    """
 
-    mode_files = list(
-        filter(os.path.isfile, glob.iglob(mode_dir + '/**', recursive=True)))
-    print('Creating matrices from {} mode files'.format(len(mode_files)))
+    import colored
 
-    counts = {}
-    for file in sorted(mode_files):
-        index_name = os.path.basename(os.path.dirname(file))
-        qry_name = os.path.basename(file)
-        num = open(file).read().strip()
-        if not index_name in counts:
-            counts[index_name] = {}
-        counts[index_name][qry_name] = int(num)
+    return tracing.measure(colored.count_query, *args)
 
-    return counts
+
+# --------------------------------------------------
+@tracing.traced
+def colored_compare(input_files,
+                    kmer_dir,
+                    out_dir,
+                    kmer_size,
+                    min_mode,
+                    pct_kmer_coverage,
+                    num_threads,
+                    skip=None,
+                    index_mem='',
+                    journal=None,
+                    redo=None):
+    """
+    Merge the NumPy indexes into one colored index, then scan each
+    query once to count the reads every sample keeps (its whole row);
+    return (counts database, (worker seconds, # pairs compared))
+    """
+
+    import colored
+    import counts_db
+    import fastx
+    import kmers
+    import scheduler
+
+    skip = skip or set()
+    index_files = sorted(
+        file.path for file in os.scandir(kmer_dir)
+        if file.is_file() and kmers.is_index(file.path))
+
+    if not index_files:
+        die('Found no kmer indexes in "{}"'.format(kmer_dir))
+
+    colored_dir = os.path.join(out_dir, 'colored')
+    if not os.path.isdir(colored_dir):
+        os.makedirs(colored_dir)
+
+    budget = kmers.parse_size(index_mem) if index_mem else \
+        scheduler.available_memory() // 2
+    prefix = colored.build(index_files, os.path.join(colored_dir, 'index'),
+                           budget)
+    names = [kmers.index_name(file) for file in index_files]
+
+    db_file = os.path.join(out_dir, counts_db.DB_NAME)
+    db = counts_db.connect(db_file)
+    params = {'engine': 'numpy', 'kmer_size': kmer_size,
+              'min_mode': min_mode, 'pct_kmer_coverage': pct_kmer_coverage}
+    done = numpy_done_pairs(db, index_files, input_files, params, skip,
+                            journal, redo)
+    by_name = dict(zip(names, index_files))
+
+    jobs = [(qry_file, kmer_size, min_mode, pct_kmer_coverage)
+            for qry_file in input_files
+            if any((name, fastx.sample_name(qry_file)) not in done
+                   for name in names)]
+
+    warn('Comparing {} queries to a colored index of {} samples '
+         '({:,} bytes) @ {}'.format(len(jobs), len(names),
+                                    colored.index_bytes(prefix),
+                                    num_threads))
+
+    seconds = 0.
+    if jobs:
+        with Pool(max(1, min(num_threads, len(jobs))),
+                  initializer=colored.init_worker,
+                  initargs=(prefix, )) as pool:
+            for (qry_file, kept), usage in pool.imap_unordered(
+                    star_count_query, jobs):
+                qry_name = fastx.sample_name(qry_file)
+                tracing.add_task('scan:' + qry_name, 'colored_compare', usage)
+                seconds += usage['wall']
+                rows = [(index_name, qry_name, num)
+                        for index_name, num in kept.items()
+                        if (index_name, qry_name) not in skip]
+                counts_db.put_modes(db, rows)
+                journal_pairs(journal, params, by_name, qry_file,
+                              [row[0] for row in rows])
+
+    db.close()
+
+    # Each scan compares the query to every sample
+    return db_file, (seconds, len(jobs) * len(names))
 
 
 # --------------------------------------------------
-def make_matrix(input_files, mode_dir, out_dir):
-    """Find all the mode files, create matrix output into "figures" dir"""
+@tracing.traced
+def sharded_compare(index_files,
+                    input_files,
+                    out_dir,
+                    engine,
+                    kmer_size,
+                    min_mode,
+                    pct_kmer_coverage,
+                    num_shards,
+                    runner='local',
+                    num_workers=1,
+                    skip=None):
+    """
+    Compare in tiles written as shard manifests, run them locally or as
+    a SLURM array, merge their counts; return (counts database, (worker
+    seconds, # pairs compared here)), the database None while shards
+    are pending
+    """
+
+    import json
+    import counts_db
+    import shard
+
+    shard_dir = os.path.join(out_dir, 'shards')
+    params = {
+        'engine': engine,
+        'kmer_size': kmer_size,
+        'min_mode': min_mode,
+        'pct_kmer_coverage': pct_kmer_coverage
+    }
+    tiles = shard.make_tiles(index_files, input_files, num_shards)
+    manifests = shard.write_manifests(tiles, shard_dir, params, skip)
+    results = [
+        os.path.join(shard_dir, 'tile_{:04d}.db'.format(num))
+        for num in range(len(manifests))
+    ]
+    pending = [
+        manifest for manifest in manifests if not shard.is_current(manifest)
+    ]
+
+    if pending and runner == 'slurm':
+        script = shard.write_slurm(manifests, shard_dir)
+        warn('{} of {} shards pending, run "sbatch {}" then rerun'.format(
+            len(pending), len(manifests), script))
+        return None, (0., 0)
+
+    seconds = 0.
+    num_pairs = 0
+    if pending:
+        warn('Running {} shards (# workers = {})'.format(
+            len(pending), num_workers))
+        start = time.time()
+        shard.run_local(pending, num_workers)
+        seconds = (time.time() - start) * min(num_workers, len(pending))
+        for manifest in pending:
+            with open(manifest) as fh:
+                tile = json.load(fh)
+            num_pairs += len(tile['indexes']) * len(tile['queries']) - \
+                len(tile['skip'])
+
+    db_file = os.path.join(out_dir, counts_db.DB_NAME)
+    num = shard.merge(db_file, results)
+    warn('Merged {} counts from {} shards'.format(num, len(results)))
+
+    return db_file, (seconds, num_pairs)
 
-    figs_dir = os.path.join(out_dir, 'figures')
-    if not os.path.isdir(figs_dir):
-        os.makedirs(figs_dir)
 
-    input_counts = get_input_file_counts(input_files, out_dir)
-    counts = matrix_from_mode(mode_dir)
+# --------------------------------------------------
+@tracing.traced
+def count_kept_reads(keep_dir, out_dir, counted=False):
+    """
+    Put the number of reads kept per pair into the counts database,
+    from the kept.py containers or ("counted") the "mode" files holding
+    just the number
+    """
+
+    import counts_db
+    import fastx
+    import kept
+
+    db_file = os.path.join(out_dir, counts_db.DB_NAME)
+    db = counts_db.connect(db_file)
+    done = counts_db.done_pairs(db)
+
+    rows = []
+    if counted:
+        for index_dir in os.scandir(keep_dir):
+            index_name = os.path.basename(index_dir)
+            for mode_file in os.scandir(index_dir):
+                qry_name = fastx.sample_name(mode_file.path)
+                if (index_name, qry_name) not in done and \
+                   not mode_file.name.endswith('.tmp'):
+                    with open(mode_file.path) as fh:
+                        rows.append((index_name, qry_name,
+                                     int(fh.read().strip() or 0)))
+    else:
+        for container in os.scandir(keep_dir):
+            if not container.name.endswith(kept.CONTAINER_EXT):
+                continue
+            index_name = container.name[:-len(kept.CONTAINER_EXT)]
+            for qry_name, (_, num_kept) in kept.counts(
+                    container.path).items():
+                if (index_name, qry_name) not in done:
+                    rows.append((index_name, qry_name, num_kept))
+
+    warn('Counting taken seqs (# pairs = {})'.format(len(rows)))
+
+    if rows:
+        counts_db.put_modes(db, rows)
+
+    db.close()
+
+    return db_file
+
+
+# --------------------------------------------------
+@tracing.traced
+def get_input_file_counts(input_files, out_dir, journal=None,
+                          num_threads=1):
+    """
+    Count how many sequences were used in the input files, recounting
+    those changed since they were counted (per the run journal)
+    """
+
+    import counts_db
+    import fastx
+
+    db = counts_db.connect(os.path.join(out_dir, counts_db.DB_NAME))
+    have = counts_db.get_input_counts(db)
+    todo = [
+        file for file in input_files if fastx.sample_name(file) not in have
+        or not is_done(journal, 'count:' + fastx.sample_name(file), {},
+                       [file], [])
+    ]
+
+    warn('Counting input seqs (# files = {} @ {})'.format(
+        len(todo), num_threads))
+
+    # Large files one at a time, split into byte ranges across workers
+    big = [file for file in todo if fastx.splittable(file, num_threads)]
+    small = [file for file in todo
+             if not fastx.splittable(file, num_threads)]
+    nums = [fastx.count_records(file, procs=num_threads) for file in big]
+
+    if small:
+        with Pool(max(1, min(num_threads, len(small)))) as pool:
+            nums.extend(pool.map(fastx.count_records, small))
+
+    if todo:
+        counts_db.put_input_counts(
+            db, [(fastx.sample_name(file), num)
+                 for file, num in zip(big + small, nums)])
+
+    if journal:
+        for file in todo:
+            journal.record('count:' + fastx.sample_name(file), {}, [file], [])
+
+    input_counts = counts_db.get_input_counts(db)
+    db.close()
+
+    for basename, num_seqs in input_counts.items():
+        if num_seqs < 1:
+            die('Cannot have zero-count for input "{}"'.format(basename))
 
-    all_keys = set(counts.keys())
-    for key in all_keys:
-        map(all_keys.add, counts[key].keys())
+    return input_counts
 
-    all_samples = sorted(all_keys)
 
-    raw_fh = open(os.path.join(figs_dir, 'matrix_raw.txt'), 'wt')
-    norm_fh = open(os.path.join(figs_dir, 'matrix_norm.txt'), 'wt')
-    norm_avg_fh = open(os.path.join(figs_dir, 'matrix_norm_avg.txt'), 'wt')
+# --------------------------------------------------
+@tracing.traced
+def make_matrix(input_files, db_file, out_dir, journal=None,
+                num_threads=1):
+    """Read the mode counts, create matrix output into "figures" dir"""
 
-    hdr = '\t'.join([''] + all_samples) + '\n'
-    raw_fh.write(hdr)
-    norm_fh.write(hdr)
-    norm_avg_fh.write(hdr)
+    import matrices
 
-    for qry_name in all_samples:
-        raw = [qry_name]
-        norm = [qry_name]
-        norm_avg = [qry_name]
+    figs_dir = os.path.join(out_dir, 'figures')
+    if not os.path.isdir(figs_dir):
+        os.makedirs(figs_dir)
 
-        for idx_name in all_samples:
-            qry_to_idx = counts[idx_name].get(qry_name, 0)
-            idx_to_qry = counts[qry_name].get(idx_name, 0)
-            norm_idx_to_qry = idx_to_qry / input_counts[idx_name]
-            norm_qry_to_idx = qry_to_idx / input_counts[qry_name]
-            raw.append(str(qry_to_idx))
-            norm.append('{:.6f}'.format(norm_qry_to_idx))
-            norm_avg.append('{:.6f}'.format(
-                (norm_qry_to_idx + norm_idx_to_qry) / 2))
+    input_counts = get_input_file_counts(input_files, out_dir, journal,
+                                         num_threads)
+    names, counts = matrices.from_db(db_file)
+    print('Creating matrices from {} x {} mode counts'.format(
+        len(names), len(names)))
 
-        raw_fh.write('\t'.join(raw) + '\n')
-        norm_fh.write('\t'.join(norm) + '\n')
-        norm_avg_fh.write('\t'.join(norm_avg) + '\n')
+    missing = [name for name in names if name not in input_counts]
+    if missing:
+        die('No input count for "{}"'.format('", "'.join(missing)))
 
-    raw_fh.close()
-    norm_fh.close()
-    norm_avg_fh.close()
+    mats = matrices.normalized(counts, [input_counts[name] for name in names])
+    matrices.save(figs_dir, 'matrix_raw', names, mats['raw'], '%d')
+    matrices.save(figs_dir, 'matrix_norm', names, mats['norm'], '%.6f')
+    matrices.save(figs_dir, 'matrix_norm_avg', names, mats['norm_avg'],
+                  '%.6f')
 
     return figs_dir
 
 
 # --------------------------------------------------
-def make_figures(figures_dir):
-    """Run R program to generate figures"""
+@tracing.traced
+def make_figures(figures_dir, num_scans=20000, num_chains=4, num_procs=1):
+    """
+    Run R program to generate figures, fit GBME in-process (chains in
+    "num_procs" processes) and plot it with "sna.r"
+    """
+
+    import gbme
 
     matrix = os.path.join(figures_dir, 'matrix_norm_avg.txt')
     if not os.path.isfile(matrix):
@@ -344,58 +1290,171 @@ def make_figures(figures_dir):
         '{}/make_figures.r -m {}'.format(curdir, matrix), shell=True)
 
     warn('Running GBME')
-    subprocess.run('{}/sna.r -m {}'.format(curdir, matrix), shell=True)
+    gbme_out = gbme.run(matrix, figures_dir, num_scans=num_scans,
+                        num_chains=num_chains, procs=num_procs)
+    subprocess.run(
+        '{}/sna.r -m {} -g {}'.format(curdir, matrix, gbme_out), shell=True)
 
     return True
 
 
 # --------------------------------------------------
-def subset_input(input_files, out_dir, max_seqs):
-    """Subset the input files, if necessary"""
+def subset_counted(job, db_file, on_done=None):
+    """A subset function job's "on_done" storing how many reads it took"""
+
+    import counts_db
+
+    def done():
+        """Run the job's own callback, then store its count"""
+        if on_done:
+            on_done()
+        out_file, _, num_taken = job.result
+        db = counts_db.connect(db_file)
+        counts_db.put_input_counts(db, [(os.path.basename(out_file),
+                                         num_taken)])
+        db.close()
+
+    return done
+
+
+# --------------------------------------------------
+def subset_jobs(input_files, out_dir, max_seqs, seed=1, cache=None,
+                journal=None, stream=False, num_procs=1):
+    """
+    Jobs for the inputs that need subsetting: "fa_subset.py" commands
+    when streaming (counting/comparing pipe from them), else calls to
+    fa_subset in the scheduler's long-lived workers rather than one
+    interpreter per file
+    """
+
+    import counts_db
+    import fa_subset
+    import fastx
+    import scheduler
+
+    subset_dir = os.path.join(out_dir, 'subset')
+    if not os.path.isdir(subset_dir):
+        os.makedirs(subset_dir)
+
+    curdir = os.path.dirname(os.path.realpath(__file__))
+    prg = os.path.join(curdir, 'fa_subset.py')
+    db_file = os.path.join(out_dir, counts_db.DB_NAME)
+    tmpl = '{} -o {} -n {} -s {} -c {} {}'
+    params = {'max_seqs': max_seqs, 'seed': seed}
 
     subset_files = []
-    if max_seqs > 0:
-        warn('Subsetting input to {}'.format(max_seqs))
-        subset_dir = os.path.join(out_dir, 'subset')
-
-        if not os.path.isdir(subset_dir):
-            os.makedirs(subset_dir)
-
-        jobfile = tmp.NamedTemporaryFile(delete=False, mode='wt')
-        curdir = os.path.dirname(os.path.realpath(__file__))
-        prg = os.path.join(curdir, 'fa_subset.py')
-        tmpl = '{} -o {} -n {} {}\n'
-
-        for input_file in input_files:
-            out_file = os.path.join(subset_dir, os.path.basename(input_file))
-            subset_files.append(out_file)
-            if os.path.isfile(out_file) and os.path.getsize(out_file) > 0:
-                warn('"{}" exists, skipping'.format(out_file))
-            else:
-                jobfile.write(
-                    tmpl.format(prg, subset_dir, max_seqs, input_file))
+    jobs = []
+    for input_file in input_files:
+        basename = fastx.sample_name(input_file)
+        out_file = os.path.join(subset_dir, basename)
+        subset_files.append(out_file)
+        name = 'subset:' + basename
+        if is_done(journal, name, params, [input_file], [out_file]):
+            warn('"{}" exists, skipping'.format(out_file))
+            continue
+
+        on_done = None
+        if cache:
+            key = cache.key('subset', input_file, params)
+            if cache.get(key, out_file):
+                continue
+            on_done = lambda key=key, out_file=out_file: cache.put(
+                key, out_file)
+
+        # The reservoir holds up to max_seqs records (~ 1KB each, at most)
+        mem = min(os.path.getsize(input_file), max_seqs * 1024)
+        if stream:
+            job = scheduler.Job(
+                name=name,
+                cmd=tmpl.format(prg, subset_dir, max_seqs, seed, db_file,
+                                input_file),
+                mem=mem)
+        else:
+            # A large input is counted in byte ranges on "num_procs" CPUs
+            procs = num_procs if fastx.splittable(input_file, num_procs) \
+                else 1
+            job = scheduler.Job(
+                name=name,
+                func=fa_subset.subset_file,
+                args=(input_file, subset_dir, max_seqs, 0, '', 'fasta', seed,
+                      None, procs),
+                cpus=procs,
+                mem=mem)
+            on_done = subset_counted(job, db_file, on_done)
+
+        # Both kinds store the number of reads taken
+        on_done = journaled(journal, 'count:' + basename, {}, [out_file], [],
+                            on_done)
+        job.on_done = journaled(journal, name, params, [input_file],
+                                [out_file], on_done)
+        jobs.append(job)
+
+    return subset_files, jobs
 
-        jobfile.close()
 
-        run_job_file(
-            jobfile.name, msg='Subsetting input files', num_concurrent=16)
-    else:
-        warn('No max_seqs, using input files as-is')
-        subset_files = input_files
+# --------------------------------------------------
+@tracing.traced
+def clear_stale(out_dir, args):
+    """Remove outputs that were made with different parameters"""
+
+    import cache
+    import counts_db
 
-    return subset_files
+    subset_params = {'max_seqs': args.max_seqs, 'seed': args.seed}
+    index_params = dict(
+        subset_params,
+        engine=args.engine,
+        kmer_size=args.kmer_size,
+        hash_size=args.hash_size)
+    sketch_params = dict(
+        subset_params,
+        kmer_size=args.kmer_size,
+        sketch_size=args.sketch_size)
+    compare_params = dict(
+        index_params,
+        min_mode=args.min_mode,
+        pct_kmer_coverage=args.pct_kmer_coverage)
+
+    stages = [
+        ('subset', subset_params, ['subset'], 'input_count'),
+        ('index', index_params, ['jellyfish', 'kmers', 'colored'], None),
+        ('sketch', sketch_params, ['sketches'], None),
+        ('compare', compare_params,
+         ['kept', 'mode', 'shards'], 'mode'),
+    ]
+
+    db = counts_db.connect(os.path.join(out_dir, counts_db.DB_NAME))
+    for stage, params, dirs, table in stages:
+        stamp = os.path.join(out_dir, '.{}.params'.format(stage))
+        if cache.is_stale(stamp, params):
+            warn('Parameters for "{}" changed, removing old output'.format(
+                stage))
+            for dirname in dirs:
+                shutil.rmtree(os.path.join(out_dir, dirname), True)
+            if table:
+                counts_db.clear(db, table)
+    db.close()
 
 
 # --------------------------------------------------
 def main():
     """Start here"""
 
+    import fastx
+
     args = get_args()
     out_dir = os.path.abspath(args.outdir)
 
+    if args.colored and args.engine != 'numpy':
+        die('--colored needs "--engine numpy"')
+
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
+    if args.trace:
+        tracing.enable(os.path.join(out_dir, 'trace'))
+        atexit.register(lambda: warn(tracing.finish()))
+
     input_files = find_input_files(args.query)
 
     num_files = len(input_files)
@@ -405,28 +1464,254 @@ def main():
     if num_files == 0:
         die('No usable files from --query')
 
-    subset_files = subset_input(
-        input_files=input_files, out_dir=out_dir, max_seqs=args.max_seqs)
+    clear_stale(out_dir, args)
+
+    import journal
+    run_journal = journal.Journal(out_dir, verify=args.verify)
+
+    shared_cache = None
+    if args.cache_dir:
+        import cache
+        shared_cache = cache.Cache(args.cache_dir, args.cache_size)
+
+    jobs = []
+    if args.max_seqs > 0:
+        warn('Subsetting input to {}'.format(args.max_seqs))
+        subset_files, jobs = subset_jobs(
+            input_files=input_files,
+            out_dir=out_dir,
+            max_seqs=args.max_seqs,
+            seed=args.seed,
+            cache=shared_cache,
+            journal=run_journal,
+            stream=args.stream,
+            num_procs=args.num_threads)
+    else:
+        warn('No max_seqs, using input files as-is')
+        subset_files = input_files
+
+    # Kept to see what was piped once "jobs" moves on
+    subsetted = jobs
 
     if not subset_files:
         die('Something bad happened while subsetting files')
 
-    jf_dir = jellyfish_count(
-        files=subset_files,
-        out_dir=out_dir,
-        kmer_size=args.kmer_size,
-        hash_size=args.hash_size,
-        num_threads=args.num_threads)
-
-    keep_dir = pairwise_compare(
-        input_files=subset_files, jf_dir=jf_dir, out_dir=out_dir)
-
-    mode_dir = count_kept_reads(keep_dir=keep_dir, out_dir=out_dir)
+    if args.stream and args.engine == 'numpy':
+        numpy_stream(jobs, out_dir, args.kmer_size, args.hash_size,
+                     shared_cache, run_journal)
+
+    # Only the Jellyfish pipeline streams subsets into counting/comparing
+    redone = set()
+    if jobs and (args.engine == 'numpy' or args.prefilter > 0 or
+                 args.approximate):
+        run_jobs(jobs, msg='Subsetting input files', retries=args.retries,
+                 keep_going=args.keep_going)
+        redone = {job.name for job in jobs}
+        jobs = []
+
+    skip = set()
+    if args.prefilter > 0 or args.approximate:
+        import sketch
+
+        names, sim = sketch_input(
+            files=subset_files,
+            out_dir=out_dir,
+            kmer_size=args.kmer_size,
+            sketch_size=args.sketch_size,
+            num_threads=args.num_threads,
+            journal=run_journal)
+
+        if args.approximate:
+            warn('Done, see approximate matrix in "{}"'.format(
+                os.path.join(out_dir, 'figures', 'matrix_sketch.txt')))
+            return
+
+        skip = sketch.skip_pairs(names, sim, args.prefilter)
+        warn('Prefilter will skip {} of {} pairs'.format(
+            len(skip), len(names)**2))
+
+    hash_sizes = None
+    if args.engine == 'jellyfish':
+        hash_sizes = jellyfish_hash_sizes(
+            files=subset_files,
+            kmer_size=args.kmer_size,
+            hash_size=args.hash_size,
+            estimate=args.hash_estimate,
+            sources={
+                subset_file: (input_file, args.max_seqs)
+                for subset_file, input_file in zip(subset_files, input_files)
+            } if args.max_seqs > 0 else None,
+            num_threads=args.num_threads)
+
+    if args.engine == 'numpy':
+        import kmers
+
+        kmer_dir, indexed = numpy_count(
+            files=subset_files,
+            out_dir=out_dir,
+            kmer_size=args.kmer_size,
+            hash_size=args.hash_size,
+            num_threads=args.num_threads,
+            cache=shared_cache,
+            journal=run_journal)
+        redone |= indexed
+
+        index_files = [
+            kmers.index_path(kmer_dir, file) for file in subset_files
+        ]
+
+        if args.colored:
+            db_file, compared = colored_compare(
+                input_files=subset_files,
+                kmer_dir=kmer_dir,
+                out_dir=out_dir,
+                kmer_size=args.kmer_size,
+                min_mode=args.min_mode,
+                pct_kmer_coverage=args.pct_kmer_coverage,
+                num_threads=args.num_threads,
+                skip=skip,
+                index_mem=args.index_mem,
+                journal=run_journal,
+                redo=redone)
+        elif args.shards > 0:
+            db_file, compared = sharded_compare(
+                index_files=index_files,
+                input_files=subset_files,
+                out_dir=out_dir,
+                engine=args.engine,
+                kmer_size=args.kmer_size,
+                min_mode=args.min_mode,
+                pct_kmer_coverage=args.pct_kmer_coverage,
+                num_shards=args.shards,
+                runner=args.shard_runner,
+                num_workers=args.num_threads,
+                skip=skip)
+        else:
+            db_file, compared = numpy_compare(
+                input_files=subset_files,
+                kmer_dir=kmer_dir,
+                out_dir=out_dir,
+                kmer_size=args.kmer_size,
+                min_mode=args.min_mode,
+                pct_kmer_coverage=args.pct_kmer_coverage,
+                num_threads=args.num_threads,
+                skip=skip,
+                index_mem=args.index_mem,
+                journal=run_journal,
+                redo=redone)
+    elif args.shards > 0:
+        jf_dir, count_jobs = jellyfish_jobs(
+            files=subset_files,
+            out_dir=out_dir,
+            kmer_size=args.kmer_size,
+            hash_size=args.hash_size,
+            num_threads=args.num_threads,
+            cache=shared_cache,
+            stream_into={job.name: job
+                         for job in jobs} if args.stream else None,
+            journal=run_journal,
+            hash_sizes=hash_sizes)
+
+        run_jobs(jobs + count_jobs, msg='Subsetting and counting kmers',
+                 retries=args.retries, keep_going=args.keep_going)
+
+        db_file, compared = sharded_compare(
+            index_files=[
+                os.path.join(jf_dir, fastx.sample_name(file))
+                for file in subset_files
+            ],
+            input_files=subset_files,
+            out_dir=out_dir,
+            engine=args.engine,
+            kmer_size=args.kmer_size,
+            min_mode=args.min_mode,
+            pct_kmer_coverage=args.pct_kmer_coverage,
+            num_shards=args.shards,
+            runner=args.shard_runner,
+            num_workers=args.num_threads,
+            skip=skip)
+    else:
+        jf_dir, count_jobs = jellyfish_jobs(
+            files=subset_files,
+            out_dir=out_dir,
+            kmer_size=args.kmer_size,
+            hash_size=args.hash_size,
+            num_threads=args.num_threads,
+            cache=shared_cache,
+            stream_into={job.name: job
+                         for job in jobs} if args.stream else None,
+            journal=run_journal,
+            hash_sizes=hash_sizes)
+
+        keep_dir, pair_jobs = compare_jobs(
+            input_files=subset_files,
+            jf_files=[
+                os.path.join(jf_dir, fastx.sample_name(file))
+                for file in subset_files
+            ],
+            out_dir=out_dir,
+            min_mode=args.min_mode,
+            pct_kmer_coverage=args.pct_kmer_coverage,
+            skip=skip,
+            index_mem={
+                os.path.join(jf_dir, fastx.sample_name(file)):
+                jellyfish_mem(size, args.kmer_size)
+                for file, size in hash_sizes.items()
+            },
+            count_only=args.stream,
+            journal=run_journal,
+            redo={job.name for job in jobs + count_jobs} | redone)
+
+        run_jobs(
+            jobs + count_jobs + pair_jobs,
+            msg='Subsetting, counting kmers and pairwise comparison',
+            retries=args.retries,
+            keep_going=args.keep_going)
+
+        db_file = count_kept_reads(
+            keep_dir=keep_dir, out_dir=out_dir, counted=args.stream)
+
+        ran = [job for job in pair_jobs if job.status == 0]
+        compared = (sum(job.seconds for job in ran), len(ran))
+
+    if shared_cache:
+        warn(shared_cache.report())
+
+    if args.stream:
+        warn('Piped {:,} bytes of subsets into {} as they were written, '
+             'rather than reading them back{}'.format(
+                 piped_bytes(subsetted, out_dir),
+                 'kmers.py' if args.engine == 'numpy' else 'Jellyfish',
+                 '' if args.engine == 'numpy' else
+                 '; counted kept reads in their pipe into "mode"'))
+
+    if db_file is None:
+        return
+
+    # Priced by the compares that ran now, not by earlier runs' pairs
+    seconds, num_compared = compared
+    if skip and num_compared:
+        warn('Prefilter skipped {} of {} pairs, saving ~{:.1f}s of compare '
+             'time ({:.2f}s per pair)'.format(
+                 len(skip), len(subset_files)**2,
+                 seconds / num_compared * len(skip),
+                 seconds / num_compared))
+    elif skip:
+        warn('Prefilter skipped {} of {} pairs'.format(
+            len(skip), len(subset_files)**2))
 
     figures_dir = make_matrix(
-        input_files=subset_files, mode_dir=mode_dir, out_dir=out_dir)
+        input_files=subset_files,
+        db_file=db_file,
+        out_dir=out_dir,
+        journal=run_journal,
+        num_threads=args.num_threads)
 
-    make_figures(figures_dir=figures_dir)
+    make_figures(
+        figures_dir=figures_dir,
+        num_scans=args.num_scans,
+        num_chains=args.num_chains,
+        num_procs=args.num_threads)
 
     warn('Done, see output dir "{}"'.format(out_dir))
 
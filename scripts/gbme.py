@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+"""
+Hoff's generalized bilinear mixed-effects model (gbme.r) for the
+undirected Gaussian case "sna.r" fits, in NumPy: several chains run in a
+process pool and stop once R-hat and the effective sample size say they
+have converged. Writes the same "gbme.out" and "Z" that "sna.r" reads.
+"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+
+GBME_OUT = 'gbme.out'
+Z_OUT = 'Z'
+
+# Converged when every summarized column is under/over these
+MAX_RHAT = 1.01
+MIN_ESS = 400
+
+# Set in each worker by "init_worker" so the model is sent once
+MODEL = None
+
+
+# --------------------------------------------------
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description='Run GBME on a similarity matrix',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        '-m', '--matrix', help='Similarity matrix', metavar='FILE',
+        required=True)
+
+    parser.add_argument(
+        '-o',
+        '--out_dir',
+        help='Output directory (default the matrix dir)',
+        metavar='DIR',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-n',
+        '--num_scans',
+        help='Most scans per chain',
+        metavar='int',
+        type=int,
+        default=20000)
+
+    parser.add_argument(
+        '-c',
+        '--num_chains',
+        help='Number of chains',
+        metavar='int',
+        type=int,
+        default=4)
+
+    parser.add_argument(
+        '-p',
+        '--procs',
+        help='Number of processes',
+        metavar='int',
+        type=int,
+        default=4)
+
+    parser.add_argument(
+        '-s', '--seed', help='Random seed', metavar='int', type=int,
+        default=0)
+
+    return parser.parse_args()
+
+
+# --------------------------------------------------
+def read_matrix(path):
+    """(names, matrix) of a table with a header and row names"""
+
+    with open(path) as fh:
+        lines = [line.split() for line in fh if line.strip()]
+
+    names = [row[0] for row in lines[1:]]
+    matrix = np.array([row[1:] for row in lines[1:]], dtype=float)
+    if matrix.shape != (len(names), len(names)):
+        raise ValueError('"{}" is not a square matrix'.format(path))
+
+    return names, matrix
+
+
+# --------------------------------------------------
+def read_meta(meta_dir, num):
+    """The "*.meta" matrices as dyadic predictors, (num x num x rd)"""
+
+    files = sorted(file for file in os.listdir(meta_dir)
+                   if file.endswith('.meta')) if os.path.isdir(
+                       meta_dir) else []
+
+    xd = np.zeros((num, num, len(files)))
+    for i, file in enumerate(files):
+        _, xd[:, :, i] = read_matrix(os.path.join(meta_dir, file))
+
+    return xd
+
+
+# --------------------------------------------------
+def upper(matrix):
+    """Values above the diagonal, row by row as gbme.r orders dyads"""
+
+    return matrix[np.triu_indices(matrix.shape[0], 1)]
+
+
+# --------------------------------------------------
+def glm_start(y, xd, k):
+    """
+    Starting values and empirical Bayes priors from the least squares
+    fit of y[i, j] ~ s[i] + r[j] + xd[i, j] (gbme.glmstart), made
+    undirected by averaging s and r
+    """
+
+    n, rd = y.shape[0], xd.shape[2]
+    off = 1 - np.eye(n)
+    xs = xd * off[:, :, None]
+
+    # Normal equations of the (n sender, n - 1 receiver, rd) design
+    xtx = np.zeros((2 * n + rd, 2 * n + rd))
+    xtx[:n, :n] = (n - 1) * np.eye(n)
+    xtx[n:2 * n, n:2 * n] = (n - 1) * np.eye(n)
+    xtx[:n, n:2 * n] = off
+    xtx[n:2 * n, :n] = off
+    xtx[:n, 2 * n:] = xs.sum(axis=1)
+    xtx[n:2 * n, 2 * n:] = xs.sum(axis=0)
+    xtx[2 * n:, :n] = xtx[:n, 2 * n:].T
+    xtx[2 * n:, n:2 * n] = xtx[n:2 * n, 2 * n:].T
+    xtx[2 * n:, 2 * n:] = np.tensordot(xs, xs, axes=([0, 1], [0, 1]))
+
+    y = y * off
+    xty = np.concatenate((y.sum(axis=1), y.sum(axis=0),
+                          np.tensordot(xs, y, axes=([0, 1], [0, 1]))))
+
+    keep = np.r_[0:n, n + 1:2 * n + rd]
+    cov = np.linalg.pinv(xtx[np.ix_(keep, keep)])
+    coef = np.insert(cov.dot(xty[keep]), n, 0)
+    s, r, beta_d = coef[:n], coef[n:2 * n], coef[2 * n:]
+
+    res = (y - s[:, None] - r[None, :] - xs.dot(beta_d)) * off
+    res = np.minimum(res, np.percentile(res, 95))
+    np.fill_diagonal(res, 0)
+
+    z = np.zeros((n, k))
+    for _ in range(50 if k > 0 else 0):
+        val, vec = np.linalg.eigh((res + res.T) / 2)
+        top = np.argsort(val)[::-1][:k]
+        z = vec[:, top] * np.sqrt(np.maximum(val[top], 0))
+        np.fill_diagonal(res, (z**2).sum(axis=1))
+
+    err = res - z.dot(z.T)
+    s = (s + r) / 2
+    b0 = 2 * s.mean()
+
+    return {
+        'pi_s2u': (2, np.var(upper(err + err.T), ddof=1)),
+        'pi_s2z': np.column_stack((np.full(k, 2.), (z**2).sum(axis=0) / n)),
+        'pi_s2a': (2, np.var(s - s.mean(), ddof=1)),
+        'pim_bd': beta_d,
+        'pis_bd': (n * (n - 1))**2 * cov[2 * n - 1:, 2 * n - 1:],
+        'pim_b0s': b0,
+        'pis_b0s': 4. * n
+    }, {
+        'beta_d': beta_d,
+        'beta_u': b0,
+        's': s,
+        'z': z
+    }
+
+
+# --------------------------------------------------
+def make_model(y, xd, k):
+    """The data, priors, start and fixed cross-products of a fit"""
+
+    n, rd = y.shape[0], xd.shape[2]
+    y = y.copy()
+    np.fill_diagonal(y, 0)
+    xu = (xd + xd.transpose(1, 0, 2)) * (1 - np.eye(n))[:, :, None]
+    priors, start = glm_start(y, xd, k)
+
+    # Upper-triangle cross-products of the dyad design (Xu, 2 Tu)
+    xu_upper = np.stack([upper(xu[:, :, l]) for l in range(rd)], axis=1) \
+        if rd else np.zeros((n * (n - 1) // 2, 0))
+
+    return {
+        'y': y,
+        'xd': xd,
+        'xu': xu,
+        'k': k,
+        'xtx': xu_upper.T.dot(xu_upper),
+        'xtt': 2 * xu.sum(axis=1),
+        'ipis_bd': np.linalg.inv(priors['pis_bd']) if rd else
+        np.zeros((0, 0)),
+        'priors': priors,
+        'start': start
+    }
+
+
+# --------------------------------------------------
+def columns(model):
+    """Column names of "gbme.out", as gbme.r names them"""
+
+    rd = model['xd'].shape[2]
+    return ['k', 'scan', 'll'] + \
+        ['bd{}'.format(l + 1) for l in range(rd)] + ['b0', 's2a', 's2e'] + \
+        ['s2z{}'.format(l + 1) for l in range(model['k'])]
+
+
+# --------------------------------------------------
+def init_worker(model):
+    """Pool initializer: keep the model once per worker process"""
+
+    global MODEL
+    MODEL = model
+
+
+# --------------------------------------------------
+def run_chain(job):
+    """
+    Run one chain of MODEL for "num_scans" Gibbs scans from its state,
+    return (state, output rows, z of each row) every "odens" scans
+    """
+
+    state, first_scan, num_scans, odens = job
+    model = MODEL
+    y, xd, xu, k = model['y'], model['xd'], model['xu'], model['k']
+    priors = model['priors']
+    n, rd = y.shape[0], xd.shape[2]
+    num_dyads = n * (n - 1) // 2
+    rng = state['rng']
+    beta_d, beta_u = state['beta_d'], state['beta_u']
+    s, z = state['s'], state['z']
+
+    rows, zs = [], []
+    for scan in range(first_scan, first_scan + num_scans):
+        # Error variance
+        w = y - z.dot(z.T)
+        u = w + w.T
+        fit = xu.dot(beta_d) + 2 * (s[:, None] + s[None, :])
+        su = 1 / rng.gamma(
+            priors['pi_s2u'][0] + num_dyads / 2,
+            1 / (priors['pi_s2u'][1] + upper((u - fit)**2).sum() / 2))
+        se = su / 4
+
+        # Variance of the sender effects
+        s2a = 1 / rng.gamma(
+            priors['pi_s2a'][0] + n / 2,
+            1 / (priors['pi_s2a'][1] + ((s - beta_u / 2)**2).sum() / 2))
+
+        # Dyadic coefficients and sender effects jointly; the effects'
+        # precision is c I + v J, so everything but "rd" is closed form
+        c = 1 / s2a + 4 * (n - 2) / su
+        v = 4 / su
+
+        def d_inv(x):
+            return (x - v / (c + n * v) * x.sum(axis=0)) / c
+
+        h_s = beta_u / 2 / s2a + 2 * (u * (1 - np.eye(n))).sum(axis=1) / su
+        if rd:
+            xtt = model['xtt'] / su
+            prec = model['ipis_bd'] + model['xtx'] / su - \
+                xtt.T.dot(d_inv(xtt))
+            h_d = model['ipis_bd'].dot(priors['pim_bd']) + \
+                np.array([upper(xu[:, :, l] * u).sum()
+                          for l in range(rd)]) / su - \
+                xtt.T.dot(d_inv(h_s))
+            chol = np.linalg.cholesky(prec)
+            beta_d = np.linalg.solve(prec, h_d) + np.linalg.solve(
+                chol.T, rng.standard_normal(rd))
+            h_s = h_s - xtt.dot(beta_d)
+
+        noise = rng.standard_normal(n)
+        s = d_inv(h_s) + noise / np.sqrt(c) + \
+            (1 / np.sqrt(c + n * v) - 1 / np.sqrt(c)) * noise.mean()
+
+        # Intercept
+        var_u = 1 / (1 / priors['pis_b0s'] + n / 4 / s2a)
+        beta_u = var_u * (priors['pim_b0s'] / priors['pis_b0s'] +
+                          s.sum() / 2 / s2a) + \
+            np.sqrt(var_u) * rng.standard_normal()
+
+        # Latent positions, one sample at a time in random order
+        sz = np.zeros(0)
+        if k:
+            sz = 1 / rng.gamma(priors['pi_s2z'][:, 0] + n / 2,
+                               1 / (priors['pi_s2z'][:, 1] +
+                                    (z**2).sum(axis=0) / 2))
+            res = y - xd.dot(beta_d) - s[:, None] - s[None, :]
+            np.fill_diagonal(res, 0)
+            ares = (res + res.T) / 2
+            iprior = np.diag(1 / sz)
+            ztz = z.T.dot(z)
+            noise = rng.standard_normal((n, k))
+            for i in rng.permutation(n):
+                ztz -= np.outer(z[i], z[i])
+                prec = iprior + ztz / se
+                chol = np.linalg.cholesky(prec)
+                z[i] = np.linalg.solve(prec, ares[i].dot(z) / se) + \
+                    np.linalg.solve(chol.T, noise[i])
+                ztz += np.outer(z[i], z[i])
+
+        if scan % odens == 0:
+            w = y - z.dot(z.T)
+            u = upper(w + w.T)
+            log_lik = -num_dyads / 2 * np.log(2 * np.pi * su) - \
+                (u**2).sum() / 2 / su
+            rows.append(
+                np.concatenate(([k, scan, log_lik], beta_d,
+                                [beta_u, s2a, se], sz)))
+            zs.append(z.copy())
+
+    state = {'rng': rng, 'beta_d': beta_d, 'beta_u': beta_u, 's': s,
+             'z': z}
+
+    return state, rows, zs
+
+
+# --------------------------------------------------
+def split_chains(draws):
+    """(chains, draws, params) to twice the chains of half the draws"""
+
+    half = draws.shape[1] // 2
+    return np.concatenate((draws[:, :half], draws[:, half:2 * half]))
+
+
+# --------------------------------------------------
+def rhat(draws):
+    """Split R-hat of each parameter in (chains, draws, params)"""
+
+    draws = split_chains(draws)
+    num = draws.shape[1]
+    within = draws.var(axis=1, ddof=1).mean(axis=0)
+    between = num * draws.mean(axis=1).var(axis=0, ddof=1)
+    var_plus = (num - 1) / num * within + between / num
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(within > 0, np.sqrt(var_plus / within), 1.)
+
+
+# --------------------------------------------------
+def ess(draws):
+    """
+    Effective sample size of each parameter in (chains, draws, params)
+    from the split chains' autocorrelations, truncated by Geyer's
+    initial monotone sequence
+    """
+
+    draws = split_chains(draws)
+    chains, num, params = draws.shape
+    centered = draws - draws.mean(axis=1, keepdims=True)
+    spectrum = np.fft.rfft(centered, n=2 * num, axis=1)
+    acov = np.fft.irfft(spectrum * np.conj(spectrum), axis=1)[:, :num] / num
+
+    within = draws.var(axis=1, ddof=1).mean(axis=0)
+    var_plus = (num - 1) / num * within + \
+        draws.mean(axis=1).var(axis=0, ddof=1)
+
+    sizes = np.full(params, float(chains * num))
+    for param in np.flatnonzero(var_plus > 0):
+        rho = 1 - (within[param] - acov[:, :, param].mean(axis=0)) / \
+            var_plus[param]
+        pairs = rho[:num - num % 2].reshape(-1, 2).sum(axis=1)
+        last = np.flatnonzero(pairs <= 0)
+        pairs = np.minimum.accumulate(pairs[:last[0] if len(last) else None])
+        tau = max(-1 + 2 * pairs.sum(), 1 / np.log10(chains * num))
+        sizes[param] = chains * num / tau
+
+    return sizes
+
+
+# --------------------------------------------------
+def monitored(chain_rows, k):
+    """
+    Draws whose convergence is checked over the second half of the
+    scans, the half "sna.r" summarizes: "ll" on, with the "s2z" summed
+    as each one is only identified up to a rotation of z
+    """
+
+    scans = chain_rows[0][:, 1]
+    kept = chain_rows[:, scans > np.round(scans.max() / 2)]
+
+    return np.concatenate(
+        (kept[:, :, 2:kept.shape[2] - k],
+         kept[:, :, kept.shape[2] - k:].sum(axis=2, keepdims=True)), axis=2)
+
+
+# --------------------------------------------------
+def fit(y,
+        xd=None,
+        k=2,
+        num_scans=20000,
+        odens=10,
+        num_chains=4,
+        procs=4,
+        seed=0,
+        check_every=1000,
+        max_rhat=MAX_RHAT,
+        min_ess=MIN_ESS):
+    """
+    Run the chains "check_every" scans at a time until the summarized
+    columns of the second half converge or "num_scans"; return the
+    column names, the rows and z of all chains interleaved by scan,
+    and (scans, max R-hat, min ESS)
+    """
+
+    n = y.shape[0]
+    xd = np.zeros((n, n, 0)) if xd is None else xd
+    model = make_model(y, xd, k)
+    names = columns(model)
+
+    states = []
+    for seq in range(num_chains):
+        state = {key: np.copy(val) for key, val in model['start'].items()}
+        state['rng'] = np.random.RandomState([seed, seq])
+        states.append(state)
+
+    chain_rows = [[] for _ in states]
+    chain_zs = [[] for _ in states]
+    check_every = max(odens, check_every - check_every % odens)
+
+    pool = None
+    if procs > 1 and num_chains > 1:
+        from multiprocessing import Pool
+        pool = Pool(min(procs, num_chains), initializer=init_worker,
+                    initargs=(model, ))
+    else:
+        init_worker(model)
+
+    try:
+        scans, worst_rhat, least_ess = 0, np.inf, 0.
+        while scans < num_scans:
+            todo = min(check_every, num_scans - scans)
+            jobs = [(state, scans + 1, todo, odens) for state in states]
+            results = pool.map(run_chain, jobs) if pool else \
+                list(map(run_chain, jobs))
+            scans += todo
+
+            for num, (state, rows, zs) in enumerate(results):
+                states[num] = state
+                chain_rows[num].extend(rows)
+                chain_zs[num].extend(zs)
+
+            draws = monitored(np.array(chain_rows), k)
+            if draws.shape[1] < 4:
+                continue
+
+            worst_rhat = rhat(draws).max()
+            least_ess = ess(draws).min()
+            if worst_rhat < max_rhat and least_ess >= min_ess:
+                break
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    # Rounded as gbme.r writes them
+    rows = np.round(
+        np.array(chain_rows).transpose(1, 0, 2).reshape(-1, len(names)), 3)
+    zs = np.array(chain_zs).transpose(1, 0, 2, 3).reshape(-1, n, k)
+
+    return names, rows, zs, (scans, worst_rhat, least_ess)
+
+
+# --------------------------------------------------
+def format_num(val, fmt='{:.15g}'):
+    """A number as R's write.table prints it"""
+
+    text = fmt.format(val)
+    return '0' if text == '-0' else text
+
+
+# --------------------------------------------------
+def write_out(out_dir, names, rows, zs):
+    """Write "gbme.out" and "Z" as gbme.r does, return their paths"""
+
+    out_file = os.path.join(out_dir, GBME_OUT)
+    with open(out_file + '.tmp', 'wt') as out_fh:
+        out_fh.write(' '.join(names) + '\n')
+        for row in rows.tolist():
+            out_fh.write(' '.join(map(format_num, row)) + '\n')
+    os.rename(out_file + '.tmp', out_file)
+
+    z_file = os.path.join(out_dir, Z_OUT)
+    with open(z_file + '.tmp', 'wt') as out_fh:
+        for z in zs:
+            for pos in z.tolist():
+                out_fh.write(' '.join(
+                    format_num(val, '{:.3g}') for val in pos) + '\n')
+    os.rename(z_file + '.tmp', z_file)
+
+    return out_file, z_file
+
+
+# --------------------------------------------------
+def summarize(names, rows):
+    """
+    Posterior mean, sd and 2.5/50/97.5% quantiles of the columns after
+    "ll" over the second half of the scans, as "sna.r" prints them
+    """
+
+    scans = rows[:, 1]
+    kept = rows[scans > np.round(scans.max() / 2), 3:]
+    stats = np.vstack((kept.mean(axis=0), kept.std(axis=0, ddof=1),
+                       np.percentile(kept, [2.5, 50, 97.5], axis=0)))
+
+    return names[3:], ['mean', 'sd', '2.5%', '50%', '97.5%'], stats
+
+
+# --------------------------------------------------
+def run(matrix_file, out_dir='', k=2, num_scans=20000, odens=10,
+        num_chains=4, procs=4, seed=0):
+    """
+    Fit the model "sna.r" fits to a matrix (and the "meta" dir next to
+    it) and write its outputs into "out_dir," return "gbme.out"
+    """
+
+    out_dir = out_dir or os.path.dirname(os.path.abspath(matrix_file))
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    _, y = read_matrix(matrix_file)
+    xd = read_meta(os.path.join(out_dir, 'meta'), y.shape[0])
+    start = time.time()
+    names, rows, zs, (scans, worst_rhat, least_ess) = fit(
+        y, xd, k=k, num_scans=num_scans, odens=odens,
+        num_chains=num_chains, procs=procs, seed=seed)
+
+    print('GBME ran {} chain{} x {} scans in {:.1f}s, R-hat {:.3f}, '
+          'ESS {:.0f}'.format(num_chains, '' if num_chains == 1 else 's',
+                              scans, time.time() - start, worst_rhat,
+                              least_ess))
+
+    out_file, _ = write_out(out_dir, names, rows, zs)
+    cols, stats, values = summarize(names, rows)
+    print('\t'.join([''] + cols))
+    for stat, vals in zip(stats, values.tolist()):
+        print('\t'.join([stat] + ['{:.4f}'.format(val) for val in vals]))
+
+    return out_file
+
+
+# --------------------------------------------------
+def main():
+    """Start here"""
+
+    args = get_args()
+
+    if not os.path.isfile(args.matrix):
+        print('--matrix "{}" is not a file'.format(args.matrix),
+              file=sys.stderr)
+        sys.exit(1)
+
+    out_file = run(args.matrix, args.out_dir, num_scans=args.num_scans,
+                   num_chains=args.num_chains, procs=args.procs,
+                   seed=args.seed)
+    print('Done, see "{}"'.format(out_file))
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -2,10 +2,11 @@
 """Extract reads from FASTA based on IDs in file"""
 
 import argparse
+import mmap
 import os
-    
 import sys
-from Bio import SeqIO
+import time
+from multiprocessing import Pool
 
 # --------------------------------------------------
 def get_args():
@@ -14,51 +15,234 @@ def get_args():
         description='Argparse Python script',
         formatter_class=argparse.ArgumentDefaultsHelpFormatter)
 
-    parser.add_argument('-r', '--reads', help='FASTA reads file',
-                        metavar='FILE', type=str, required=True)
+    parser.add_argument('-r', '--reads',
+                        help='FASTA reads file (may be compressed)',
+                        metavar='FILE', type=str, default='')
 
-    parser.add_argument('-i', '--ids', help='IDs file',
-                        metavar='FILE', type=str, required=True)
+    parser.add_argument('-i', '--ids', help='IDs file(s)',
+                        metavar='FILE', type=str, nargs='+', default=[])
 
-    parser.add_argument('-o', '--out', help='Output file',
-                        metavar='DIR', type=str, required=True)
+    parser.add_argument('-o', '--out',
+                        help='Output file, gzipped if it ends in ".gz" '
+                        '(directory for several IDs files)',
+                        metavar='DIR', type=str, default='')
 
-    return parser.parse_args()
+    parser.add_argument('-m', '--manifest',
+                        help='Tab-delimited "reads, IDs, output" lines '
+                        'to extract in a batch',
+                        metavar='FILE', type=str, default='')
+
+    parser.add_argument('-p', '--procs',
+                        help='Worker processes for a batch',
+                        metavar='NUM', type=int, default=os.cpu_count())
+
+    args = parser.parse_args()
+
+    if not args.manifest and not (args.reads and args.ids and args.out):
+        parser.error('Need --reads, --ids and --out, or --manifest')
+
+    return args
 
 # --------------------------------------------------
 def main():
     """main"""
+    import tracing
+
+    # The cold start of a batch counts from the process starting
+    start = tracing.process_start()
     args = get_args()
-    reads_file = args.reads
-    ids_file = args.ids
-    out_file = args.out
 
-    if not os.path.isfile(reads_file):
-        print('--reads "{}" is not a file'.format(reads_file))
-        sys.exit(1)
+    tasks = []
+    if args.reads:
+        if len(args.ids) == 1:
+            out_files = [args.out]
+        else:
+            out_files = [os.path.join(args.out, os.path.basename(ids_file))
+                         for ids_file in args.ids]
+        tasks.append((args.reads, args.ids, out_files))
+
+    if args.manifest:
+        tasks.extend(read_manifest(args.manifest))
+
+    num_failed = 0
+    first_done = None
+    for reads_file, out_files, result, error in extract_files(tasks,
+                                                              args.procs):
+        first_done = first_done or time.time()
+        if error:
+            print(error)
+            num_failed += 1
+            continue
+
+        checked, took = result
+        for out_file, num in zip(out_files, took):
+            print('Done, checked {} took {}, see {}'.format(
+                checked, num, out_file))
 
-    if not os.path.isfile(ids_file):
-        print('--ids "{}" is not a file'.format(ids_file))
+    if len(tasks) > 1:
+        now = time.time()
+        print('Extracted from {} files in {:.2f}s, first done after {:.2f}s '
+              '({:.1f} files/s)'.format(len(tasks), now - start,
+                                        (first_done or now) - start,
+                                        len(tasks) / max(now - start, 1e-9)))
+
+    if num_failed:
         sys.exit(1)
 
-    out_dir = os.path.dirname(os.path.abspath(out_file))
-    if not os.path.isdir(out_dir):
-        os.makedirs(out_dir)
+# --------------------------------------------------
+def read_manifest(manifest):
+    """
+    (reads, [IDs files], [output files]) from "reads, IDs, output" lines,
+    grouped so each reads file is read once for all of its outputs
+    """
+    by_reads = {}
+    with open(manifest) as fh:
+        for line in fh:
+            if not line.strip() or line.startswith('#'):
+                continue
+            reads_file, ids_file, out_file = line.rstrip('\n').split('\t')
+            ids_files, out_files = by_reads.setdefault(reads_file, ([], []))
+            ids_files.append(ids_file)
+            out_files.append(out_file)
+
+    return [(reads_file, ids_files, out_files)
+            for reads_file, (ids_files, out_files) in by_reads.items()]
+
+# --------------------------------------------------
+def extract_file(reads_file, ids_files, out_files, procs=1):
+    """
+    write the records of "reads_file" named in each IDs file to its
+    output file, return (records checked, counts); the offset index of
+    a large plain file is built in "procs" byte ranges at once; raise
+    ValueError for missing inputs
+    """
+    import fastx
+
+    if not os.path.isfile(reads_file):
+        raise ValueError('--reads "{}" is not a file'.format(reads_file))
+
+    for ids_file in ids_files:
+        if not os.path.isfile(ids_file):
+            raise ValueError('--ids "{}" is not a file'.format(ids_file))
+
+    for out_file in out_files:
+        out_dir = os.path.dirname(os.path.abspath(out_file))
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir, exist_ok=True)
 
+    wanted = [read_ids(ids_file) for ids_file in ids_files]
+    if fastx.compression(reads_file):
+        return stream_extract(reads_file, wanted, out_files)
+
+    offsets = fastx.load_offsets(reads_file, procs)
+    return len(offsets), extract(reads_file, offsets, wanted, out_files)
+
+# --------------------------------------------------
+def extract_task(task):
+    """
+    Pool worker: "extract_file" on one (reads, IDs files, outputs, procs),
+    return (reads, outputs, result or None, error or None)
+    """
+    reads_file, ids_files, out_files, procs = task
+    try:
+        return (reads_file, out_files,
+                extract_file(reads_file, ids_files, out_files, procs), None)
+    except (OSError, ValueError) as err:
+        return reads_file, out_files, None, str(err)
+
+# --------------------------------------------------
+def extract_files(tasks, procs=None):
+    """
+    Extract from many reads files in a pool of long-lived workers (one
+    interpreter start and import per worker, not per file), yielding
+    "extract_task" results as they finish
+    """
+    import fastx
+
+    procs = procs or os.cpu_count()
+
+    # Large files one at a time with all the workers on their byte ranges
+    for task in tasks:
+        if fastx.splittable(task[0], procs):
+            yield extract_task(task + (procs, ))
+
+    tasks = [task + (1, ) for task in tasks
+             if not fastx.splittable(task[0], procs)]
+    if len(tasks) < 2 or procs == 1:
+        yield from map(extract_task, tasks)
+        return
+
+    with Pool(min(procs, len(tasks))) as pool:
+        yield from pool.imap_unordered(extract_task, tasks)
+
+# --------------------------------------------------
+def read_ids(ids_file):
+    """set of IDs in a file, one per line"""
     take_id = set()
     for line in open(ids_file):
         take_id.add(line.rstrip().split(' ')[0]) # remove anything after " "
 
+    return take_id
+
+# --------------------------------------------------
+def extract(reads_file, offsets, wanted, out_files):
+    """
+    copy the raw bytes of the wanted records of each output in one
+    sequential pass over the mapped reads file, return the counts
+    """
+    import fastx
+
+    spans = []
+    for out_num, take_id in enumerate(wanted):
+        found = fastx.find_offsets(offsets, take_id)
+        spans.extend((int(offset), int(length), out_num)
+                     for offset, length in found)
+    spans.sort()
+
+    took = [0] * len(out_files)
+    out_fhs = [fastx.open_output(out_file) for out_file in out_files]
+    try:
+        if spans:
+            with open(reads_file, 'rb') as fh:
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    for offset, length, out_num in spans:
+                        if fastx.span_id(mm, offset) not in wanted[out_num]:
+                            continue
+                        record = mm[offset:offset + length]
+                        if not record.endswith(b'\n'):
+                            record += b'\n'
+                        out_fhs[out_num].write(record)
+                        took[out_num] += 1
+    finally:
+        for out_fh in out_fhs:
+            out_fh.close()
+
+    return took
+
+# --------------------------------------------------
+def stream_extract(reads_file, wanted, out_files):
+    """
+    compressed reads cannot be mapped, so decompress them in one pass
+    and check every record, return (records checked, counts)
+    """
+    import fastx
+
     checked = 0
-    took = 0
-    with open(out_file, "wt") as out_fh:
-        for record in SeqIO.parse(reads_file, "fasta"):
+    took = [0] * len(out_files)
+    out_fhs = [fastx.open_output(out_file) for out_file in out_files]
+    try:
+        for record in fastx.read_records(reads_file):
             checked += 1
-            if record.id in take_id:
-                SeqIO.write(record, out_fh, "fasta")
-                took += 1
+            read_id = fastx.span_id(record, 0)
+            for out_num, take_id in enumerate(wanted):
+                if read_id in take_id:
+                    out_fhs[out_num].write(record)
+                    took[out_num] += 1
+    finally:
+        for out_fh in out_fhs:
+            out_fh.close()
 
-    print('Done, checked {} took {}, see {}'.format(checked, took, out_file))
+    return checked, took
 
 # --------------------------------------------------
 if __name__ == '__main__':
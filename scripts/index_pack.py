@@ -0,0 +1,143 @@
+"""All NumPy kmer indexes packed into one read-only, mmapped layout"""
+
+import json
+import os
+import numpy as np
+import kmers
+
+MAX_COUNT = np.iinfo(np.uint32).max
+
+# Set in each worker by "init_worker" so the pack is opened once
+PACK = None
+
+
+# --------------------------------------------------
+def pack_files(prefix):
+    """The (codes, counts, meta) files for a pack prefix"""
+
+    return prefix + '.codes.npy', prefix + '.counts.npy', prefix + '.json'
+
+
+# --------------------------------------------------
+def build(index_files, prefix):
+    """
+    Concatenate the indexes into one uint64 codes array and one uint32
+    (saturating) counts array; reuse the pack if nothing changed
+    """
+
+    codes_file, counts_file, meta_file = pack_files(prefix)
+    sources = [[kmers.index_name(file), os.path.getsize(file),
+                os.path.getmtime(file)] for file in sorted(index_files)]
+
+    if os.path.isfile(meta_file):
+        with open(meta_file) as fh:
+            if json.load(fh)['sources'] == sources:
+                return prefix
+
+    sizes = [kmers.load_index(file)[0].shape[0]
+             for file in sorted(index_files)]
+    offsets = np.concatenate(([0], np.cumsum(sizes))).tolist()
+
+    codes = np.lib.format.open_memmap(
+        codes_file + '.tmp', mode='w+', dtype=np.uint64,
+        shape=(offsets[-1], ))
+    counts = np.lib.format.open_memmap(
+        counts_file + '.tmp', mode='w+', dtype=np.uint32,
+        shape=(offsets[-1], ))
+
+    for i, file in enumerate(sorted(index_files)):
+        idx_codes, idx_counts = kmers.load_index(file)
+        codes[offsets[i]:offsets[i + 1]] = idx_codes
+        counts[offsets[i]:offsets[i + 1]] = np.minimum(idx_counts, MAX_COUNT)
+
+    del codes, counts
+    os.rename(codes_file + '.tmp', codes_file)
+    os.rename(counts_file + '.tmp', counts_file)
+
+    with open(meta_file + '.tmp', 'wt') as out_fh:
+        json.dump({
+            'names': [name for name, _, _ in sources],
+            'offsets': offsets,
+            'sources': sources
+        }, out_fh)
+    os.rename(meta_file + '.tmp', meta_file)
+
+    return prefix
+
+
+# --------------------------------------------------
+def open_pack(prefix):
+    """Map a pack read-only, return {name: (codes, counts)} views"""
+
+    codes_file, counts_file, meta_file = pack_files(prefix)
+    with open(meta_file) as fh:
+        meta = json.load(fh)
+
+    codes = np.load(codes_file, mmap_mode='r')
+    counts = np.load(counts_file, mmap_mode='r')
+    offsets = meta['offsets']
+
+    return {
+        name: (codes[offsets[i]:offsets[i + 1]],
+               counts[offsets[i]:offsets[i + 1]])
+        for i, name in enumerate(meta['names'])
+    }
+
+
+# --------------------------------------------------
+def index_bytes(prefix):
+    """{name: bytes} of each packed index"""
+
+    with open(pack_files(prefix)[2]) as fh:
+        meta = json.load(fh)
+
+    offsets = meta['offsets']
+    return {
+        name: (offsets[i + 1] - offsets[i]) * 12
+        for i, name in enumerate(meta['names'])
+    }
+
+
+# --------------------------------------------------
+def plan_blocks(sizes, budget):
+    """
+    Group index names into consecutive blocks of at most "budget" bytes
+    (a bigger index gets a block to itself)
+    """
+
+    blocks = []
+    block = []
+    total = 0
+    for name in sorted(sizes):
+        if block and total + sizes[name] > budget:
+            blocks.append(block)
+            block = []
+            total = 0
+        block.append(name)
+        total += sizes[name]
+
+    if block:
+        blocks.append(block)
+
+    return blocks
+
+
+# --------------------------------------------------
+def init_worker(prefix):
+    """Pool initializer: map the pack once per worker process"""
+
+    global PACK
+    PACK = open_pack(prefix)
+
+
+# --------------------------------------------------
+def count_block(qry_file, names, kmer_size, min_mode, pct_kmer_coverage):
+    """Probe one block of packed indexes with a query, without copying"""
+
+    import compare
+
+    kept, _ = compare.count_kept_indexes(
+        qry_file, [(name, PACK[name]) for name in names], kmer_size, min_mode,
+        pct_kmer_coverage)
+
+    return qry_file, kept
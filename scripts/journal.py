@@ -0,0 +1,118 @@
+"""Run journal: finished jobs with their parameters and output checksums"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+JOURNAL_NAME = 'journal.db'
+
+SCHEMA = """
+    create table if not exists job (
+        name text primary key,
+        params text not null,
+        outputs text not null,
+        finished real not null
+    ) without rowid;
+"""
+
+
+# --------------------------------------------------
+def checksum(path, chunk_size=2**20):
+    """BLAKE2b of a file"""
+
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+# --------------------------------------------------
+def describe(path, with_checksum=True):
+    """[size, mtime, checksum] of an output"""
+
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime,
+            checksum(path) if with_checksum else None]
+
+
+# --------------------------------------------------
+def params_key(params, inputs):
+    """Stable string for job parameters and the state of its inputs"""
+
+    return json.dumps({
+        'params': params,
+        'inputs': {
+            path: describe(path, False)[:2]
+            for path in inputs if os.path.isfile(path)
+        }
+    }, sort_keys=True)
+
+
+# --------------------------------------------------
+class Journal:
+    """
+    Jobs are recorded only after their outputs were renamed into place,
+    so a job is done when its parameters are unchanged and its outputs
+    are still the ones recorded; anything else is redone
+    """
+
+    def __init__(self, out_dir, verify=False):
+        self.path = os.path.join(out_dir, JOURNAL_NAME)
+        self.verify = verify
+        # Jobs are recorded from the scheduler's callback thread
+        self.db = sqlite3.connect(self.path, timeout=60,
+                                  check_same_thread=False)
+        self.db.execute('pragma journal_mode=wal')
+        self.db.execute('pragma synchronous=normal')
+        self.db.executescript(SCHEMA)
+
+    def record(self, name, params, inputs, outputs):
+        """Record a finished job, its parameters, inputs and outputs"""
+
+        described = {path: describe(path) for path in outputs
+                     if os.path.isfile(path)}
+        with self.db:
+            self.db.execute('insert or replace into job values (?, ?, ?, ?)',
+                            (name, params_key(params, inputs),
+                             json.dumps(described), time.time()))
+
+    def is_done(self, name, params, inputs, outputs):
+        """
+        Did "name" finish with these parameters and inputs (by size and
+        mtime), and are its outputs intact? (size and mtime, plus the
+        checksum if verifying)
+        """
+
+        if not all(os.path.isfile(path) for path in inputs):
+            return False
+
+        row = self.db.execute(
+            'select params, outputs from job where name = ?',
+            (name, )).fetchone()
+        if not row or row[0] != params_key(params, inputs):
+            return False
+
+        recorded = json.loads(row[1])
+        for path in outputs:
+            if path not in recorded or not os.path.isfile(path):
+                return False
+
+            size, mtime, digest = recorded[path]
+            now = describe(path, self.verify)
+            if now[:2] != [size, mtime] or \
+               (self.verify and now[2] != digest):
+                return False
+
+        return True
+
+    def close(self):
+        """Close the journal database"""
+
+        self.db.close()
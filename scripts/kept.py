@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Kept reads as compressed bitmaps of record ordinals in the query, one
+SQLite container per index; the reads themselves are extracted on demand
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import zlib
+import numpy as np
+import fastx
+
+CONTAINER_EXT = '.kept'
+
+SCHEMA = """
+    create table if not exists kept (
+        query_name text primary key,
+        num_reads integer not null,
+        num_kept integer not null,
+        runs blob not null
+    ) without rowid;
+"""
+
+
+# --------------------------------------------------
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description='Store or extract the reads an index kept from a query',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        'container', help='Container of one index', metavar='FILE')
+
+    parser.add_argument(
+        '-q',
+        '--query',
+        help='Query file the reads came from',
+        metavar='FILE',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-s',
+        '--store',
+        help='Store the kept reads (FASTA/Q) read from this file',
+        metavar='FILE',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-t',
+        '--id_table',
+        help='Cache of the query read IDs for --store',
+        metavar='FILE',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-o',
+        '--out',
+        help='Write the kept reads here, gzipped if it ends in ".gz"',
+        metavar='FILE',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-r',
+        '--rejected',
+        help='Write the rejected reads instead',
+        action='store_true')
+
+    args = parser.parse_args()
+
+    if (args.store or args.out) and not args.query:
+        parser.error('--store and --out need --query')
+
+    return args
+
+
+# --------------------------------------------------
+def container_path(keep_dir, index_name):
+    """Where the container of an index lives"""
+
+    return os.path.join(keep_dir, index_name + CONTAINER_EXT)
+
+
+# --------------------------------------------------
+def connect(path):
+    """Open (creating if needed) a container in WAL mode"""
+
+    db = sqlite3.connect(path, timeout=60)
+    db.execute('pragma journal_mode=wal')
+    db.execute('pragma synchronous=normal')
+    db.executescript(SCHEMA)
+
+    return db
+
+
+# --------------------------------------------------
+def encode(ordinals):
+    """
+    Sorted unique ordinals as whichever deflates smaller (as Roaring
+    picks per container): runs, alternating gaps and run lengths as
+    uint32 ("R"), or a plain bitmap ("B") for scattered ordinals
+    """
+
+    ordinals = np.asarray(ordinals, dtype=np.int64)
+    if len(ordinals) == 0:
+        return b'R' + zlib.compress(b'')
+
+    breaks = np.flatnonzero(np.diff(ordinals) != 1) + 1
+    starts = ordinals[np.concatenate(([0], breaks))]
+    lengths = np.diff(np.concatenate(([0], breaks, [len(ordinals)])))
+    gaps = starts - np.concatenate(([0], (starts + lengths)[:-1]))
+
+    runs = np.empty(2 * len(starts), dtype='<u4')
+    runs[0::2] = gaps
+    runs[1::2] = lengths
+    encoded = b'R' + zlib.compress(runs.tobytes(), 6)
+
+    # Runs are 8 bytes each, a bitmap 1 bit per ordinal up to the last
+    if 64 * len(starts) > ordinals[-1] + 1:
+        bits = np.zeros(ordinals[-1] + 1, dtype=bool)
+        bits[ordinals] = True
+        packed = b'B' + zlib.compress(np.packbits(bits).tobytes(), 6)
+        if len(packed) < len(encoded):
+            return packed
+
+    return encoded
+
+
+# --------------------------------------------------
+def decode(blob):
+    """The sorted ordinals in an "encode"d bitmap"""
+
+    data = zlib.decompress(blob[1:])
+    if blob[:1] == b'B':
+        return np.flatnonzero(
+            np.unpackbits(np.frombuffer(data, dtype=np.uint8))).astype(
+                np.int64)
+
+    runs = np.frombuffer(data, dtype='<u4').astype(np.int64)
+    if len(runs) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    gaps, lengths = runs[0::2], runs[1::2]
+    starts = np.cumsum(gaps + np.concatenate(([0], lengths[:-1])))
+    steps = np.arange(lengths.sum()) - np.repeat(
+        np.cumsum(lengths) - lengths, lengths)
+
+    return np.repeat(starts, lengths) + steps
+
+
+# --------------------------------------------------
+def id_table(path, cache=''):
+    """
+    ID hashes of a query's reads sorted (stably) with their ordinals,
+    as a (n x 2) uint64 array, saved to "cache" if given
+    """
+
+    if cache and os.path.isfile(cache) and \
+       os.path.getmtime(cache) >= os.path.getmtime(path):
+        return np.load(cache)
+
+    if fastx.mappable(path):
+        hashes = fastx.span_table(path, fastx.guess_format(path), 0,
+                                  os.path.getsize(path))[:, 0]
+    else:
+        hashes = np.array(
+            [fastx.id_hash(fastx.span_id(record, 0))
+             for record in fastx.read_records(path)], dtype=np.uint64)
+
+    order = np.argsort(hashes, kind='mergesort')
+    table = np.stack((hashes[order], order.astype(np.uint64)), axis=1)
+
+    if cache:
+        tmp = '{}.{}.tmp'.format(cache, os.getpid())
+        with open(tmp, 'wb') as out_fh:
+            np.save(out_fh, table)
+        os.rename(tmp, cache)
+
+    return table
+
+
+# --------------------------------------------------
+def ordinals_of(read_ids, table):
+    """
+    Ordinals of reads by ID in an "id_table," the n-th read with an ID
+    taken as the n-th record with it so repeated IDs each count once
+    """
+
+    hashes = np.array(sorted(map(fastx.id_hash, read_ids)), dtype=np.uint64)
+    if len(hashes) == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    first = np.searchsorted(table[:, 0], hashes, side='left')
+    last = np.searchsorted(table[:, 0], hashes, side='right')
+    repeat = np.arange(len(hashes)) - np.searchsorted(hashes, hashes,
+                                                      side='left')
+    pos = first + repeat
+    if np.any(pos >= last):
+        raise ValueError('Kept read IDs are not all in the query')
+
+    return np.sort(table[pos, 1].astype(np.int64))
+
+
+# --------------------------------------------------
+def store(container, query_file, reads_file, id_cache=''):
+    """Record the reads kept from "query_file," return the number kept"""
+
+    return store_ids(container, query_file,
+                     [fastx.span_id(record, 0)
+                      for record in fastx.read_records(reads_file)],
+                     id_cache)
+
+
+# --------------------------------------------------
+def store_pipe(container, query_file, cmd, id_cache=''):
+    """
+    "store" the reads a shell pipeline (e.g. query_per_sequence) writes
+    to STDOUT, in this process rather than a kept.py per pair; nothing
+    is stored and CalledProcessError is raised if the pipeline fails
+    """
+
+    bash = shutil.which('bash')
+    shell = [bash, '-o', 'pipefail'] if bash else ['/bin/sh']
+    with subprocess.Popen(shell + ['-c', cmd],
+                          stdout=subprocess.PIPE) as proc:
+        read_ids = [fastx.span_id(record, 0)
+                    for record in fastx.handle_records(proc.stdout)]
+
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+    return store_ids(container, query_file, read_ids, id_cache)
+
+
+# --------------------------------------------------
+def store_ids(container, query_file, read_ids, id_cache=''):
+    """Record the reads kept from "query_file" by their IDs"""
+
+    table = id_table(query_file, id_cache)
+    ordinals = ordinals_of(read_ids, table)
+
+    db = connect(container)
+    with db:
+        db.execute('insert or replace into kept values (?, ?, ?, ?)',
+                   (fastx.sample_name(query_file), len(table), len(ordinals),
+                    encode(ordinals)))
+    db.close()
+
+    return len(ordinals)
+
+
+# --------------------------------------------------
+def counts(container):
+    """{query name: (num reads, num kept)} in a container"""
+
+    db = connect(container)
+    rows = db.execute(
+        'select query_name, num_reads, num_kept from kept').fetchall()
+    db.close()
+
+    return {name: (num_reads, num_kept) for name, num_reads, num_kept in rows}
+
+
+# --------------------------------------------------
+def get(container, query_name, rejected=False):
+    """The sorted ordinals kept (or "rejected") from a query"""
+
+    db = connect(container)
+    row = db.execute('select num_reads, runs from kept where query_name = ?',
+                     (query_name, )).fetchone()
+    db.close()
+
+    if not row:
+        raise KeyError('No reads of "{}" in "{}"'.format(query_name,
+                                                         container))
+
+    ordinals = decode(row[1])
+    if rejected:
+        return np.setdiff1d(np.arange(row[0]), ordinals, assume_unique=True)
+
+    return ordinals
+
+
+# --------------------------------------------------
+def extract(container, query_file, out_file, rejected=False):
+    """
+    Write the reads an index kept (or "rejected") from a query as they
+    are in the query file, return the number written
+    """
+
+    ordinals = get(container, fastx.sample_name(query_file), rejected)
+
+    with fastx.open_output(out_file) as out_fh:
+        if fastx.mappable(query_file):
+            data = fastx.map_file(query_file)
+            try:
+                starts, ends = fastx.record_bounds(
+                    data, fastx.guess_format(query_file))
+                for start, end in zip(starts[ordinals].tolist(),
+                                      ends[ordinals].tolist()):
+                    record = data[start:end]
+                    out_fh.write(record if record.endswith(b'\n') else
+                                 record + b'\n')
+            finally:
+                data.close()
+        else:
+            wanted = iter(ordinals.tolist())
+            next_take = next(wanted, None)
+            for num, record in enumerate(fastx.read_records(query_file)):
+                if num == next_take:
+                    out_fh.write(record)
+                    next_take = next(wanted, None)
+
+    return len(ordinals)
+
+
+# --------------------------------------------------
+def main():
+    """Start here"""
+
+    args = get_args()
+
+    if args.store:
+        num = store(args.container, args.query, args.store, args.id_table)
+        print('Stored {} kept read{} of "{}"'.format(
+            num, '' if num == 1 else 's', args.query))
+    elif args.out:
+        try:
+            num = extract(args.container, args.query, args.out,
+                          args.rejected)
+        except KeyError as err:
+            print(err.args[0], file=sys.stderr)
+            sys.exit(1)
+        print('Wrote {} {} read{} to "{}"'.format(
+            num, 'rejected' if args.rejected else 'kept',
+            '' if num == 1 else 's', args.out))
+    else:
+        for name, (num_reads, num_kept) in sorted(
+                counts(args.container).items()):
+            print('{}\t{}\t{}'.format(name, num_kept, num_reads))
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
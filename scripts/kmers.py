@@ -0,0 +1,477 @@
+#!/usr/bin/env python3
+"""In-process k-mer counting with NumPy"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+import fastx
+
+INDEX_EXT = '.npy'
+MAX_KMER_SIZE = 32
+
+# What "--hash_size auto" holds in memory before spilling
+DEFAULT_HASH_SIZE = '100M'
+
+# Rough compression ratio of sequence files, to size them unpacked
+COMPRESSED_RATIO = 4
+
+# HyperLogLog registers (2^HLL_BITS) for estimating distinct kmers
+HLL_BITS = 14
+
+# ASCII -> 2-bit code, anything that is not ACGT is 4
+BASE_CODE = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate([b'Aa', b'Cc', b'Gg', b'Tt']):
+    for _base in _bases:
+        BASE_CODE[_base] = _code
+
+
+# --------------------------------------------------
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description='Count canonical kmers into sorted NumPy indexes',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        'file', help='FASTA/Q input file(s)', metavar='FILE', nargs='+')
+
+    parser.add_argument(
+        '-o',
+        '--out_dir',
+        help='Output directory',
+        metavar='DIR',
+        type=str,
+        default='kmers')
+
+    parser.add_argument(
+        '-k',
+        '--kmer_size',
+        help='Kmer size',
+        metavar='int',
+        type=int,
+        default=20)
+
+    parser.add_argument(
+        '-s',
+        '--hash_size',
+        help='Distinct kmers held in memory before spilling to disk',
+        metavar='str',
+        type=str,
+        default='100M')
+
+    parser.add_argument(
+        '-b',
+        '--batch_size',
+        help='Number of bases encoded per batch',
+        metavar='int',
+        type=int,
+        default=4000000)
+
+    parser.add_argument(
+        '-n',
+        '--name',
+        help='Sample name for a single input, e.g., /dev/stdin',
+        metavar='str',
+        type=str,
+        default='')
+
+    return parser.parse_args()
+
+
+# --------------------------------------------------
+def parse_size(size):
+    """Turn a Jellyfish-style size ("100M", "2G") into an int"""
+
+    suffixes = {'k': 10**3, 'm': 10**6, 'g': 10**9, 't': 10**12}
+    size = str(size).strip()
+    mult = suffixes.get(size[-1:].lower())
+    if mult:
+        return int(float(size[:-1]) * mult)
+
+    return int(size)
+
+
+# --------------------------------------------------
+def index_path(out_dir, file, name=None):
+    """Location of the index for an input file (or sample name)"""
+
+    return os.path.join(out_dir, (name or fastx.sample_name(file)) + INDEX_EXT)
+
+
+# --------------------------------------------------
+def index_name(path):
+    """Sample name for an index file"""
+
+    name = os.path.basename(path)
+    return name[:-len(INDEX_EXT)] if name.endswith(INDEX_EXT) else name
+
+
+# --------------------------------------------------
+def is_index(path):
+    """Does the path look like a NumPy kmer index?"""
+
+    return path.endswith(INDEX_EXT)
+
+
+# --------------------------------------------------
+def kmer_codes(seqs, kmer_size, with_read_ids=False):
+    """
+    Encode every valid kmer in a list of sequences as a canonical
+    2-bit uint64 code; optionally also return the read each came from
+    """
+
+    # Join with "N" so no window spans two reads
+    buf = np.frombuffer(b'N'.join(seqs), dtype=np.uint8)
+    starts = np.cumsum([0] + [len(seq) + 1 for seq in seqs[:-1]])
+
+    return array_codes(buf, starts, kmer_size, with_read_ids)
+
+
+# --------------------------------------------------
+def array_codes(buf, starts, kmer_size, with_read_ids=False):
+    """
+    "kmer_codes" of sequences already in one uint8 buffer, separated by
+    "N," with the offset where each read starts (see "fastx.seq_arrays")
+    """
+
+    if not 0 < kmer_size <= MAX_KMER_SIZE:
+        raise ValueError('kmer_size must be between 1 and {}'.format(
+            MAX_KMER_SIZE))
+
+    num_windows = len(buf) - kmer_size + 1
+    if num_windows < 1:
+        empty = np.zeros(0, dtype=np.uint64)
+        return (empty, np.zeros(0, dtype=np.int64)) if with_read_ids else empty
+
+    codes = BASE_CODE[buf]
+    invalid = np.zeros(len(codes) + 1, dtype=np.int32)
+    np.cumsum(codes > 3, out=invalid[1:])
+    valid = (invalid[kmer_size:] - invalid[:num_windows]) == 0
+
+    fwd_bases = (codes & 3).astype(np.uint64)
+    rev_bases = np.uint64(3) - fwd_bases
+    fwd = np.zeros(num_windows, dtype=np.uint64)
+    rev = np.zeros(num_windows, dtype=np.uint64)
+    two = np.uint64(2)
+    for i in range(kmer_size):
+        fwd <<= two
+        fwd |= fwd_bases[i:i + num_windows]
+        rev |= rev_bases[i:i + num_windows] << np.uint64(2 * i)
+
+    canonical = np.minimum(fwd, rev)[valid]
+
+    if not with_read_ids:
+        return canonical
+
+    read_ids = np.searchsorted(
+        starts, np.flatnonzero(valid), side='right') - 1
+
+    return canonical, read_ids
+
+
+# --------------------------------------------------
+def merge_counts(parts):
+    """Merge sorted (codes, counts) pairs, summing shared codes"""
+
+    if len(parts) == 1:
+        return parts[0]
+
+    codes = np.concatenate([part[0] for part in parts])
+    counts = np.concatenate([part[1] for part in parts])
+    order = np.argsort(codes, kind='mergesort')
+    codes = codes[order]
+    counts = counts[order]
+
+    if len(codes) == 0:
+        return codes, counts
+
+    starts = np.concatenate(([0], np.flatnonzero(codes[1:] != codes[:-1]) + 1))
+    return codes[starts], np.add.reduceat(counts, starts)
+
+
+# --------------------------------------------------
+def spill_run(spill_dir, num, parts):
+    """Merge the held partial counts and write them as a sorted run"""
+
+    path = os.path.join(spill_dir, 'run{:04d}.npy'.format(num))
+    save_index(path, *merge_counts(parts))
+
+    return path
+
+
+# --------------------------------------------------
+def merge_runs(run_paths, spill_dir, max_held):
+    """
+    K-way merge of sorted runs on disk, one range of codes at a time so
+    about "max_held" entries are in memory; return the merged (codes,
+    counts) memory-mapped
+    """
+
+    runs = [load_index(path) for path in run_paths]
+    total = sum(len(codes) for codes, _ in runs)
+    num_ranges = max(1, -(-total // max(1, max_held)))
+
+    # Cut points from an even sample of every run
+    sampled = np.sort(np.concatenate(
+        [np.asarray(codes[::max(1, len(codes) // (100 * num_ranges))])
+         for codes, _ in runs]))
+    cuts = np.unique(sampled[np.linspace(
+        0, len(sampled), num_ranges + 1)[1:-1].astype(int)]) \
+        if len(sampled) and num_ranges > 1 else np.zeros(0, dtype=np.uint64)
+    bounds = [np.concatenate(([0], np.searchsorted(codes, cuts),
+                              [len(codes)])) for codes, _ in runs]
+
+    out_files = [os.path.join(spill_dir, name) for name in ('codes', 'counts')]
+    num_merged = 0
+    with open(out_files[0], 'wb') as codes_fh, \
+            open(out_files[1], 'wb') as counts_fh:
+        for num in range(len(cuts) + 1):
+            codes, counts = merge_counts([
+                (np.asarray(codes[bound[num]:bound[num + 1]]),
+                 np.asarray(counts[bound[num]:bound[num + 1]]))
+                for (codes, counts), bound in zip(runs, bounds)])
+            codes.astype(np.uint64).tofile(codes_fh)
+            counts.astype(np.uint64).tofile(counts_fh)
+            num_merged += len(codes)
+
+    if num_merged == 0:
+        empty = np.zeros(0, dtype=np.uint64)
+        return empty, empty.copy()
+
+    return tuple(np.memmap(file, dtype=np.uint64, mode='r')
+                 for file in out_files)
+
+
+# --------------------------------------------------
+def count_kmers(file, kmer_size, hash_size='100M', batch_size=4000000,
+                spill_dir=None):
+    """
+    Count the canonical kmers in a file, batch by batch. The partial
+    counts are merged and spilled to a sorted run on disk (in a temp dir
+    under "spill_dir") whenever they pass "hash_size" distinct entries,
+    and the runs are merged a code range at a time, so peak memory is
+    about "hash_size" entries plus a batch; spilled counts come back
+    memory-mapped.
+    """
+
+    import shutil
+    import tempfile
+
+    max_held = parse_size(DEFAULT_HASH_SIZE if hash_size == 'auto' else
+                          hash_size)
+    parts = []
+    num_held = 0
+    num_kmers = 0
+    tmp_dir = None
+    run_paths = []
+
+    try:
+        for buf, starts in fastx.seq_arrays(file, batch_size):
+            codes = array_codes(buf, starts, kmer_size)
+            num_kmers += len(codes)
+            uniq, counts = np.unique(codes, return_counts=True)
+            parts.append((uniq, counts.astype(np.uint64)))
+            num_held += len(uniq)
+
+            if num_held > max_held:
+                tmp_dir = tmp_dir or tempfile.mkdtemp(
+                    prefix='kmers.', dir=spill_dir)
+                run_paths.append(spill_run(tmp_dir, len(run_paths), parts))
+                parts = []
+                num_held = 0
+
+        if not run_paths:
+            if not parts:
+                empty = np.zeros(0, dtype=np.uint64)
+                return empty, empty.copy(), 0
+
+            codes, counts = merge_counts(parts)
+            return codes, counts, num_kmers
+
+        if parts:
+            run_paths.append(spill_run(tmp_dir, len(run_paths), parts))
+            parts = []
+
+        codes, counts = merge_runs(run_paths, tmp_dir, max_held)
+        return codes, counts, num_kmers
+    finally:
+        # Mapped files stay readable once unlinked
+        if tmp_dir:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+# --------------------------------------------------
+def save_index(path, codes, counts, chunk_size=2**24):
+    """
+    Write an index as one (2 x n) uint64 .npy so it can be mmapped,
+    streaming (memory-mapped) inputs a chunk at a time
+    """
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fh:
+        np.lib.format.write_array_header_1_0(fh, {
+            'descr': np.lib.format.dtype_to_descr(np.dtype(np.uint64)),
+            'fortran_order': False,
+            'shape': (2, len(codes))
+        })
+        for values in (codes, counts):
+            for lo in range(0, len(values), chunk_size):
+                np.asarray(values[lo:lo + chunk_size]).astype(
+                    np.uint64).tofile(fh)
+    os.rename(tmp_path, path)
+
+    return path
+
+
+# --------------------------------------------------
+def load_index(path, mmap=True):
+    """Return the (codes, counts) arrays of an index"""
+
+    index = np.load(path, mmap_mode='r' if mmap else None)
+    return index[0], index[1]
+
+
+# --------------------------------------------------
+def index_file(file, out_dir, kmer_size, hash_size='100M',
+               batch_size=4000000, name=None):
+    """Count one file and save its index, return stats for reporting"""
+
+    start = time.time()
+    codes, counts, num_kmers = count_kmers(
+        file, kmer_size, hash_size=hash_size, batch_size=batch_size,
+        spill_dir=out_dir)
+    save_index(index_path(out_dir, file, name), codes, counts)
+
+    return {
+        'file': name or file,
+        'kmers': num_kmers,
+        'distinct': len(codes),
+        'seconds': time.time() - start
+    }
+
+
+# --------------------------------------------------
+def report(stats):
+    """Format the throughput of one indexing run"""
+
+    secs = max(stats['seconds'], 1e-9)
+    return '{}: {:,} kmers ({:,} distinct) in {:.2f}s = {:,.0f} kmers/s' \
+        .format(os.path.basename(stats['file']), stats['kmers'],
+                stats['distinct'], stats['seconds'], stats['kmers'] / secs)
+
+
+# --------------------------------------------------
+def estimate_kmers(file, kmer_size, max_records=0):
+    """
+    Upper bound on the kmers (so distinct kmers) in a file from its
+    size, of its first "max_records" if it will be subset
+    """
+
+    num_bytes = os.path.getsize(file)
+    if fastx.compression(file):
+        num_bytes *= COMPRESSED_RATIO
+
+    if max_records > 0:
+        num_bytes = min(num_bytes,
+                        max_records * fastx.mean_record_bytes(file))
+
+    # About half of a FASTQ is quality scores
+    if fastx.guess_format(file) == 'fastq':
+        num_bytes //= 2
+
+    return int(min(num_bytes, 4**kmer_size))
+
+
+# --------------------------------------------------
+def mix64(codes):
+    """Spread kmer codes over 64 bits (the SplitMix64 finalizer)"""
+
+    with np.errstate(over='ignore'):
+        codes = codes ^ (codes >> np.uint64(30))
+        codes = codes * np.uint64(0xbf58476d1ce4e5b9)
+        codes = codes ^ (codes >> np.uint64(27))
+        codes = codes * np.uint64(0x94d049bb133111eb)
+        return codes ^ (codes >> np.uint64(31))
+
+
+# --------------------------------------------------
+def hll_update(registers, codes):
+    """Add kmer codes to HyperLogLog registers"""
+
+    if len(codes) == 0:
+        return registers
+
+    hashes = mix64(codes)
+    rest_bits = 64 - HLL_BITS
+    slot = (hashes >> np.uint64(rest_bits)).astype(np.int64)
+    rest = hashes & np.uint64((1 << rest_bits) - 1)
+
+    # Position of the first 1 bit in "rest", from its float exponent
+    rank = rest_bits + 1 - np.frexp(rest.astype(np.float64))[1]
+    np.maximum.at(registers, slot, rank.astype(np.uint8))
+
+    return registers
+
+
+# --------------------------------------------------
+def hll_count(registers):
+    """HyperLogLog estimate, linear counting while registers are empty"""
+
+    num = len(registers)
+    alpha = 0.7213 / (1 + 1.079 / num)
+    estimate = alpha * num * num / np.sum(2.0**-registers.astype(float))
+
+    num_zero = np.count_nonzero(registers == 0)
+    if estimate <= 2.5 * num and num_zero:
+        estimate = num * np.log(num / num_zero)
+
+    return int(estimate)
+
+
+# --------------------------------------------------
+def estimate_distinct(file, kmer_size, batch_size=4000000):
+    """Estimate the distinct kmers in a file in one HyperLogLog pass"""
+
+    registers = np.zeros(2**HLL_BITS, dtype=np.uint8)
+    for buf, starts in fastx.seq_arrays(file, batch_size):
+        hll_update(registers, array_codes(buf, starts, kmer_size))
+
+    return hll_count(registers)
+
+
+# --------------------------------------------------
+def main():
+    """Start here"""
+
+    args = get_args()
+
+    if args.name and len(args.file) > 1:
+        print('--name needs a single input file', file=sys.stderr)
+        sys.exit(1)
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    total_kmers = 0
+    start = time.time()
+    for file in args.file:
+        if not os.path.exists(file):
+            print('"{}" is not a file'.format(file), file=sys.stderr)
+            continue
+
+        stats = index_file(file, args.out_dir, args.kmer_size,
+                           args.hash_size, args.batch_size, args.name)
+        total_kmers += stats['kmers']
+        print(report(stats))
+
+    secs = max(time.time() - start, 1e-9)
+    print('Done, {:,} kmers in {:.2f}s = {:,.0f} kmers/s'.format(
+        total_kmers, secs, total_kmers / secs))
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
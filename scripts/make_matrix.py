@@ -6,9 +6,9 @@ import argparse
 import glob
 import os
 import sys
-from math import log
-import pandas as pd
+import numpy as np
 from scipy.spatial.distance import pdist, squareform
+import matrices
 
 # --------------------------------------------------
 def get_args():
@@ -23,19 +23,58 @@ def get_args():
 
     parser.add_argument(
         '-m', '--mode_dir', help='Mode directory',
-        metavar='DIR', type=str, required=True)
+        metavar='DIR', type=str, default='')
+
+    parser.add_argument(
+        '-c', '--counts_db', help='Counts database (instead of --mode_dir)',
+        metavar='FILE', type=str, default='')
 
     parser.add_argument(
         '-o', '--out_dir', help='Matrix output dir',
         metavar='DIR', type=str, default=os.getcwd())
 
+    parser.add_argument(
+        '-b', '--block_size', help='Rows per distance block (0 = all at once)',
+        metavar='INT', type=int, default=0)
+
+    parser.add_argument(
+        '-p', '--procs', help='Processes for blocked distances',
+        metavar='INT', type=int, default=os.cpu_count() or 1)
+
+    parser.add_argument(
+        '-k', '--top_k', help='Also write each sample\'s K nearest neighbors',
+        metavar='INT', type=int, default=0)
+
+    parser.add_argument(
+        '-n', '--neighbors_only', help='With --top_k, skip the square matrix',
+        action='store_true')
+
     return parser.parse_args()
 
+# --------------------------------------------------
+def read_mode_dir(mode_dir):
+    """Read the counts from one file per pair in the mode dir"""
+    mode_files = list(filter(os.path.isfile,
+                             glob.iglob(mode_dir + '/**', recursive=True)))
+    print('Found {} mode files'.format(len(mode_files)))
+
+    counts = {}
+    for file in mode_files:
+        sample1 = os.path.basename(os.path.dirname(file))
+        sample2 = os.path.basename(file)
+        num = open(file).read().strip()
+        if not sample1 in counts:
+            counts[sample1] = {}
+        counts[sample1][sample2] = int(num)
+
+    return counts
+
 # --------------------------------------------------
 def main():
     """main"""
     args = get_args()
     mode_dir = args.mode_dir
+    db_file = args.counts_db
     out_dir = args.out_dir
     distance_method = args.distance_method
     valid_distance = set("""
@@ -44,14 +83,22 @@ def main():
         russellrao seuclidean sokalmichener sokalsneath sqeuclidean yule.
         """.split())
 
-    if not mode_dir:
-        print('--mode_dir is required')
+    if not mode_dir and not db_file:
+        print('--mode_dir or --counts_db is required')
+        sys.exit(1)
+
+    if db_file and not os.path.isfile(db_file):
+        print('Bad --counts_db "{}"'.format(db_file))
         sys.exit(1)
 
-    if not os.path.isdir(mode_dir):
+    if mode_dir and not os.path.isdir(mode_dir):
         print('Bad --mode_dir "{}"'.format(mode_dir))
         sys.exit(1)
 
+    if args.neighbors_only and args.top_k < 1:
+        print('--neighbors_only needs --top_k')
+        sys.exit(1)
+
     if not distance_method in valid_distance:
         print('--distance_method "{}" is not valid'.format(distance_method))
         print('Please select from {}'.format(', '.join(valid_distance)))
@@ -60,67 +107,43 @@ def main():
     if not os.path.isdir(out_dir):
         os.makedirs(out_dir)
 
-    mode_files = list(filter(os.path.isfile,
-                             glob.iglob(mode_dir + '/**', recursive=True)))
-    print('Found {} mode files'.format(len(mode_files)))
-
-    counts = {}
-    for file in mode_files:
-        sample1 = os.path.basename(os.path.dirname(file))
-        sample2 = os.path.basename(file)
-        num = open(file).read().strip()
-        if not sample1 in counts:
-            counts[sample1] = {}
-        counts[sample1][sample2] = int(num)
-
-    all_keys = set(counts.keys())
-    for key in all_keys:
-        map(all_keys.add, counts[key].keys())
-
-    all_samples = sorted(all_keys)
-
-    raw_file = os.path.join(out_dir, 'matrix_raw.txt')
-    raw_fh = open(raw_file, 'w')
-
-    avg_file = os.path.join(out_dir, 'matrix_avg.txt')
-    avg_fh = open(avg_file, 'w')
-
-    log_avg_file = os.path.join(out_dir, 'matrix_log_avg.txt')
-    log_avg_fh = open(log_avg_file, 'w')
-
-    raw_fh.write('\t'.join([''] + all_samples) + '\n')
-    avg_fh.write('\t'.join([''] + all_samples) + '\n')
-    log_avg_fh.write('\t'.join([''] + all_samples) + '\n')
-
-    for sample1 in all_samples:
-        raw = [sample1]
-        avgs = [sample1]
-        log_avg = [sample1]
-
-        for sample2 in all_samples:
-            n1 = counts[sample1].get(sample2, 0)
-            n2 = counts[sample2].get(sample1, 0)
-            avg = (n1 + n2) / 2
-
-            raw.append(str(n1))
-            avgs.append('{:.0f}'.format(avg))
-            log_avg.append('{:.4f}'.format(log(avg)) if avg > 0 else '0')
-
-        raw_fh.write('\t'.join(raw) + '\n')
-        avg_fh.write('\t'.join(avgs) + '\n')
-        log_avg_fh.write('\t'.join(log_avg) + '\n')
-
-    raw_fh.close()
-    avg_fh.close()
-    log_avg_fh.close()
-    
-    dat = pd.read_csv(avg_file, sep="\t", index_col=0)
-    dist = pd.DataFrame(squareform(pdist(dat.values, distance_method)),
-                        index=dat.index,
-                        columns=dat.index)
-
-    norm_file = os.path.join(out_dir, 'matrix_normalized.txt')
-    dist.to_csv(norm_file, sep='\t')
+    if db_file:
+        names, counts = matrices.from_db(db_file)
+        print('Found {0} x {0} mode counts'.format(len(names)))
+    else:
+        names, counts = matrices.from_counts(read_mode_dir(mode_dir))
+
+    mats = matrices.averaged(counts)
+    matrices.save(out_dir, 'matrix_raw', names, mats['raw'], '%d')
+    matrices.save(out_dir, 'matrix_avg', names, mats['avg'], '%.0f')
+    matrices.save(out_dir, 'matrix_log_avg', names, mats['log_avg'], '%.4f')
+
+    if args.block_size > 0:
+        dist_file = os.path.join(out_dir, 'matrix_normalized.npy')
+        nearest, near_dist = matrices.blocked_distance(
+            os.path.join(out_dir, 'matrix_avg.npy'), dist_file,
+            distance_method, args.block_size, args.procs, args.top_k)
+
+        if args.neighbors_only:
+            os.remove(dist_file)
+        else:
+            matrices.write_tsv(
+                os.path.join(out_dir, 'matrix_normalized.txt'), names,
+                np.load(dist_file, mmap_mode='r'), '%.6f')
+    else:
+        dist = squareform(pdist(mats['avg'], distance_method))
+        if not args.neighbors_only:
+            matrices.save(out_dir, 'matrix_normalized', names, dist, '%s')
+
+        if args.top_k > 0:
+            nearest = np.argsort(dist + np.diag([np.inf] * len(names)),
+                                 axis=1)[:, :min(args.top_k, len(names) - 1)]
+            near_dist = dist[np.arange(len(names))[:, None], nearest]
+
+    if args.top_k > 0:
+        matrices.write_neighbors(
+            os.path.join(out_dir, 'matrix_neighbors.txt'), names, nearest,
+            near_dist)
 
     print('Done, see files in dir "{}"'.format(out_dir))
 
@@ -2,13 +2,20 @@
 """make meta dir from meta file"""
 
 import argparse
-import itertools
 import os
 import re
 import shutil
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
 import pandas as pd
-import scipy.spatial.distance
-from geopy.distance import vincenty
+from scipy.spatial.distance import pdist, squareform
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Haversine is within 0.5% of the ellipsoid, pairs closer than this to
+# the cutoff are settled with geopy's geodesic when it is installed
+GEODESIC_BAND = 0.01
 
 # --------------------------------------------------
 def get_sample_names(args):
@@ -47,23 +54,17 @@ def main():
 
     dataframe = pd.read_table(meta, index_col=0)
     cols = dataframe.columns.tolist()
-
-    for col_num, col in enumerate(cols):
-        data = dataframe.loc[restrict, col] if restrict else dataframe[col]
-        matrix = None
-        if re.search(r'\.d$', col):
-            matrix = discrete_vals(data)
-        elif re.search(r'\.c$', col):
-            matrix = continuous_vals(data, euc_dist)
-        elif re.search(r'\.ll$', col):
-            matrix = lat_lon_vals(data, max_dist)
-
-        if not matrix is None:
-            path = os.path.join(out_dir, col + '.meta')
-            print('{:3}: Writing {}'.format(col_num + 1, path))
-            matrix.to_csv(path, sep='\t')
-        else:
-            print('No data for col "{}"'.format(col))
+    columns = [(col, dataframe.loc[restrict, col] if restrict else
+                dataframe[col]) for col in cols]
+
+    make = partial(write_col, out_dir=out_dir, euc_dist=euc_dist,
+                   max_dist=max_dist)
+    with Pool(max(1, min(args.procs, len(columns)))) as pool:
+        for col_num, path in enumerate(pool.imap(make, columns)):
+            if path:
+                print('{:3}: Wrote {}'.format(col_num + 1, path))
+            else:
+                print('No data for col "{}"'.format(cols[col_num]))
 
     print('Done, see output in "{}"'.format(out_dir))
 
@@ -110,71 +111,104 @@ def get_args():
                         help='Comma-separated list of sample names')
     parser.add_argument('-l', '--list', type=str, metavar='STR', default='',
                         help='File with sample names one per line')
+    parser.add_argument('-p', '--procs', type=int, metavar='INT',
+                        default=os.cpu_count() or 1,
+                        help='Columns to process in parallel')
     return parser.parse_args()
 
 # --------------------------------------------------
-def discrete_vals(data):
-    """discrete"""
-    ordered = sorted(data.index.tolist())
-    matrix = pd.DataFrame(1, index=ordered, columns=ordered)
+def write_col(column, out_dir, euc_dist, max_dist):
+    """make one column's matrix, write it, return the path (or None)"""
+    col, data = column
+    data = data.sort_index()
+    matrix = None
+    if re.search(r'\.d$', col):
+        matrix = discrete_vals(data)
+    elif re.search(r'\.c$', col):
+        matrix = continuous_vals(data, euc_dist)
+    elif re.search(r'\.ll$', col):
+        matrix = lat_lon_vals(data, max_dist)
+
+    if matrix is None:
+        return None
+
+    path = os.path.join(out_dir, col + '.meta')
+    write_meta(path, data.index.tolist(), matrix)
+
+    return path
 
-    for sample1, sample2 in itertools.combinations(data.index, 2):
-        val = data[sample1] == data[sample2]
-        matrix[sample1][sample2] = val
-        matrix[sample2][sample1] = val
+# --------------------------------------------------
+def write_meta(path, names, matrix):
+    """tab-delimited matrix with header/row names in one write"""
+    lines = ['\t'.join([''] + list(map(str, names)))]
+    for name, row in zip(names, matrix.tolist()):
+        lines.append('\t'.join([str(name)] + list(map(str, row))))
 
-    return matrix
+    with open(path, 'wt') as out_fh:
+        out_fh.write('\n'.join(lines) + '\n')
 
 # --------------------------------------------------
-def continuous_vals(data, threshold):
-    """continuous"""
-    ordered = sorted(data.index.tolist())
-    combos = list(itertools.combinations(data.index, 2))
-    dist = pd.DataFrame(0, index=ordered, columns=ordered)
+def discrete_vals(data):
+    """discrete: 1 where the values are equal"""
+    vals = np.array(data.tolist(), dtype=object)
+    matrix = (vals[:, None] == vals[None, :]).astype(int)
+    np.fill_diagonal(matrix, 1)
 
-    #
-    # First calculate all distances
-    #
-    for sample1, sample2 in combos:
-        dist[sample1][sample2] = \
-            scipy.spatial.distance.euclidean(data[sample1], data[sample2])
+    return matrix
 
-    #
-    # Get all the distances greater than 0 as a list
-    #
-    distances = sorted(filter(lambda n: n > 0, \
-                              itertools.chain.from_iterable(dist.values.tolist())))
+# --------------------------------------------------
+def continuous_vals(data, threshold):
+    """continuous: 1 where the distance is in the bottom X percent"""
+    vals = data.values.astype(float).reshape(-1, 1)
+    dist = pdist(vals, 'euclidean')
 
     #
-    # Figure out the bottom X percent/max value
+    # Figure out the bottom X percent/max value of distances > 0
     #
-    count = len(distances)
-    max_index = int(count * threshold)
-    max_val = distances[max_index - 1]
+    with np.errstate(invalid='ignore'):
+        distances = dist[dist > 0]
+    max_index = int(len(distances) * threshold)
+    if max_index > 0:
+        max_val = np.partition(distances, max_index - 1)[max_index - 1]
+    else:
+        max_val = distances.max()
 
-    #
-    # Create the return matrix using 1/0 for the distance w/in tolerance
-    #
-    matrix = pd.DataFrame(0, index=ordered, columns=ordered)
-    for sample1, sample2 in combos:
-        val = int(dist[sample1][sample2] < max_val)
-        matrix[sample1][sample2] = val
-        matrix[sample2][sample1] = val
+    with np.errstate(invalid='ignore'):
+        matrix = squareform((dist < max_val).astype(int))
 
     return matrix
 
 # --------------------------------------------------
 def lat_lon_vals(data, max_dist):
-    """latitude/longitude"""
-    ordered = sorted(data.index.tolist())
-    matrix = pd.DataFrame(1, index=ordered, columns=ordered)
-
-    for sample1, sample2 in itertools.combinations(data.index, 2):
-        pos1 = re.split(r'\s*,\s*', data[sample1])
-        pos2 = re.split(r'\s*,\s*', data[sample2])
-        val = int(vincenty(pos1, pos2).kilometers < max_dist)
-        matrix[sample1][sample2] = val
-        matrix[sample2][sample1] = val
+    """latitude/longitude: 1 where the samples are within max_dist km"""
+    pos = np.array([re.split(r'\s*,\s*', val) for val in data.tolist()],
+                   dtype=float)
+    lat, lon = np.radians(pos[:, 0]), np.radians(pos[:, 1])
+
+    hav = np.sin((lat[:, None] - lat[None, :]) / 2)**2 + \
+        np.cos(lat[:, None]) * np.cos(lat[None, :]) * \
+        np.sin((lon[:, None] - lon[None, :]) / 2)**2
+    dist = 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+    matrix = (dist < max_dist).astype(int)
+
+    #
+    # Settle the pairs near the cutoff on the ellipsoid
+    #
+    try:
+        from geopy.distance import geodesic
+    except ImportError:
+        try:
+            from geopy.distance import vincenty as geodesic
+        except ImportError:
+            geodesic = None
+
+    if geodesic:
+        near = np.abs(dist - max_dist) <= GEODESIC_BAND * max_dist
+        for i, j in zip(*np.nonzero(np.triu(near, 1))):
+            val = int(geodesic(pos[i], pos[j]).kilometers < max_dist)
+            matrix[i, j] = matrix[j, i] = val
+
+    np.fill_diagonal(matrix, 1)
 
     return matrix
 
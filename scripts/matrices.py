@@ -0,0 +1,210 @@
+"""Build the count/similarity matrices with NumPy and write them out"""
+
+import os
+import numpy as np
+import counts_db
+
+# Set in each distance worker by "_init_distance"
+DIST_ARGS = None
+
+
+# --------------------------------------------------
+def from_counts(counts, names=None):
+    """
+    {index_name: {query_name: num}} to (names, matrix) with
+    matrix[index, query]; names default to the sorted index names
+    """
+
+    names = sorted(counts) if names is None else names
+    pos = {name: i for i, name in enumerate(names)}
+    matrix = np.zeros((len(names), len(names)), dtype=np.int64)
+
+    for index_name, nums in counts.items():
+        if index_name not in pos:
+            continue
+        row = matrix[pos[index_name]]
+        for qry_name, num in nums.items():
+            if qry_name in pos:
+                row[pos[qry_name]] = num
+
+    return names, matrix
+
+
+# --------------------------------------------------
+def from_db(db_file):
+    """Load the whole count matrix from the counts database at once"""
+
+    db = counts_db.connect(db_file)
+    names = [
+        row[0] for row in db.execute(
+            'select distinct index_name from mode order by index_name')
+    ]
+
+    db.execute('create temp table sample (name text primary key, pos int)')
+    db.executemany('insert into temp.sample values (?, ?)',
+                   [(name, i) for i, name in enumerate(names)])
+
+    cells = np.array(
+        db.execute('select i.pos, q.pos, m.num from mode m '
+                   'join temp.sample i on m.index_name = i.name '
+                   'join temp.sample q on m.query_name = q.name').fetchall(),
+        dtype=np.int64).reshape(-1, 3)
+    db.close()
+
+    matrix = np.zeros((len(names), len(names)), dtype=np.int64)
+    matrix[cells[:, 0], cells[:, 1]] = cells[:, 2]
+
+    return names, matrix
+
+
+# --------------------------------------------------
+def normalized(matrix, input_counts):
+    """
+    Fizkin matrices, rows are queries: "raw" reads of the query kept by
+    each index, "norm" those over the query's read count and "norm_avg"
+    the mean of the two directions
+    """
+
+    raw = matrix.T
+    norm = raw / np.asarray(input_counts, dtype=float)[:, None]
+
+    return {'raw': raw, 'norm': norm, 'norm_avg': (norm + norm.T) / 2}
+
+
+# --------------------------------------------------
+def averaged(matrix):
+    """
+    make_matrix.py matrices, rows are indexes: "raw", the rounded mean
+    of the two directions ("avg") and its log ("log_avg", 0 when 0)
+    """
+
+    mean = (matrix + matrix.T) / 2
+    with np.errstate(divide='ignore'):
+        log_avg = np.where(mean > 0, np.log(mean), 0)
+
+    return {'raw': matrix, 'avg': np.round(mean), 'log_avg': log_avg}
+
+
+# --------------------------------------------------
+def write_tsv(path, names, matrix, fmt):
+    """Write a matrix with a header and row names, one row at a time"""
+
+    row_fmt = '\t'.join([fmt] * len(names)) + '\n'
+    with open(path, 'wt') as out_fh:
+        out_fh.write('\t'.join([''] + list(names)) + '\n')
+        for name, row in zip(names, matrix):
+            out_fh.write(name + '\t' + row_fmt % tuple(row.tolist()))
+
+    return path
+
+
+# --------------------------------------------------
+def save(out_dir, stem, names, matrix, fmt):
+    """Write "<stem>.txt" and "<stem>.npy" (and Parquet if possible)"""
+
+    write_tsv(os.path.join(out_dir, stem + '.txt'), names, matrix, fmt)
+    np.save(os.path.join(out_dir, stem + '.npy'), matrix)
+
+    with open(os.path.join(out_dir, 'samples.txt'), 'wt') as out_fh:
+        out_fh.write('\n'.join(names) + '\n')
+
+    try:
+        import pandas as pd
+        pd.DataFrame(matrix, index=names, columns=names).to_parquet(
+            os.path.join(out_dir, stem + '.parquet'))
+    except (ImportError, ValueError):
+        pass
+
+    return os.path.join(out_dir, stem + '.txt')
+
+
+# --------------------------------------------------
+def _init_distance(data_file, out_file, metric, kwargs):
+    """Pool initializer: map the data and the output once per worker"""
+
+    global DIST_ARGS
+    DIST_ARGS = (np.load(data_file, mmap_mode='r'),
+                 np.load(out_file, mmap_mode='r+'), metric, kwargs)
+
+
+# --------------------------------------------------
+def _distance_rows(block):
+    """Fill rows [start, stop) of the output, return their top-k"""
+
+    from scipy.spatial.distance import cdist
+
+    data, out, metric, kwargs = DIST_ARGS
+    start, stop, block_size, top_k = block
+    rows = np.asarray(data[start:stop], dtype=float)
+
+    for col in range(0, data.shape[0], block_size):
+        cols = np.asarray(data[col:col + block_size], dtype=float)
+        out[start:stop, col:col + block_size] = cdist(
+            rows, cols, metric, **kwargs)
+    out.flush()
+
+    if top_k < 1:
+        return start, None, None
+
+    dist = np.array(out[start:stop], dtype=float)
+    dist[np.arange(stop - start), np.arange(start, stop)] = np.inf
+    k = min(top_k, dist.shape[1] - 1)
+    nearest = np.argpartition(dist, k - 1, axis=1)[:, :k] if k > 0 else \
+        np.zeros((stop - start, 0), dtype=int)
+    rows = np.arange(stop - start)[:, None]
+    near_dist = dist[rows, nearest]
+    order = np.argsort(near_dist, axis=1)
+
+    return start, nearest[rows, order], near_dist[rows, order]
+
+
+# --------------------------------------------------
+def blocked_distance(data_file, out_file, metric, block_size=1000,
+                     num_procs=1, top_k=0):
+    """
+    Pairwise distances between the rows of a (mmapped) .npy, computed in
+    row blocks by a process pool into a float32 .npy memmap; returns the
+    (indexes, distances) of each row's "top_k" nearest rows
+    """
+
+    from multiprocessing import Pool
+
+    data = np.load(data_file, mmap_mode='r')
+    num = data.shape[0]
+    out = np.lib.format.open_memmap(
+        out_file, mode='w+', dtype=np.float32, shape=(num, num))
+    del out
+
+    # Standardized euclidean needs the variances of all rows, not a block's
+    kwargs = {}
+    if metric == 'seuclidean':
+        kwargs['V'] = np.var(np.asarray(data, dtype=float), axis=0, ddof=1)
+
+    blocks = [(start, min(start + block_size, num), block_size, top_k)
+              for start in range(0, num, block_size)]
+
+    nearest = np.zeros((num, max(0, min(top_k, num - 1))), dtype=np.int64)
+    near_dist = np.zeros(nearest.shape)
+    with Pool(max(1, min(num_procs, len(blocks))),
+              initializer=_init_distance,
+              initargs=(data_file, out_file, metric, kwargs)) as pool:
+        for start, idx, dist in pool.imap_unordered(_distance_rows, blocks):
+            if idx is not None:
+                nearest[start:start + len(idx)] = idx
+                near_dist[start:start + len(idx)] = dist
+
+    return nearest, near_dist
+
+
+# --------------------------------------------------
+def write_neighbors(path, names, nearest, near_dist):
+    """Write each sample's nearest neighbors as long-format TSV"""
+
+    with open(path, 'wt') as out_fh:
+        out_fh.write('sample\trank\tneighbor\tdistance\n')
+        for name, idx, dist in zip(names, nearest, near_dist):
+            for rank, (i, val) in enumerate(zip(idx, dist), start=1):
+                out_fh.write('{}\t{}\t{}\t{:.6f}\n'.format(
+                    name, rank, names[i], val))
+
+    return path
@@ -0,0 +1,251 @@
+"""Run shell jobs as a DAG, packing them onto the node's CPUs and memory"""
+
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import tracing
+
+BACKFILL = 100
+
+# Status of a job whose command succeeded but whose "on_done" raised
+ON_DONE_FAILED = 'on_done'
+
+# Pipelines fail when any of their commands does
+BASH = shutil.which('bash')
+
+
+# --------------------------------------------------
+def num_cpus():
+    """CPUs this process may use"""
+
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# --------------------------------------------------
+def available_memory():
+    """Bytes of memory available to start jobs (MemAvailable)"""
+
+    try:
+        with open('/proc/meminfo') as fh:
+            for line in fh:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+# --------------------------------------------------
+class Job:
+    """
+    A shell command, or a function run in the scheduler's pool of
+    worker processes ("func" called with "args"), with its resource
+    cost and dependencies; a function's return value is kept in
+    "result" for its "on_done"
+    """
+
+    def __init__(self, name, cmd=None, cpus=1, mem=0, deps=None,
+                 on_done=None, func=None, args=()):
+        self.name = name
+        self.cmd = cmd
+        self.func = func
+        self.args = args
+        self.cpus = cpus
+        self.mem = mem
+        self.deps = set(deps or [])
+        self.on_done = on_done
+        self.result = None
+        self.tries = 0
+        self.status = None
+        self.start = 0.
+        self.seconds = 0.
+        self.cpu = 0.
+        self.max_rss = 0
+        self.read_bytes = 0
+        self.write_bytes = 0
+
+    def __str__(self):
+        return self.cmd or '{}{}'.format(self.func.__name__, self.args)
+
+
+# --------------------------------------------------
+class Scheduler:
+    """
+    Start each job once its dependencies have finished and its CPUs and
+    memory fit in what is free; a failed job is retried up to "retries"
+    times, then either no more jobs start or ("keep_going") only its
+    dependents are dropped
+    """
+
+    def __init__(self, cpus=None, mem=None, max_jobs=None, retries=0,
+                 keep_going=False):
+        self.cpus = cpus or num_cpus()
+        self.mem = mem or available_memory()
+        self.max_jobs = max_jobs
+        self.retries = retries
+        self.keep_going = keep_going
+
+    def run(self, jobs):
+        """Run all jobs, return the list of failed jobs"""
+
+        loop = asyncio.new_event_loop()
+        try:
+            # Callbacks run one at a time, off the loop, so checksums and
+            # cache copies do not hold up starting other jobs; function
+            # jobs share long-lived workers instead of an interpreter each
+            with ThreadPoolExecutor(self.cpus + 1) as waiters, \
+                    ThreadPoolExecutor(1) as callbacks, \
+                    ProcessPoolExecutor(self.cpus) as workers:
+                return loop.run_until_complete(
+                    self._run(jobs, (waiters, callbacks, workers)))
+        finally:
+            loop.close()
+
+    def _fits(self, job, free_cpus, free_mem, num_running):
+        """
+        Can "job" start now? Its memory must fit both what is not
+        reserved by running jobs and what the node has free right now
+        (other processes); an oversized job may run alone
+        """
+
+        if self.max_jobs and num_running >= self.max_jobs:
+            return False
+
+        if num_running == 0:
+            return True
+
+        return job.cpus <= free_cpus and job.mem <= free_mem and \
+            (job.mem == 0 or job.mem <= available_memory())
+
+    async def _start(self, job, pools):
+        """
+        Run one job in a shell, reaping it with wait4 (in a thread) so
+        its own CPU time, peak RSS and block I/O come for free, or its
+        function in the "workers" pool, then its "on_done" in the
+        "callbacks" thread; a callback that raises fails the job
+        """
+
+        waiters, callbacks, workers = pools
+        job.start = time.time()
+        loop = asyncio.get_event_loop()
+        if job.func:
+            try:
+                job.result, usage = await loop.run_in_executor(
+                    workers, tracing.measure, job.func, *job.args)
+                job.status = 0
+                job.cpu = usage['cpu']
+                job.max_rss = usage['max_rss']
+                job.read_bytes = usage['read_bytes']
+                job.write_bytes = usage['write_bytes']
+            except Exception as err:
+                print('Job "{}" raised: {}'.format(job.name, err),
+                      file=sys.stderr)
+                job.status = 1
+            job.seconds = time.time() - job.start
+        else:
+            shell = [BASH, '-o', 'pipefail'] if BASH else ['/bin/sh']
+            proc = subprocess.Popen(shell + ['-c', job.cmd])
+            _, status, usage = await loop.run_in_executor(
+                waiters, os.wait4, proc.pid, 0)
+
+            proc.returncode = os.WEXITSTATUS(status) \
+                if os.WIFEXITED(status) else -os.WTERMSIG(status)
+            job.status = proc.returncode
+            job.seconds = time.time() - job.start
+            job.cpu = usage.ru_utime + usage.ru_stime
+            job.max_rss = usage.ru_maxrss * 1024
+            job.read_bytes = usage.ru_inblock * 512
+            job.write_bytes = usage.ru_oublock * 512
+
+        if job.status == 0 and job.on_done:
+            try:
+                await loop.run_in_executor(callbacks, job.on_done)
+            except Exception as err:
+                print('Job "{}" finished but its callback failed: {}'.format(
+                    job.name, err), file=sys.stderr)
+                job.status = ON_DONE_FAILED
+
+        return job
+
+    async def _run(self, jobs, pools):
+        """Main loop: launch what is ready and fits, reap what finishes"""
+
+        by_name = {job.name: job for job in jobs}
+        dependents = {}
+        waiting = {}
+        for job in jobs:
+            deps = [dep for dep in job.deps if dep in by_name]
+            waiting[job.name] = len(deps)
+            for dep in deps:
+                dependents.setdefault(dep, []).append(job)
+
+        ready = deque(job for job in jobs if waiting[job.name] == 0)
+        running = set()
+        failed = []
+        free_cpus = self.cpus
+        free_mem = self.mem
+
+        while ready or running:
+            # Launch from the front, backfilling smaller jobs behind it
+            launched = True
+            while ready and launched and (self.keep_going or not failed):
+                launched = False
+                for i in range(min(len(ready), BACKFILL)):
+                    job = ready[i]
+                    if self._fits(job, free_cpus, free_mem, len(running)):
+                        del ready[i]
+                        free_cpus -= job.cpus
+                        free_mem -= job.mem
+                        running.add(
+                            asyncio.ensure_future(
+                                self._start(job, pools)))
+                        launched = True
+                        break
+
+            if not running:
+                break
+
+            done, running = await asyncio.wait(
+                running, return_when=asyncio.FIRST_COMPLETED)
+
+            for task in done:
+                job = task.result()
+                free_cpus += job.cpus
+                free_mem += job.mem
+
+                if job.status != 0:
+                    print('Job "{}" failed ({}): {}'.format(
+                        job.name, job.status, job), file=sys.stderr)
+                    if job.tries < self.retries:
+                        job.tries += 1
+                        ready.appendleft(job)
+                    else:
+                        failed.append(job)
+                    continue
+
+                for child in dependents.get(job.name, []):
+                    waiting[child.name] -= 1
+                    if waiting[child.name] == 0:
+                        ready.append(child)
+
+        return failed
+
+
+# --------------------------------------------------
+def report(jobs, seconds, cpus):
+    """Summarize a run: jobs, wall time and CPU-slot utilization"""
+
+    busy = sum(job.seconds * job.cpus for job in jobs)
+    util = busy / (seconds * cpus) if seconds > 0 else 0
+
+    return 'Ran {} jobs in {:.1f}s on {} CPUs ({:.0%} busy)'.format(
+        len(jobs), seconds, cpus, min(util, 1))
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+"""Split the (index x query) comparisons into tiles run as shards"""
+
+import argparse
+import hashlib
+import json
+import math
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+from multiprocessing import Pool
+import counts_db
+
+MANIFEST_TMPL = 'tile_{:04d}.json'
+
+# A tile's result keeps the hash of the manifest it was made from
+TILE_SCHEMA = """
+    create table if not exists tile (
+        hash text not null
+    );
+"""
+
+
+# --------------------------------------------------
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description='Run comparison shards from their manifests',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        'manifest', help='Shard manifest(s)', metavar='FILE', nargs='+')
+
+    return parser.parse_args()
+
+
+# --------------------------------------------------
+def balance(files, num_groups):
+    """Split files into groups of about equal total size (greedy LPT)"""
+
+    num_groups = max(1, min(num_groups, len(files)))
+    groups = [[] for _ in range(num_groups)]
+    sizes = [0] * num_groups
+    for file in sorted(files, key=os.path.getsize, reverse=True):
+        smallest = sizes.index(min(sizes))
+        groups[smallest].append(file)
+        sizes[smallest] += os.path.getsize(file)
+
+    return [sorted(group) for group in groups if group]
+
+
+# --------------------------------------------------
+def make_tiles(index_files, query_files, num_tiles):
+    """
+    Cut the pair matrix into about "num_tiles" blocks: indexes into rows
+    and queries into columns, each balanced on file size, so a tile
+    loads only its indexes and scans only its queries
+    """
+
+    num_rows = max(1, int(math.sqrt(num_tiles)))
+    num_cols = max(1, int(math.ceil(num_tiles / num_rows)))
+
+    return [(rows, cols) for rows in balance(index_files, num_rows)
+            for cols in balance(query_files, num_cols)]
+
+
+# --------------------------------------------------
+def write_manifests(tiles, shard_dir, params, skip=None):
+    """Write one self-contained JSON manifest per tile"""
+
+    import fastx
+    import kmers
+
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+
+    skip = skip or set()
+    manifests = []
+    for num, (index_files, query_files) in enumerate(tiles):
+        index_names = set(map(kmers.index_name, index_files))
+        query_names = set(map(fastx.sample_name, query_files))
+        path = os.path.join(shard_dir, MANIFEST_TMPL.format(num))
+        manifest = dict(
+            params,
+            tile=num,
+            indexes=index_files,
+            queries=query_files,
+            skip=sorted(
+                [idx, qry] for idx, qry in skip
+                if idx in index_names and qry in query_names),
+            result=os.path.join(shard_dir, 'tile_{:04d}.db'.format(num)))
+
+        with open(path, 'wt') as out_fh:
+            json.dump(manifest, out_fh, indent=2)
+        manifests.append(path)
+
+    return manifests
+
+
+# --------------------------------------------------
+def manifest_hash(manifest):
+    """
+    Hash what a tile's counts depend on: its index and query files (by
+    size and mtime), the parameters and the pairs skipped
+    """
+
+    key = {k: v for k, v in manifest.items() if k not in ('tile', 'result')}
+    key['stats'] = {}
+    for path in manifest['indexes'] + manifest['queries']:
+        if os.path.isfile(path):
+            stat = os.stat(path)
+            key['stats'][path] = [stat.st_size, stat.st_mtime]
+
+    return hashlib.blake2b(
+        json.dumps(key, sort_keys=True).encode(), digest_size=16).hexdigest()
+
+
+# --------------------------------------------------
+def result_hash(result):
+    """The manifest hash stored in a tile's result, None if there is none"""
+
+    if not os.path.isfile(result):
+        return None
+
+    db = sqlite3.connect(result, timeout=60)
+    try:
+        row = db.execute('select hash from tile').fetchone()
+    except sqlite3.OperationalError:
+        row = None
+    finally:
+        db.close()
+
+    return row[0] if row else None
+
+
+# --------------------------------------------------
+def is_current(manifest_file):
+    """Was the tile's result made from this manifest and these inputs?"""
+
+    with open(manifest_file) as fh:
+        manifest = json.load(fh)
+
+    return result_hash(manifest['result']) == manifest_hash(manifest)
+
+
+# --------------------------------------------------
+def run_shard(manifest_file):
+    """
+    Run the comparisons of one tile into its own counts database, unless
+    its result is current (see "manifest_hash")
+    """
+
+    with open(manifest_file) as fh:
+        manifest = json.load(fh)
+
+    result = manifest['result']
+    digest = manifest_hash(manifest)
+    if result_hash(result) == digest:
+        return result
+
+    skip = set(map(tuple, manifest['skip']))
+    if manifest['engine'] == 'numpy':
+        rows = numpy_shard(manifest, skip)
+    else:
+        rows = jellyfish_shard(manifest, skip)
+
+    tmp_result = result + '.tmp'
+    if os.path.isfile(tmp_result):
+        os.remove(tmp_result)
+    db = counts_db.connect(tmp_result)
+    counts_db.put_modes(db, rows)
+    db.executescript(TILE_SCHEMA)
+    with db:
+        db.execute('insert into tile values (?)', (digest, ))
+    db.execute('pragma journal_mode=delete')
+    db.close()
+    os.rename(tmp_result, result)
+
+    return result
+
+
+# --------------------------------------------------
+def numpy_shard(manifest, skip):
+    """Count kept reads with the in-process NumPy engine"""
+
+    import compare
+    import fastx
+    import kmers
+
+    rows = []
+    for qry_file in manifest['queries']:
+        qry_name = fastx.sample_name(qry_file)
+        todo = [
+            file for file in manifest['indexes']
+            if (kmers.index_name(file), qry_name) not in skip
+        ]
+        if todo:
+            kept, _ = compare.count_kept(
+                qry_file, todo, manifest['kmer_size'], manifest['min_mode'],
+                manifest['pct_kmer_coverage'])
+            rows.extend((idx, qry_name, num) for idx, num in kept.items())
+
+    return rows
+
+
+# --------------------------------------------------
+def jellyfish_shard(manifest, skip):
+    """Count kept reads with "query_per_sequence", keeping no reads"""
+
+    import fastx
+
+    rows = []
+    work_dir = tempfile.mkdtemp()
+    try:
+        for jf_file in manifest['indexes']:
+            index_name = os.path.basename(jf_file)
+            for qry_file in manifest['queries']:
+                qry_name = fastx.sample_name(qry_file)
+                if (index_name, qry_name) in skip:
+                    continue
+
+                kept = os.path.join(work_dir, 'kept')
+                pipe, qry_arg = fastx.stream_input(qry_file)
+                cmd = pipe + 'query_per_sequence {} {} {} {} 1>{} 2>/dev/null'
+                cmd = cmd.format(manifest['min_mode'],
+                                 manifest['pct_kmer_coverage'], jf_file,
+                                 qry_arg, kept)
+                subprocess.run(cmd, shell=True, check=True)
+                rows.append((index_name, qry_name, fastx.count_records(kept)))
+    finally:
+        shutil.rmtree(work_dir)
+
+    return rows
+
+
+# --------------------------------------------------
+def run_local(manifests, num_workers):
+    """Run shards in a process pool, each worker standing in for a node"""
+
+    with Pool(max(1, min(num_workers, len(manifests)))) as pool:
+        return pool.map(run_shard, manifests)
+
+
+# --------------------------------------------------
+def merge(db_file, results):
+    """Upsert all the shard counts into the main counts database"""
+
+    db = counts_db.connect(db_file)
+    num = 0
+    for result in results:
+        shard_db = counts_db.connect(result)
+        rows = [(idx, qry, n)
+                for idx, qry_nums in counts_db.get_modes(shard_db).items()
+                for qry, n in qry_nums.items()]
+        shard_db.close()
+        counts_db.put_modes(db, rows)
+        num += len(rows)
+    db.close()
+
+    return num
+
+
+# --------------------------------------------------
+def write_slurm(manifests, shard_dir, partition='normal',
+                walltime='24:00:00'):
+    """A SLURM job-array script running one manifest per task"""
+
+    prg = os.path.realpath(__file__)
+    path = os.path.join(shard_dir, 'shards.slurm')
+    with open(path, 'wt') as out_fh:
+        out_fh.write('\n'.join([
+            '#!/bin/bash',
+            '',
+            '#SBATCH -J fizkin-shard',
+            '#SBATCH -N 1',
+            '#SBATCH -n 1',
+            '#SBATCH -p {}'.format(partition),
+            '#SBATCH -t {}'.format(walltime),
+            '#SBATCH --array=0-{}'.format(len(manifests) - 1),
+            '',
+            'set -u',
+            '',
+            'MANIFEST=$(printf "{}/{}" "$SLURM_ARRAY_TASK_ID")'.format(
+                shard_dir, MANIFEST_TMPL.replace('{:04d}', '%04d')),
+            '{} "$MANIFEST"'.format(prg),
+            ''
+        ]))
+
+    return path
+
+
+# --------------------------------------------------
+def main():
+    """Start here"""
+
+    args = get_args()
+
+    for manifest in args.manifest:
+        if not os.path.isfile(manifest):
+            print('"{}" is not a file'.format(manifest), file=sys.stderr)
+            sys.exit(1)
+
+        print('Done, see "{}"'.format(run_shard(manifest)))
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
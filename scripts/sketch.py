@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""Bottom-k MinHash sketches and approximate similarity matrices"""
+
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from scipy.sparse import csr_matrix
+import fastx
+import kmers
+
+SKETCH_EXT = '.sketch.npy'
+
+
+# --------------------------------------------------
+def get_args():
+    """Get command-line arguments"""
+
+    parser = argparse.ArgumentParser(
+        description='MinHash sketches and approximate similarity',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument(
+        'file', help='FASTA/Q input file(s)', metavar='FILE', nargs='+')
+
+    parser.add_argument(
+        '-o',
+        '--out_dir',
+        help='Output directory',
+        metavar='DIR',
+        type=str,
+        default='sketches')
+
+    parser.add_argument(
+        '-k',
+        '--kmer_size',
+        help='Kmer size',
+        metavar='int',
+        type=int,
+        default=20)
+
+    parser.add_argument(
+        '-n',
+        '--sketch_size',
+        help='Number of hashes kept per sample',
+        metavar='int',
+        type=int,
+        default=1000)
+
+    parser.add_argument(
+        '-a',
+        '--abundance',
+        help='Use kmer abundances (cosine instead of Jaccard)',
+        action='store_true')
+
+    parser.add_argument(
+        '-e',
+        '--exact',
+        help='Exact matrix (e.g., "matrix_norm_avg.txt") to measure error',
+        metavar='FILE',
+        type=str,
+        default='')
+
+    parser.add_argument(
+        '-p',
+        '--prefilter',
+        help='Similarity below which a pair would be skipped',
+        metavar='float',
+        type=float,
+        default=0.)
+
+    return parser.parse_args()
+
+
+# --------------------------------------------------
+def hash_codes(codes):
+    """Scramble kmer codes with the 64-bit MurmurHash3 finalizer"""
+
+    hashes = codes.astype(np.uint64)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xff51afd7ed558ccd)
+    hashes ^= hashes >> np.uint64(33)
+    hashes *= np.uint64(0xc4ceb9fe1a85ec53)
+    hashes ^= hashes >> np.uint64(33)
+
+    return hashes
+
+
+# --------------------------------------------------
+def sketch_path(out_dir, file):
+    """Location of the sketch for an input file"""
+
+    return os.path.join(out_dir, fastx.sample_name(file) + SKETCH_EXT)
+
+
+# --------------------------------------------------
+def sketch_name(path):
+    """Sample name for a sketch file"""
+
+    name = os.path.basename(path)
+    return name[:-len(SKETCH_EXT)] if name.endswith(SKETCH_EXT) else name
+
+
+# --------------------------------------------------
+def sketch_seqs(batches, kmer_size, sketch_size):
+    """Bottom-k (hashes, counts) over "fastx.seq_arrays" batches"""
+
+    hashes = np.zeros(0, dtype=np.uint64)
+    counts = np.zeros(0, dtype=np.uint64)
+
+    for buf, starts in batches:
+        uniq, num = np.unique(
+            hash_codes(kmers.array_codes(buf, starts, kmer_size)),
+            return_counts=True)
+        hashes, counts = kmers.merge_counts(
+            [(hashes, counts), (uniq[:sketch_size],
+                                num[:sketch_size].astype(np.uint64))])
+        hashes = hashes[:sketch_size]
+        counts = counts[:sketch_size]
+
+    return hashes, counts
+
+
+# --------------------------------------------------
+def sketch_file(file, out_dir, kmer_size, sketch_size=1000,
+                batch_size=4000000):
+    """Sketch one file and save it next to the others, return the path"""
+
+    hashes, counts = sketch_seqs(
+        fastx.seq_arrays(file, batch_size), kmer_size, sketch_size)
+
+    return kmers.save_index(sketch_path(out_dir, file), hashes, counts)
+
+
+# --------------------------------------------------
+def similarity(sketches, abundance=False):
+    """
+    N x N similarity from (hashes, counts) sketches: bottom-k Jaccard
+    estimates, or the cosine of the abundance vectors with "abundance"
+    """
+
+    num = len(sketches)
+    lens = [len(hashes) for hashes, _ in sketches]
+    if num == 0 or sum(lens) == 0:
+        return np.eye(num)
+
+    all_hashes = np.concatenate([hashes for hashes, _ in sketches])
+    uniq, cols = np.unique(all_hashes, return_inverse=True)
+    rows = np.repeat(np.arange(num), lens)
+
+    if abundance:
+        vals = np.concatenate([counts for _, counts in sketches])
+        mat = csr_matrix((vals.astype(float), (rows, cols)),
+                         shape=(num, len(uniq)))
+        dot = (mat @ mat.T).toarray()
+        norms = np.sqrt(np.diag(dot))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sim = np.nan_to_num(dot / np.outer(norms, norms))
+    else:
+        mat = csr_matrix((np.ones(len(rows)), (rows, cols)),
+                         shape=(num, len(uniq)))
+        inter = (mat @ mat.T).toarray()
+
+        # Only compare hashes below the smaller of the two sketch maxima
+        maxes = np.array([hashes[-1] if len(hashes) else 0
+                          for hashes, _ in sketches], dtype=np.uint64)
+        below = np.array([
+            np.searchsorted(hashes, maxes, side='right')
+            for hashes, _ in sketches
+        ], dtype=float)
+        union = below + below.T - inter
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sim = np.nan_to_num(inter / union)
+
+    np.fill_diagonal(sim, 1.)
+
+    return sim
+
+
+# --------------------------------------------------
+def load_sketches(files):
+    """Read sketches into memory, return (names, sketches)"""
+
+    names = [sketch_name(file) for file in files]
+    sketches = [tuple(np.array(a) for a in kmers.load_index(file))
+                for file in files]
+
+    return names, sketches
+
+
+# --------------------------------------------------
+def write_matrix(path, names, matrix):
+    """Write a square matrix as TSV with sample names"""
+
+    with open(path, 'wt') as out_fh:
+        out_fh.write('\t'.join([''] + names) + '\n')
+        for name, row in zip(names, matrix):
+            out_fh.write('\t'.join([name] + ['{:.6f}'.format(val)
+                                             for val in row]) + '\n')
+
+    return path
+
+
+# --------------------------------------------------
+def read_matrix(path):
+    """Read a square TSV matrix, return (names, matrix)"""
+
+    with open(path) as fh:
+        names = fh.readline().rstrip('\n').split('\t')[1:]
+        rows = {}
+        for line in fh:
+            flds = line.rstrip('\n').split('\t')
+            rows[flds[0]] = list(map(float, flds[1:]))
+
+    return names, np.array([rows[name] for name in names])
+
+
+# --------------------------------------------------
+def skip_pairs(names, matrix, threshold):
+    """(index, query) pairs with similarity below "threshold" """
+
+    low = np.argwhere(matrix < threshold)
+    return set((names[i], names[j]) for i, j in low if i != j)
+
+
+# --------------------------------------------------
+def error_report(names, approx, exact_names, exact, threshold=0.):
+    """Compare an approximate matrix to an exact one on shared samples"""
+
+    shared = [name for name in names if name in set(exact_names)]
+    pos = {name: i for i, name in enumerate(names)}
+    exact_pos = {name: i for i, name in enumerate(exact_names)}
+    a_idx = [pos[name] for name in shared]
+    e_idx = [exact_pos[name] for name in shared]
+    a_vals = approx[np.ix_(a_idx, a_idx)]
+    e_vals = exact[np.ix_(e_idx, e_idx)]
+    off_diag = ~np.eye(len(shared), dtype=bool)
+    a_vals = a_vals[off_diag]
+    e_vals = e_vals[off_diag]
+
+    missed = int(((a_vals < threshold) & (e_vals > 0)).sum())
+    corr = np.corrcoef(a_vals, e_vals)[0, 1] if len(a_vals) > 1 else 1.
+
+    return ('{} samples: Pearson r = {:.4f}, mean abs error = {:.6f}, '
+            '{} of {} skipped pairs had exact similarity > 0').format(
+                len(shared), corr, np.abs(a_vals - e_vals).mean()
+                if len(a_vals) else 0, missed, int(
+                    (a_vals < threshold).sum()))
+
+
+# --------------------------------------------------
+def main():
+    """Start here"""
+
+    args = get_args()
+
+    if not os.path.isdir(args.out_dir):
+        os.makedirs(args.out_dir)
+
+    start = time.time()
+    files = []
+    for file in args.file:
+        if not os.path.isfile(file):
+            print('"{}" is not a file'.format(file), file=sys.stderr)
+            continue
+        files.append(
+            sketch_file(file, args.out_dir, args.kmer_size, args.sketch_size))
+    sketch_secs = time.time() - start
+
+    start = time.time()
+    names, sketches = load_sketches(files)
+    sim = similarity(sketches, abundance=args.abundance)
+    write_matrix(
+        os.path.join(args.out_dir, 'matrix_sketch.txt'), names, sim)
+
+    print('Sketched {} files in {:.2f}s, matrix in {:.2f}s'.format(
+        len(files), sketch_secs, time.time() - start))
+
+    if args.prefilter > 0:
+        print('Prefilter {} would skip {} of {} pairs'.format(
+            args.prefilter, len(skip_pairs(names, sim, args.prefilter)),
+            len(names)**2))
+
+    if args.exact:
+        exact_names, exact = read_matrix(args.exact)
+        print(error_report(names, sim, exact_names, exact, args.prefilter))
+
+
+# --------------------------------------------------
+if __name__ == '__main__':
+    main()
@@ -44,6 +44,13 @@ option_list = list(
     help = "Number of GBME iterations",
     metavar = "integer"
   ),
+  make_option(
+    c("-g", "--gbme_out"),
+    default = "",
+    type = "character",
+    help = "Existing GBME output (from gbme.py) to plot instead of running GBME",
+    metavar = "character"
+  ),
   make_option(
     c("-a", "--alias"),
     default = "",
@@ -59,6 +66,7 @@ matrix.file  = opt$matrix
 out.dir      = opt$out_dir
 n_iter       = opt$number
 alias.file   = opt$alias
+gbme.out     = opt$gbme_out
 sna.filename = opt$sna
 
 Y = as.matrix(read.table(matrix.file, header = TRUE))
@@ -81,6 +89,12 @@ if (!dir.exists(out.dir)) {
 }
 
 GBME_OUT = file.path(out.dir, "gbme.out")
+Z_OUT = file.path(out.dir, "Z")
+
+if (nchar(gbme.out) > 0) {
+  GBME_OUT = gbme.out
+  Z_OUT = file.path(dirname(gbme.out), "Z")
+}
 
 # Look for the "*.meta" files 
 meta_dir = file.path(out.dir, "meta")
@@ -112,12 +126,16 @@ Y = as.matrix(read.table(matrix.file, header = TRUE))
 n = nrow(Y)
 args = c(Xss, fam = "gaussian", k = 2, direct = F, NS = n_iter, odens = 10, ofilename = GBME_OUT)
 
-printf("Running GBME with %s scans\n", n_iter)
-
-if (is.null(Xss)) {
-  gbme(Y = Y, fam = "gaussian", k = 2, direct = F, NS = n_iter, odens = 10, ofilename = GBME_OUT)
+if (nchar(gbme.out) > 0) {
+  printf("Using GBME output '%s'\n", gbme.out)
 } else {
-  gbme(Y = Y, Xss, fam = "gaussian", k = 2, direct = F, NS = n_iter, odens = 10, ofilename = GBME_OUT)
+  printf("Running GBME with %s scans\n", n_iter)
+
+  if (is.null(Xss)) {
+    gbme(Y = Y, fam = "gaussian", k = 2, direct = F, NS = n_iter, odens = 10, ofilename = GBME_OUT, zfilename = Z_OUT)
+  } else {
+    gbme(Y = Y, Xss, fam = "gaussian", k = 2, direct = F, NS = n_iter, odens = 10, ofilename = GBME_OUT, zfilename = Z_OUT)
+  }
 }
 
 if (!file.exists(GBME_OUT)) {
@@ -171,7 +189,7 @@ print(M.SD.Q)
 #
 # analysis of latent positions
 #
-Z <- read.table("Z")
+Z <- read.table(Z_OUT)
 
 #
 # convert to an array
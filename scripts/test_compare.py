@@ -0,0 +1,111 @@
+"""Tests for compare.py"""
+
+import numpy as np
+import pytest
+import compare
+import kmers
+
+# k = 3; the index has AAA (count 2) and ACG/CGT (count 5)
+KMER_SIZE = 3
+
+READS = [
+    ('all_found', 'AAAAA'),  # [2, 2, 2]: mode 2, 100%
+    ('three_of_four', 'AAAAAC'),  # [2, 2, 2, 0]: mode 2, 75%
+    ('half', 'AAAACC'),  # [2, 2, 0, 0]: mode 0 on the tie, 50%
+    ('short', 'AC'),  # no kmers
+    ('n_only', 'AANAA'),  # no kmer without an N
+    ('n_split', 'ACGNAAA'),  # [5, 2]: mode 2 on the tie, 100%
+    ('two_of_three', 'ACGTT'),  # [5, 5, 0]: mode 5, 66.7%
+]
+
+
+# --------------------------------------------------
+def write_index(path, counts):
+    """Save an index of {kmer: count}"""
+
+    codes = np.array([kmers.kmer_codes([kmer.encode()], KMER_SIZE)[0]
+                      for kmer in counts], dtype=np.uint64)
+    values = np.array(list(counts.values()), dtype=np.uint64)
+    order = np.argsort(codes)
+
+    return kmers.save_index(path, codes[order], values[order])
+
+
+# --------------------------------------------------
+@pytest.fixture(name='files')
+def fixture_files(tmp_path):
+    """A query FASTA and an index for it"""
+
+    query = str(tmp_path / 'qry.fa')
+    with open(query, 'wt') as out_fh:
+        for name, seq in READS:
+            out_fh.write('>{}\n{}\n'.format(name, seq))
+
+    return query, write_index(str(tmp_path / 'idx.npy'), {
+        'AAA': 2,
+        'ACG': 5
+    })
+
+
+# --------------------------------------------------
+@pytest.mark.parametrize('min_mode, pct_kmer_coverage, num_kept', [
+    (1, 75, 3),
+    (1, 76, 2),
+    (2, 10, 4),
+    (3, 10, 1),
+    (0, 50, 5),
+    (0, 51, 4),
+    (0, 0, 5),
+])
+def test_count_kept(files, min_mode, pct_kmer_coverage, num_kept):
+    """Reads kept by the mode and percent coverage of their kmers"""
+
+    query, index = files
+    kept, num_reads = compare.count_kept(query, [index], KMER_SIZE,
+                                         min_mode, pct_kmer_coverage)
+
+    assert num_reads == len(READS)
+    assert kept == {'idx': num_kept}
+
+
+# --------------------------------------------------
+def test_count_kept_empty_index(files, tmp_path):
+    """An empty index keeps only reads with kmers when nothing is asked"""
+
+    query, index = files
+    empty = kmers.save_index(
+        str(tmp_path / 'empty.npy'), np.zeros(0, dtype=np.uint64),
+        np.zeros(0, dtype=np.uint64))
+
+    assert compare.count_kept(query, [index, empty],
+                              KMER_SIZE) == ({'idx': 4, 'empty': 0},
+                                             len(READS))
+    assert compare.count_kept(query, [empty], KMER_SIZE, 0,
+                              0) == ({'empty': 5}, len(READS))
+
+
+# --------------------------------------------------
+def test_count_kept_batches(files):
+    """Small batches count the same as one"""
+
+    query, index = files
+    for batch_size in [1, 10, 4000000]:
+        assert compare.count_kept(query, [index], KMER_SIZE, 1, 75,
+                                  batch_size) == ({'idx': 3}, len(READS))
+
+
+# --------------------------------------------------
+def test_keep_reads():
+    """Ties go to the lower count; reads with no kmers are never kept"""
+
+    counts = np.array([2, 5, 5, 2, 0], dtype=np.uint64)
+    read_ids = np.array([0, 0, 1, 1, 2])
+
+    keep = compare.keep_reads(counts, read_ids, 4, 2, 0)
+    assert keep.tolist() == [True, True, False, False]
+
+    keep = compare.keep_reads(counts, read_ids, 4, 3, 0)
+    assert keep.tolist() == [False, False, False, False]
+
+    keep = compare.keep_reads(counts, read_ids, 4, 0, 0)
+    assert keep.tolist() == [True, True, True, False]
@@ -0,0 +1,86 @@
+"""Tests for fa_subset.py"""
+
+import gzip
+import os
+import fa_subset
+import fastx
+
+
+# --------------------------------------------------
+def write_fastq(path, num):
+    """Write "num" FASTQ reads whose qualities start with "@" and "+" """
+
+    with open(path, 'wt') as out_fh:
+        for i in range(num):
+            out_fh.write('@read{}\nACGTACGTAC\n+\n@+IIIIIIII\n'.format(i))
+
+    return path
+
+
+# --------------------------------------------------
+def read_fasta(path):
+    """(ids, seqs) of a FASTA file"""
+
+    with open(path) as fh:
+        lines = fh.read().splitlines()
+
+    return lines[0::2], lines[1::2]
+
+
+# --------------------------------------------------
+def test_fastq_guessed(tmp_path):
+    """FASTQ is subset by record, not by line, without --input_format"""
+
+    in_file = write_fastq(str(tmp_path / 'samp.fq'), 200)
+    out_dir = str(tmp_path / 'subset')
+    os.makedirs(out_dir)
+
+    out_file, num_read, num_taken = fa_subset.subset_file(
+        in_file, out_dir, 50)
+
+    assert (num_read, num_taken) == (200, 50)
+    ids, seqs = read_fasta(out_file)
+    assert len(ids) == 50
+    assert all(id_.startswith('>read') for id_ in ids)
+    assert set(seqs) == {'ACGTACGTAC'}
+
+
+# --------------------------------------------------
+def test_fastq_compressed_and_split(tmp_path, monkeypatch):
+    """The gzipped and the range-split paths take the same reads"""
+
+    in_file = write_fastq(str(tmp_path / 'samp.fq'), 2000)
+    with open(in_file, 'rb') as fh, gzip.open(in_file + '.gz', 'wb') as gz:
+        gz.write(fh.read())
+
+    taken = []
+    for path, procs in ((in_file, 1), (in_file + '.gz', 1), (in_file, 2)):
+        monkeypatch.setattr(fastx, 'SPLIT_BYTES', 2**20 if procs == 1 else
+                            2**10)
+        out_dir = str(tmp_path / 'out{}{}'.format(len(taken), procs))
+        os.makedirs(out_dir)
+        out_file, num_read, _ = fa_subset.subset_file(
+            path, out_dir, 100, seed=3, procs=procs)
+        assert num_read == 2000
+        taken.append(read_fasta(out_file))
+
+    assert taken[0] == taken[1] == taken[2]
+    assert len(taken[0][0]) == 100
+
+
+# --------------------------------------------------
+def test_fastq_kept_as_fastq(tmp_path):
+    """Asking for FASTQ out keeps whole FASTQ records"""
+
+    in_file = write_fastq(str(tmp_path / 'samp.fq'), 20)
+    out_dir = str(tmp_path / 'subset')
+    os.makedirs(out_dir)
+
+    out_file, _, num_taken = fa_subset.subset_file(
+        in_file, out_dir, 5, output_format='fastq')
+
+    with open(out_file) as fh:
+        lines = fh.read().splitlines()
+
+    assert num_taken == 5 and len(lines) == 20
+    assert lines[2::4] == ['+'] * 5
@@ -0,0 +1,103 @@
+"""Tests for kept.py"""
+
+import subprocess
+import numpy as np
+import pytest
+import kept
+
+
+# --------------------------------------------------
+def write_fasta(path, num):
+    """Write "num" two-line FASTA reads "read0".."read<num - 1>" """
+
+    with open(path, 'wt') as out_fh:
+        for i in range(num):
+            out_fh.write('>read{} some description\nACGT{}\n'.format(i, i))
+
+    return path
+
+
+# --------------------------------------------------
+def read_ids(path):
+    """The IDs of a FASTA file, in order"""
+
+    with open(path) as fh:
+        return [line[1:].split()[0] for line in fh if line.startswith('>')]
+
+
+# --------------------------------------------------
+def test_encode_empty():
+    """No ordinals round-trip"""
+
+    blob = kept.encode([])
+    assert len(kept.decode(blob)) == 0
+
+
+# --------------------------------------------------
+def test_encode_dense_runs():
+    """Long runs are stored as runs and come back exactly"""
+
+    ordinals = np.concatenate((np.arange(5, 5000), np.arange(7000, 9000),
+                               [12345]))
+    blob = kept.encode(ordinals)
+
+    assert blob[:1] == b'R'
+    assert np.array_equal(kept.decode(blob), ordinals)
+
+
+# --------------------------------------------------
+def test_encode_bitmap():
+    """Scattered ordinals are stored as a bitmap and come back exactly"""
+
+    ordinals = np.flatnonzero(
+        np.random.RandomState(1).randint(0, 2, 10000).astype(bool))
+    blob = kept.encode(ordinals)
+
+    assert blob[:1] == b'B'
+    assert np.array_equal(kept.decode(blob), ordinals)
+
+
+# --------------------------------------------------
+def test_extract_kept_and_rejected(tmp_path):
+    """The stored reads, and the rest, are extracted as in the query"""
+
+    query = write_fasta(str(tmp_path / 'qry.fa'), 10)
+    with open(query) as fh:
+        lines = fh.read().splitlines(True)
+    records = [''.join(lines[i:i + 2]) for i in range(0, len(lines), 2)]
+
+    reads = str(tmp_path / 'reads.fa')
+    with open(reads, 'wt') as out_fh:
+        for i in [7, 2, 3]:
+            out_fh.write(records[i])
+
+    container = kept.container_path(str(tmp_path), 'idx')
+    assert kept.store(container, query, reads) == 3
+    assert kept.counts(container) == {'qry.fa': (10, 3)}
+
+    out_file = str(tmp_path / 'kept.fa')
+    assert kept.extract(container, query, out_file) == 3
+    assert read_ids(out_file) == ['read2', 'read3', 'read7']
+    with open(out_file) as fh:
+        assert fh.read() == records[2] + records[3] + records[7]
+
+    out_file = str(tmp_path / 'rejected.fa')
+    assert kept.extract(container, query, out_file, rejected=True) == 7
+    assert read_ids(out_file) == [
+        'read{}'.format(i) for i in [0, 1, 4, 5, 6, 8, 9]
+    ]
+
+
+# --------------------------------------------------
+def test_store_pipe(tmp_path):
+    """The reads a pipeline writes are stored; a failed one stores none"""
+
+    query = write_fasta(str(tmp_path / 'qry.fa'), 10)
+    container = kept.container_path(str(tmp_path), 'idx')
+
+    assert kept.store_pipe(container, query, 'head -4 ' + query) == 2
+    assert list(kept.get(container, 'qry.fa')) == [0, 1]
+
+    with pytest.raises(subprocess.CalledProcessError):
+        kept.store_pipe(container, query, 'tail -2 {} | false'.format(query))
+    assert list(kept.get(container, 'qry.fa')) == [0, 1]
@@ -0,0 +1,82 @@
+"""Tests for kmers.py"""
+
+import numpy as np
+import pytest
+import kmers
+
+COMPLEMENT = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A'}
+
+
+# --------------------------------------------------
+def encode(kmer):
+    """2-bit code of a kmer, A=0 C=1 G=2 T=3"""
+
+    code = 0
+    for base in kmer:
+        code = code * 4 + 'ACGT'.index(base)
+    return code
+
+
+# --------------------------------------------------
+def naive_codes(seqs, kmer_size):
+    """Canonical code and read of every kmer without an N, one by one"""
+
+    codes, read_ids = [], []
+    for read_id, seq in enumerate(seqs):
+        for i in range(len(seq) - kmer_size + 1):
+            kmer = seq[i:i + kmer_size].upper()
+            if set(kmer) <= set('ACGT'):
+                rev = ''.join(COMPLEMENT[base] for base in reversed(kmer))
+                codes.append(min(encode(kmer), encode(rev)))
+                read_ids.append(read_id)
+
+    return codes, read_ids
+
+
+# --------------------------------------------------
+def test_canonical():
+    """A kmer and its reverse complement share the lower code"""
+
+    assert kmers.kmer_codes([b'ACG'], 3).tolist() == [encode('ACG')]
+    assert kmers.kmer_codes([b'CGT'], 3).tolist() == [encode('ACG')]
+    assert kmers.kmer_codes([b'TTT'], 3).tolist() == [0]
+    assert kmers.kmer_codes([b'acg'], 3).tolist() == [encode('ACG')]
+
+    # All 32 bases fill the uint64
+    assert kmers.kmer_codes([b'T' * 32], 32).tolist() == [0]
+    assert kmers.kmer_codes([b'C' * 32], 32).tolist() == [encode('C' * 32)]
+
+
+# --------------------------------------------------
+@pytest.mark.parametrize('kmer_size', [1, 5, 21, 32])
+def test_array_codes(kmer_size):
+    """Codes and read IDs match a base-by-base encoding, skipping Ns"""
+
+    rand = np.random.RandomState(kmer_size)
+    seqs = [
+        ''.join(rand.choice(list('ACGTN'), p=[.24, .24, .24, .24, .04],
+                            size=size))
+        for size in rand.randint(0, 80, 50)
+    ] + ['', 'N' * 40, 'ACGT' * 20]
+
+    buf = np.frombuffer(('N' + 'N'.join(seqs)).encode(), dtype=np.uint8)
+    starts = np.cumsum([1] + [len(seq) + 1 for seq in seqs[:-1]])
+    codes, read_ids = kmers.array_codes(buf, starts, kmer_size,
+                                        with_read_ids=True)
+
+    assert (codes.tolist(), read_ids.tolist()) == naive_codes(
+        seqs, kmer_size)
+    assert codes.dtype == np.uint64
+
+
+# --------------------------------------------------
+def test_array_codes_empty():
+    """Too short a buffer has no codes; a bad kmer size is an error"""
+
+    buf = np.frombuffer(b'NAC', dtype=np.uint8)
+    codes, read_ids = kmers.array_codes(buf, np.array([1]), 3, True)
+    assert len(codes) == 0 and len(read_ids) == 0
+
+    for kmer_size in [0, kmers.MAX_KMER_SIZE + 1]:
+        with pytest.raises(ValueError):
+            kmers.array_codes(buf, np.array([1]), kmer_size)
@@ -0,0 +1,403 @@
+"""Per-stage and per-job resource use as JSON lines and a Chrome trace"""
+
+import functools
+import json
+import os
+import resource
+import threading
+import time
+
+# The active Tracer, None when tracing is off
+TRACER = None
+
+# Seconds between samples of a stage's RSS
+SAMPLE_SECS = 0.1
+
+# The stages running, outermost first
+ACTIVE = []
+
+
+# --------------------------------------------------
+class Tracer:
+    """Collect events, appending each to "<prefix>.jsonl" as it ends"""
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.origin = time.time()
+        self.events = []
+        self.out_fh = open(prefix + '.jsonl', 'wt')
+
+    def add(self, event):
+        """Record one finished stage or job"""
+
+        self.events.append(event)
+        self.out_fh.write(json.dumps(event) + '\n')
+        self.out_fh.flush()
+
+    def close(self):
+        """Write "<prefix>.json" for chrome://tracing or Perfetto"""
+
+        self.out_fh.close()
+        with open(self.prefix + '.json', 'wt') as out_fh:
+            json.dump({'traceEvents': chrome_events(self.events,
+                                                    self.origin)}, out_fh)
+
+
+# --------------------------------------------------
+class NoStage:
+    """What "stage" hands out when tracing is off"""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NO_STAGE = NoStage()
+
+
+# --------------------------------------------------
+class Stage:
+    """
+    Measure a block of this process and the children it reaps; its peak
+    RSS is sampled from /proc as the sum over this process tree (all the
+    workers and jobs running at once), else it is the process' peak
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.start = None
+        self.before = None
+        self.max_rss = 0
+        self.stopped = threading.Event()
+        self.sampler = None
+
+    def __enter__(self):
+        self.start = time.time()
+        self.before = usage()
+        if tree_rss() is not None:
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+        ACTIVE.append(self)
+        return self
+
+    def sample(self):
+        """Keep the largest RSS of the process tree until stopped"""
+
+        while True:
+            self.max_rss = max(self.max_rss, tree_rss() or 0)
+            if self.stopped.wait(SAMPLE_SECS):
+                return
+
+    def __exit__(self, exc_type, exc, tb):
+        after = usage()
+        if self.sampler:
+            self.stopped.set()
+            self.sampler.join()
+        ACTIVE.remove(self)
+        # A peak seen by a nested stage is one of the enclosing stages' too
+        for outer in ACTIVE:
+            outer.max_rss = max(outer.max_rss, self.max_rss)
+        event = {
+            'kind': 'stage',
+            'name': self.name,
+            'stage': self.name,
+            'start': self.start,
+            'wall': time.time() - self.start,
+            'status': 0 if exc_type is None else 1
+        }
+        for key in ['cpu', 'read_bytes', 'write_bytes']:
+            event[key] = after[key] - self.before[key]
+        event['max_rss'] = self.max_rss if self.sampler else \
+            after['max_rss']
+
+        if TRACER:
+            TRACER.add(event)
+
+        return False
+
+
+# --------------------------------------------------
+def usage():
+    """CPU seconds, peak RSS and block I/O bytes of this process tree"""
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    kids = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return {
+        'cpu': own.ru_utime + own.ru_stime + kids.ru_utime + kids.ru_stime,
+        'max_rss': max(own.ru_maxrss, kids.ru_maxrss) * 1024,
+        'read_bytes': (own.ru_inblock + kids.ru_inblock) * 512,
+        'write_bytes': (own.ru_oublock + kids.ru_oublock) * 512
+    }
+
+
+# --------------------------------------------------
+def tree_rss(pid=None):
+    """
+    Bytes resident in a process (default this one) and all of its
+    descendants, from /proc; None where there is no /proc
+    """
+
+    pid = pid or os.getpid()
+    try:
+        names = os.listdir('/proc')
+    except OSError:
+        return None
+
+    children = {}
+    rss = {}
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for name in names:
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as fh:
+                # The command name may hold spaces, so split after it
+                fields = fh.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        children.setdefault(int(fields[1]), []).append(int(name))
+        rss[int(name)] = int(fields[21]) * page_size
+
+    if pid not in rss:
+        return None
+
+    total = 0
+    todo = [pid]
+    while todo:
+        proc = todo.pop()
+        total += rss.get(proc, 0)
+        todo.extend(children.get(proc, []))
+
+    return total
+
+
+# --------------------------------------------------
+def reset_peak_rss():
+    """Start this process' peak RSS (VmHWM) over, where Linux allows it"""
+
+    try:
+        with open('/proc/self/clear_refs', 'wt') as fh:
+            fh.write('5')
+        return True
+    except OSError:
+        return False
+
+
+# --------------------------------------------------
+def peak_rss():
+    """This process' peak RSS in bytes (since "reset_peak_rss")"""
+
+    try:
+        with open('/proc/self/status') as fh:
+            for line in fh:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# --------------------------------------------------
+def process_start():
+    """
+    Epoch seconds when this process started (before the interpreter
+    loaded), from /proc; now where there is no /proc
+    """
+
+    try:
+        with open('/proc/self/stat') as fh:
+            ticks = int(fh.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as fh:
+            uptime = float(fh.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return time.time()
+
+    return time.time() - uptime + ticks / os.sysconf('SC_CLK_TCK')
+
+
+# --------------------------------------------------
+def measure(func, *args):
+    """
+    Call "func(*args)" where the work is done (e.g. in a pool worker),
+    returning the result and its usage for "add_task": start, wall and
+    CPU seconds, peak RSS and block I/O of this process and the
+    children it reaped meanwhile
+    """
+
+    reset_peak_rss()
+    before = usage()
+    kids_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    start = time.time()
+    result = func(*args)
+    wall = time.time() - start
+    after = usage()
+
+    # Children's peak counts only if one of this call's set a new one
+    new_kids_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    record = {
+        'start': start,
+        'wall': wall,
+        'max_rss': max(peak_rss(), new_kids_rss * 1024
+                       if new_kids_rss > kids_rss else 0)
+    }
+    for key in ['cpu', 'read_bytes', 'write_bytes']:
+        record[key] = after[key] - before[key]
+
+    return result, record
+
+
+# --------------------------------------------------
+def enable(prefix):
+    """Start tracing into "<prefix>.jsonl" and "<prefix>.json\""""
+
+    global TRACER
+    TRACER = Tracer(prefix)
+
+    return TRACER
+
+
+# --------------------------------------------------
+def finish():
+    """Stop tracing, write the Chrome trace and return the summary"""
+
+    global TRACER
+    if not TRACER:
+        return ''
+
+    tracer, TRACER = TRACER, None
+    tracer.close()
+
+    return summary(tracer.events)
+
+
+# --------------------------------------------------
+def stage(name):
+    """Context manager timing a stage, (almost) free when tracing is off"""
+
+    return Stage(name) if TRACER else NO_STAGE
+
+
+# --------------------------------------------------
+def traced(func):
+    """Decorate a stage function to trace it under its own name"""
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not TRACER:
+            return func(*args, **kwargs)
+
+        with Stage(func.__name__):
+            return func(*args, **kwargs)
+
+    return wrapper
+
+
+# --------------------------------------------------
+def add_jobs(jobs, stage_name):
+    """Record the scheduler jobs that ran"""
+
+    for job in jobs:
+        if job.status is None:
+            continue
+
+        add_task(job.name, stage_name, {
+            'start': job.start,
+            'wall': job.seconds,
+            'cpu': job.cpu,
+            'max_rss': job.max_rss,
+            'read_bytes': job.read_bytes,
+            'write_bytes': job.write_bytes
+        }, job.status)
+
+
+# --------------------------------------------------
+def add_task(name, stage_name, record, status=0):
+    """Record one task of a stage, with its usage from "measure" """
+
+    if not TRACER:
+        return
+
+    TRACER.add(dict(record, kind='job', name=name, stage=stage_name,
+                    status=status))
+
+
+# --------------------------------------------------
+def chrome_events(events, origin):
+    """
+    Trace-event "X" records: stages on the first row, jobs packed onto
+    as few rows as they need without overlapping
+    """
+
+    lanes = []
+    trace = []
+    for event in sorted(events, key=lambda e: e['start']):
+        if event['kind'] == 'stage':
+            tid = 0
+        else:
+            for tid, free_at in enumerate(lanes, start=1):
+                if free_at <= event['start']:
+                    break
+            else:
+                lanes.append(0)
+                tid = len(lanes)
+            lanes[tid - 1] = event['start'] + event['wall']
+
+        trace.append({
+            'name': event['name'],
+            'cat': event['kind'],
+            'ph': 'X',
+            'pid': 1,
+            'tid': tid,
+            'ts': int((event['start'] - origin) * 1e6),
+            'dur': int(event['wall'] * 1e6),
+            'args': {
+                key: event[key]
+                for key in ['stage', 'cpu', 'max_rss', 'read_bytes',
+                            'write_bytes', 'status']
+            }
+        })
+
+    return trace
+
+
+# --------------------------------------------------
+def summary(events, num_slowest=5):
+    """A table of the stages and the slowest jobs"""
+
+    mib = 2.**20
+    row = '{:<40} {:>6} {:>10} {:>10} {:>9} {:>9} {:>9} {:>4}'
+    lines = [
+        row.format('stage', 'jobs', 'wall_s', 'cpu_s', 'rss_MiB', 'read_MiB',
+                   'write_MiB', 'fail')
+    ]
+
+    for event in events:
+        if event['kind'] != 'stage':
+            continue
+
+        jobs = [e for e in events
+                if e['kind'] == 'job' and e['stage'] == event['name']]
+        lines.append(
+            row.format(event['name'][:40], len(jobs),
+                       '{:.1f}'.format(event['wall']),
+                       '{:.1f}'.format(event['cpu']),
+                       '{:.0f}'.format(max([event['max_rss']] +
+                                           [e['max_rss'] for e in jobs]) /
+                                       mib),
+                       '{:.0f}'.format(event['read_bytes'] / mib),
+                       '{:.0f}'.format(event['write_bytes'] / mib),
+                       sum(e['status'] != 0 for e in jobs + [event])))
+
+    jobs = sorted((e for e in events if e['kind'] == 'job'),
+                  key=lambda e: e['wall'], reverse=True)[:num_slowest]
+    if jobs:
+        lines.append('Slowest jobs:')
+        for job in jobs:
+            lines.append('  {:.1f}s {:.0f} MiB {}'.format(
+                job['wall'], job['max_rss'] / mib, job['name']))
+
+    return '\n'.join(lines)
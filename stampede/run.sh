@@ -46,6 +46,47 @@ function lc() {
     [[ -f "$FILE" ]] && wc -l "$FILE" | cut -d ' ' -f 1
 }
 
+#
+# Compressed input is streamed through a (parallel) decompressor,
+# its sample name drops the compression extension
+#
+function cat_cmd() {
+    FILE=$1
+    case "$FILE" in
+        *.gz|*.bgz)
+            if command -v pigz > /dev/null; then
+                echo "pigz -dc -p $THREADS $FILE"
+            else
+                echo "gzip -dc $FILE"
+            fi
+            ;;
+        *.bz2)
+            echo "bzip2 -dc $FILE"
+            ;;
+        *.zst)
+            echo "zstd -dcq -T$THREADS $FILE"
+            ;;
+        *)
+            echo "cat $FILE"
+    esac
+}
+
+function is_compressed() {
+    [[ "$1" =~ \.(gz|bgz|bz2|zst)$ ]]
+}
+
+function sample_name() {
+    basename "$1" | sed -E 's/\.(gz|bgz|bz2|zst)$//'
+}
+
+function gzip_cmd() {
+    if command -v pigz > /dev/null; then
+        echo "pigz -c"
+    else
+        echo "gzip -c"
+    fi
+}
+
 function HELP() {
     printf "Usage:\\n  %s -i IN_DIR \\n\\n" "$(basename "$0")"
   
@@ -211,10 +252,11 @@ if [[ $MAX_SEQS -gt 0 ]]; then
 
     COUNTS_PARAM="$$.count.param"
     while read -r FILE; do
-        BASE=$(basename "$FILE")
+        BASE=$(sample_name "$FILE")
         COUNT_FILE="$COUNT_DIR/$BASE"
         if [[ ! -f "$COUNT_FILE" ]]; then
-            echo "grep -ce '^>' $FILE > $COUNT_FILE" >> "$COUNTS_PARAM"
+            echo "$(cat_cmd "$FILE") | grep -ce '^>' > $COUNT_FILE.tmp; [[ -s $COUNT_FILE.tmp ]] && mv $COUNT_FILE.tmp $COUNT_FILE" \
+                >> "$COUNTS_PARAM"
         fi
     done < "$INPUT_FILES"
 
@@ -238,7 +280,7 @@ if [[ $MAX_SEQS -gt 0 ]]; then
     fi
 
     COUNTS=$(mktemp)
-    cat "$COUNT_DIR"/* > "$COUNTS"
+    find "$COUNT_DIR" -type f ! -name '*.tmp' -exec cat {} + > "$COUNTS"
     LOWEST_READ_COUNT=$(sort -n "$COUNTS" | head -n 1)
 
     if [[ $LOWEST_READ_COUNT -lt $MIN_SEQS ]]; then
@@ -257,39 +299,36 @@ if [[ $MAX_SEQS -gt 0 ]]; then
     SUBSET_DIR="$OUT_DIR/subset"
     [[ ! -d "$SUBSET_DIR" ]] && mkdir -p "$SUBSET_DIR"
 
-    SUBSET_PARAM="$$.subset.param"
+    SUBSET_MANIFEST="$$.subset.manifest"
     i=0
     while read -r FILE; do
         i=$((i+1))
-        BASENAME=$(basename "$FILE")
+        BASENAME=$(sample_name "$FILE")
         printf "%3d: %s\\n" $i "$BASENAME"
 
         SUBSET_FILE="$SUBSET_DIR/$BASENAME"
         if [[ -s "$SUBSET_FILE" ]]; then
             echo "SUBSET_FILE \"$SUBSET_FILE\" exists, skipping"
         else
-            echo "$SINGULARITY_EXEC fa_subset.py -o $SUBSET_DIR -n $MAX_SEQS $FILE" >> "$SUBSET_PARAM"
+            echo "$FILE" >> "$SUBSET_MANIFEST"
         fi
     done < "$INPUT_FILES"
 
-    NJOBS=$(lc "$SUBSET_PARAM")
+    NFILES=$(lc "$SUBSET_MANIFEST")
 
-    if [[ $NJOBS -lt 1 ]]; then
-        echo "No subset launcher jobs to run!"
+    if [[ $NFILES -lt 1 ]]; then
+        echo "No files to subset!"
     else
-        echo "Starting NJOBS \"$NJOBS\" $(date)"
-        LAUNCHER_JOB_FILE="$SUBSET_PARAM"
-        LAUNCHER_PPN=$NJOBS
-        export LAUNCHER_JOB_FILE
-        export LAUNCHER_PPN
-        $PARAMRUN
-        echo "Ended LAUNCHER $(date)"
-        unset LAUNCHER_PPN
-        rm "$SUBSET_PARAM"
+        # One batch of long-lived workers, not an interpreter per file
+        echo "Subsetting NFILES \"$NFILES\" $(date)"
+        $SINGULARITY_EXEC fa_subset.py -o "$SUBSET_DIR" -n "$MAX_SEQS" \
+            -M "$SUBSET_MANIFEST" -P "$THREADS"
+        echo "Ended subsetting $(date)"
+        rm "$SUBSET_MANIFEST"
     fi
 
     SUBSET_FILES=$(mktemp)
-    find "$SUBSET_DIR" -type f -size +0c > "$SUBSET_FILES"
+    find "$SUBSET_DIR" -type f -size +0c ! -name '*.tmp' > "$SUBSET_FILES"
 else
     echo "No MAX_SEQS, so using raw INPUT_FILES"
     SUBSET_FILES="$INPUT_FILES"
@@ -319,14 +358,17 @@ COUNT_PARAM="$$.count.param"
 i=0
 while read -r FILE; do
     i=$((i+1))
-    BASENAME=$(basename "$FILE")
+    BASENAME=$(sample_name "$FILE")
     printf "%3d: %s\\n" $i "$BASENAME"
     
     JF_FILE="$JF_DIR/$BASENAME"
     if [[ -s "$JF_FILE" ]]; then
         echo "Index exists for \"$BASENAME,\" skipping"
-    else 
-        echo "$COUNT_CMD -o $JF_FILE $FILE" >> "$COUNT_PARAM"
+    elif is_compressed "$FILE"; then
+        echo "$(cat_cmd "$FILE") | $COUNT_CMD -o $JF_FILE.tmp /dev/stdin && mv $JF_FILE.tmp $JF_FILE" \
+            >> "$COUNT_PARAM"
+    else
+        echo "$COUNT_CMD -o $JF_FILE.tmp $FILE && mv $JF_FILE.tmp $JF_FILE" >> "$COUNT_PARAM"
     fi
 done < "$SUBSET_FILES"
 
@@ -351,7 +393,7 @@ else
 fi
 
 JF_INDEXES=$(mktemp)
-find "$JF_DIR" -type f -size +0c > "$JF_INDEXES"
+find "$JF_DIR" -type f -size +0c ! -name '*.tmp' > "$JF_INDEXES"
 NUM_JF=$(lc "$JF_INDEXES")
 
 if [[ $NUM_JF -lt 1 ]]; then
@@ -382,17 +424,35 @@ while read -r INDEX; do
 
     while read -r FASTA; do
         i=$((i+1))
-        FASTA_BASENAME=$(basename "$FASTA")
+        FASTA_BASENAME=$(sample_name "$FASTA")
 
         printf "%3d: %s -> %s\\n" $i "$INDEX_BASENAME" "$FASTA_BASENAME"
 
         KEEP_OUT="$KEEP_DIR/$FASTA_BASENAME"
         REJECT_OUT="$REJECT_DIR/$FASTA_BASENAME"
+        if [[ $GZIP_READS -gt 0 ]]; then
+            KEEP_OUT="$KEEP_OUT.gz"
+            REJECT_OUT="$REJECT_OUT.gz"
+        fi
 
+        IN_CMD=""
+        IN_FILE="$FASTA"
+        if is_compressed "$FASTA"; then
+            IN_CMD="$(cat_cmd "$FASTA") | "
+            IN_FILE="/dev/stdin"
+        fi
+
+        # Outputs get their names only once complete, so a job killed
+        # part way (walltime, --halt) is redone on the next run
+        RENAME_OUT="mv $KEEP_OUT.tmp $KEEP_OUT && mv $REJECT_OUT.tmp $REJECT_OUT"
         if [[ -s "$KEEP_OUT" ]]; then
             echo "\"$KEEP_OUT\" exists, skipping"
+        elif [[ $GZIP_READS -gt 0 ]]; then
+            # Kept (STDOUT) and rejected (STDERR) are gzipped as written
+            echo "$IN_CMD{ $QUERY_CMD $INDEX $IN_FILE 2>&1 1>&3 | $(gzip_cmd) > $REJECT_OUT.tmp; } 3>&1 | $(gzip_cmd) > $KEEP_OUT.tmp && $RENAME_OUT" \
+                >> "$QUERY_PARAM"
         else
-            echo "$QUERY_CMD $INDEX $FASTA 1>$KEEP_OUT 2>$REJECT_OUT" \
+            echo "$IN_CMD$QUERY_CMD $INDEX $IN_FILE 1>$KEEP_OUT.tmp 2>$REJECT_OUT.tmp && $RENAME_OUT" \
                 >> "$QUERY_PARAM"
         fi
     done < "$SUBSET_FILES"
@@ -421,7 +481,7 @@ fi
 # 4. Count the number of reads for each comparison
 #
 QUERIES=$(mktemp)
-find "$READS_KEPT_DIR" -type f > "$QUERIES"
+find "$READS_KEPT_DIR" -type f ! -name '*.tmp' > "$QUERIES"
 NUM_QUERIES=$(lc "$QUERIES")
 
 if [[ $NUM_QUERIES -lt 1 ]]; then
@@ -435,7 +495,7 @@ echo "Counting NUM_QUERIES \"$NUM_QUERIES\""
 MODE_DIR="$OUT_DIR/mode"
 
 while read -r QRY_FILE; do
-    BASENAME=$(basename "$QRY_FILE")
+    BASENAME=$(sample_name "$QRY_FILE")
     BASE_DIR=$(basename "$(dirname "$QRY_FILE")")
 
     MODE_OUT_DIR="$MODE_DIR/$BASE_DIR"
@@ -443,7 +503,9 @@ while read -r QRY_FILE; do
 
     MODE_FILE="$MODE_OUT_DIR/$BASENAME"
     if [[ ! -f "$MODE_FILE" ]]; then
-        grep -ce '^>' "$QRY_FILE" > "$MODE_FILE"
+        # "grep -c" fails on 0, it prints the count only once done
+        $(cat_cmd "$QRY_FILE") | grep -ce '^>' > "$MODE_FILE.tmp"
+        [[ -s "$MODE_FILE.tmp" ]] && mv "$MODE_FILE.tmp" "$MODE_FILE"
     fi
 done < "$QUERIES"
 rm "$QUERIES"
@@ -507,7 +569,9 @@ ALIAS_FILE_ARG=""
 GBME_PREVIOUS="$SNA_DIR/gbme.out"
 [[ -f "$GBME_PREVIOUS" ]] && rm -f "$GBME_PREVIOUS"
 
-$SINGULARITY_EXEC sna.r -m "$MATRIX_NORM" -o "$SNA_DIR" -s "sna-gbme.pdf" -n $NUM_SCANS $ALIAS_FILE_ARG
+$SINGULARITY_EXEC gbme.py -m "$MATRIX_NORM" -o "$SNA_DIR" -n $NUM_SCANS -p $THREADS
+
+$SINGULARITY_EXEC sna.r -m "$MATRIX_NORM" -o "$SNA_DIR" -s "sna-gbme.pdf" -g "$GBME_PREVIOUS" $ALIAS_FILE_ARG
 
 GBME_OUT="$SNA_DIR/sna-gbme.pdf"
 [[ ! -f "$GBME_OUT" ]] && echo "Failed to create GBME_OUT \"$GBME_OUT\""
@@ -529,29 +593,6 @@ for READS_DIR in $READS_KEPT_DIR $READS_REJECTED_DIR; do
     if [[ $KEEP_READS -gt 0 ]]; then
         find "$READS_DIR" -type f -size 0 -delete
         find "$READS_DIR" -type d -empty -delete
-
-        if [[ $GZIP_READS -gt 0 ]]; then
-            echo "Compressing READS_DIR \"$READS_DIR\""
-            GZIP_PARAM="$$.gzip.param"
-            find "$READS_DIR" -type f -size +0c -exec echo gzip {} \; > "$GZIP_PARAM"
-            NJOBS=$(lc "$GZIP_PARAM")
-            if [[ $NJOBS -lt 1 ]]; then
-                echo "No subset launcher jobs to run!"
-            else
-                echo "Starting NJOBS \"$NJOBS\" $(date)"
-                LAUNCHER_JOB_FILE="$GZIP_PARAM"
-                LAUNCHER_PPN=$NJOBS
-                if [[ $LAUNCHER_PPN -gt 16 ]]; then
-                    LAUNCHER_PPN=16
-                fi
-                export LAUNCHER_JOB_FILE
-                export LAUNCHER_PPN
-                $PARAMRUN
-                echo "Ended LAUNCHER $(date)"
-                unset LAUNCHER_PPN
-            fi
-            rm "$GZIP_PARAM"
-        fi
     else
         echo "Removing READS_DIR \"$READS_DIR\""
         rm -rf "$READS_DIR"